@@ -0,0 +1,71 @@
+"""مقایسه اتصال جدید برای هر کوئری (رفتار قبلی) با اتصال ماندگار هر ترد (Database.get_connection).
+
+اجرا از ریشه مخزن:  python bench/bench_db.py [تعداد تکرار]
+کوئری‌ها مستقیم روی اتصال اجرا می‌شوند تا کش‌های حافظه (کاربر، تنظیمات، سرورها) در نتیجه اثر نگذارند.
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp(prefix='sonar-bench-'))
+
+import bot  # noqa: E402
+
+QUERIES = {
+    'get_user': ('SELECT * FROM users WHERE user_id = ?', (42,)),
+    'get_setting': ('SELECT value FROM settings WHERE owner_id = ? AND key = ?', (42, 'cpu_threshold')),
+    'get_all_user_servers': ('SELECT * FROM servers WHERE owner_id = ?', (42,)),
+}
+
+
+@contextmanager
+def connect_per_query(path):
+    """همان get_connection قبل از اتصال ماندگار"""
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    try:
+        conn.execute('PRAGMA journal_mode=WAL;')
+        yield conn
+    finally:
+        conn.close()
+
+
+def seed(db):
+    with db.get_connection() as conn:
+        conn.execute("INSERT INTO users (user_id, full_name, expiry_date) VALUES (42, 'bench', '2030-01-01 00:00:00')")
+        conn.execute("INSERT INTO settings (owner_id, key, value) VALUES (42, 'cpu_threshold', '80')")
+        conn.executemany(
+            "INSERT INTO servers (owner_id, name, ip, port, username, password) VALUES (42, ?, '10.0.0.1', 22, 'root', 'x')",
+            [(f'srv{i}',) for i in range(10)]
+        )
+        conn.commit()
+
+
+def measure(open_conn, sql, args, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        with open_conn() as conn:
+            conn.execute(sql, args).fetchall()
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    db = bot.db
+    seed(db)
+    print(f"{'query':<24}{'per-query (us)':>16}{'persistent (us)':>18}{'speedup':>10}")
+    for name, (sql, args) in QUERIES.items():
+        old = measure(lambda: connect_per_query(db.db_name), sql, args, rounds)
+        new = measure(db.get_connection, sql, args, rounds)
+        print(f"{name:<24}{old:>16.1f}{new:>18.1f}{old / new:>9.1f}x")
+    bot.adb.shutdown()
+    db.close_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""حافظه و سرعت دسترسی رکوردهای __slots__ در مقابل sqlite3.Row و dict.
+
+اجرا از ریشه مخزن:  python bench/bench_records.py [تعداد]
+مقادیر ستون‌ها (رشته‌ها) بین همه حالت‌ها مشترک‌اند، پس اعداد فقط هزینه ظرف هر رکورد را نشان می‌دهند.
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp(prefix='sonar-bench-'))
+
+import bot  # noqa: E402
+from bot import ProbeResult, ServerRecord, UserRecord  # noqa: E402
+
+PROBE = {
+    'status': 'Online', 'error': None, 'cpu': 12.5, 'ram': 40.1, 'disk': 55, 'uptime_str': '1 d, 2 h, 3 m',
+    'uptime_sec': 93784.5, 'traffic_gb': 1.5, 'ssh_sessions': [], 'rtt': 12.0,
+    'net_rx_bps': 1000.0, 'net_tx_bps': 2000.0, 'disk_read_bps': 10.0, 'disk_write_bps': 20.0,
+}
+
+
+def fetch_rows(n):
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.execute('''CREATE TABLE servers (id INTEGER PRIMARY KEY, owner_id INTEGER, group_id INTEGER, name TEXT,
+        ip TEXT, port INTEGER, username TEXT, password TEXT, expiry_date TEXT, last_status TEXT, is_active INTEGER)''')
+    conn.execute('''CREATE TABLE users (user_id INTEGER PRIMARY KEY, full_name TEXT, added_date TEXT, expiry_date TEXT,
+        server_limit INTEGER, is_banned INTEGER, plan_type INTEGER, wallet_balance INTEGER, referral_count INTEGER,
+        invited_by INTEGER)''')
+    conn.executemany('INSERT INTO servers VALUES (?,?,?,?,?,?,?,?,?,?,?)', [
+        (i, i % 500, None, f'srv{i}', f'10.0.{i // 256}.{i % 256}', 22, 'root', 'gAAAA' + 'x' * 95, None, 'Online', 1)
+        for i in range(n)
+    ])
+    conn.executemany('INSERT INTO users VALUES (?,?,?,?,?,?,?,?,?,?)', [
+        (i, f'user{i}', '2024-01-01 00:00:00', '2030-01-01 00:00:00', 2, 0, 0, 0, 0, 0) for i in range(n)
+    ])
+    return conn.execute('SELECT * FROM servers').fetchall(), conn.execute('SELECT * FROM users').fetchall()
+
+
+def row_bytes(rows):
+    """sqlite3.Row: خود شیء + تاپل داده‌ای که نگه می‌دارد"""
+    return sys.getsizeof(rows[0]) + sys.getsizeof(tuple(rows[0]))
+
+
+def parsed_user(row):
+    """جایگزین UserRecord در کش کاربران: Row + تاریخ پارس‌شده + پرچم پلن"""
+    return (row, datetime.strptime(row['expiry_date'], '%Y-%m-%d %H:%M:%S'), row['plan_type'] == 1)
+
+
+def bytes_per_item(build, n):
+    tracemalloc.start()
+    items = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del items
+    return size / n
+
+
+def ns_per_access(obj, key, rounds=500_000):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        obj[key]
+    return (time.perf_counter() - start) / rounds * 1e9
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    servers, users = fetch_rows(n)
+
+    print(f"{n} records, container bytes per record (shared column values excluded)")
+    print(f"{'':<14}{'sqlite3.Row':>14}{'dict':>10}{'__slots__':>12}")
+    print(f"{'server':<14}{row_bytes(servers):>14.0f}"
+          f"{bytes_per_item(lambda: [dict(r) for r in servers], n):>10.0f}"
+          f"{bytes_per_item(lambda: [ServerRecord.from_row(r) for r in servers], n):>12.0f}")
+    print(f"{'user':<14}{row_bytes(users):>14.0f}"
+          f"{bytes_per_item(lambda: [dict(r) for r in users], n):>10.0f}"
+          f"{bytes_per_item(lambda: [UserRecord.from_row(r) for r in users], n):>12.0f}")
+    print(f"{'user+expiry':<14}{row_bytes(users) + bytes_per_item(lambda: [parsed_user(r) for r in users], n):>14.0f}"
+          f"{'-':>10}{bytes_per_item(lambda: [UserRecord.from_row(r) for r in users], n):>12.0f}")
+    print(f"{'probe result':<14}{'-':>14}"
+          f"{bytes_per_item(lambda: [dict(PROBE) for _ in range(n)], n):>10.0f}"
+          f"{bytes_per_item(lambda: [ProbeResult(**PROBE) for _ in range(n)], n):>12.0f}")
+
+    print("\nitem access rec['name'] (ns)")
+    print(f"{'':<14}{'sqlite3.Row':>14}{'dict':>10}{'__slots__':>12}")
+    print(f"{'server':<14}{ns_per_access(servers[0], 'name'):>14.0f}{ns_per_access(dict(servers[0]), 'name'):>10.0f}"
+          f"{ns_per_access(ServerRecord.from_row(servers[0]), 'name'):>12.0f}")
+    bot.adb.shutdown()
+
+
+if __name__ == '__main__':
+    main()
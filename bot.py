@@ -8,10 +8,16 @@ import warnings
 import threading
 import statistics
 import io
+import queue
+import math
 import html
 import re
+import hashlib
+import zlib
+import itertools
 import datetime as dt
 from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from contextlib import contextmanager
 
 # --- Standard Time & Date Libraries ---
@@ -31,7 +37,7 @@ from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 # --- Telegram Libraries ---
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
-from telegram.error import BadRequest, TelegramError, Conflict, NetworkError
+from telegram.error import BadRequest, TelegramError, Conflict, NetworkError, RetryAfter
 from telegram.ext import (
     ApplicationBuilder, ContextTypes, CommandHandler, CallbackQueryHandler,
     MessageHandler, filters, ConversationHandler, JobQueue
@@ -62,7 +68,73 @@ except Exception as e:
 
 DEFAULT_INTERVAL = 40
 DOWN_RETRY_LIMIT = 3
+SSH_CONNECT_TIMEOUT = 10
+SSH_KEEPALIVE_INTERVAL = 30
+# --- SSH Executors (پروب‌های کوتاه / عملیات طولانی) ---
+SSH_PROBE_WORKERS = 32
+SSH_PROBE_PER_HOST = 2
+SSH_TASK_WORKERS = 8
+SSH_TASK_PER_HOST = 2
+MONITOR_CONCURRENCY = 20
+MONITOR_WHEEL_TICK = 5
+MONITOR_TICK_BUDGET = 4
+# --- پایش تطبیقی: سرورهای پایدار تا ADAPTIVE_MAX_FACTOR برابر دیرتر پروب می‌شوند ---
+ADAPTIVE_MAX_FACTOR = 8
+ADAPTIVE_STABLE_ROUNDS = 3
+ADAPTIVE_THRESHOLD_MARGIN = 15
+# اتصال SSH بیکار در Pool باید از طولانی‌ترین بازه پایش (DEFAULT_INTERVAL × ADAPTIVE_MAX_FACTOR) بیشتر زنده بماند،
+# وگرنه هر پروب سرور پایدار Handshake کامل می‌خواهد؛ ۱۲۰ ثانیه حاشیه برای تاخیر تیک و دوره job نگهداری
+SSH_POOL_IDLE_TIMEOUT = max(300, DEFAULT_INTERVAL * ADAPTIVE_MAX_FACTOR + 120)
+# --- Circuit Breaker هاست‌های غیرقابل دسترس ---
+BREAKER_BASE_BACKOFF = 60
+BREAKER_MAX_BACKOFF = 1800
+TCP_PROBE_TIMEOUT = 3
+PREFLIGHT_MIN_TIMEOUT = 0.5
+PREFLIGHT_RTT_FACTOR = 5
+# --- تایم‌اوت‌های تطبیقی هر سرور: p99 تاریخچه × ضریب، محدود به بازه ---
+LATENCY_WINDOW = 100
+LATENCY_MIN_SAMPLES = 5
+SSH_COMMAND_TIMEOUT = 5
+CONNECT_RTT_FACTOR = 20
+COMMAND_DURATION_FACTOR = 3
+SSH_CONNECT_TIMEOUT_RANGE = (2, 20)
+SSH_COMMAND_TIMEOUT_RANGE = (2, 30)
+# --- Snapshot آخرین پروب (stale-while-revalidate) و کش کاربران ---
+# حداقل عمر؛ عمر واقعی هر سرور max(این مقدار، بازه پایش فعلی آن) است
+SNAPSHOT_MAX_AGE = 60
+USER_CACHE_TTL = 60
+# --- Single-Flight: عمر کش نتیجه هر عملیات (ثانیه) ---
+SINGLE_FLIGHT_TTL = {'full_stats': 5, 'check_host': 30, 'datacenter': 3600}
+# نتیجه ناموفق (Timeout، 429، سرور آفلاین) فقط چند ثانیه کش می‌شود
+SINGLE_FLIGHT_FAILURE_TTL = 3
+# --- ارسال گروهی اعلان‌ها: همزمانی و سقف نرخ سراسری (پیام در ثانیه، زیر محدودیت ~۳۰ تلگرام) ---
+NOTIFY_CONCURRENCY = 8
+NOTIFY_RATE = 25
+# --- مقادیر پیش‌فرض تنظیمات کاربر (وقتی در جدول settings ردیفی نیست) ---
+SETTING_DEFAULTS = {
+    'report_interval': '0', 'cpu_threshold': '80', 'ram_threshold': '80', 'disk_threshold': '90',
+    'down_alert_enabled': '1', 'auto_update_hours': '0', 'last_auto_update_run': '0',
+    'auto_reboot_config': 'OFF', 'last_reboot_date': '2000-01-01'
+}
+# --- آمار سری زمانی: نگهداری داده خام، حذف دسته‌ای و تعداد نقاط نمودار ---
+STATS_RETENTION_DAYS = 1
+STATS_PRUNE_BATCH = 5000
+STATS_MAX_POINTS = 200
+# Rollup آمار: (طول سطل به ثانیه، نگهداری به روز) برای هر سطح
+STATS_ROLLUP_TIERS = {'5m': (300, 8), '1h': (3600, 400)}
+STATS_ROLLUP_LAG = 60
+# بازه‌های نمودار: (ثانیه، منبع داده)
+CHART_RANGES = {'24h': (86400, 'raw'), '7d': (7 * 86400, '5m'), '30d': (30 * 86400, '1h')}
+# --- دیتابیس ---
 DB_NAME = 'sonar_ultra_pro.db'
+# دیتابیس جداگانه سری‌های زمانی (آمار، Rollupها، تاریخچه تاخیر) با WAL و نگهداری مستقل
+STATS_DB_NAME = 'sonar_stats.db'
+STATS_TABLES = ['server_stats', 'server_stats_5m', 'server_stats_1h', 'rollup_state', 'latency_history']
+# بکاپ دیتابیس آمار (ثانیه)؛ 0 = غیرفعال
+STATS_BACKUP_INTERVAL = 86400
+DB_STATEMENT_CACHE = 256
+DB_READERS = 4
+DB_WRITE_BATCH = 100
 KEY_FILE = 'secret.key'
 # --- Subscription Configuration (تنظیمات اشتراک و پرداخت) ---
 SUBSCRIPTION_PLANS = {
@@ -109,6 +181,10 @@ UPTIME_MILESTONE_TRACKER = set()
 CPU_ALERT_TRACKER = {}
 DAILY_REPORT_USAGE = {}
 SSH_SESSION_CACHE = {}
+COUNTER_SAMPLES = {}
+LAST_PROBE_RESULTS = {}
+DETAIL_LIVE_EDITS = set()
+LATENCY_HISTORY = {}
 
 # --- Conversation States ---
 (
@@ -176,22 +252,273 @@ class Security:
             return "" 
 
 
+class DeferrableConnection(sqlite3.Connection):
+    """اتصالی که ترد نویسنده می‌تواند commit متدها را تا پایان یک دسته نوشتن به تعویق بیندازد"""
+    defer_commit = False
+
+    def commit(self):
+        if not self.defer_commit: super().commit()
+
+
+class UserSettings:
+    """تنظیمات تایپ‌شده یک کاربر با پیش‌فرض‌های SETTING_DEFAULTS"""
+    __slots__ = ('report_interval', 'cpu', 'ram', 'disk', 'down_alert', 'auto_update_hours',
+                 'last_auto_update_run', 'auto_reboot_config', 'last_reboot_date')
+
+    def __init__(self, raw):
+        def value(key):
+            return raw.get(key) or SETTING_DEFAULTS[key]
+
+        def number(key):
+            try: return int(float(value(key)))
+            except (TypeError, ValueError): return int(SETTING_DEFAULTS[key])
+
+        self.report_interval = number('report_interval')
+        self.cpu = number('cpu_threshold')
+        self.ram = number('ram_threshold')
+        self.disk = number('disk_threshold')
+        self.down_alert = value('down_alert_enabled') == '1'
+        self.auto_update_hours = number('auto_update_hours')
+        self.last_auto_update_run = number('last_auto_update_run')
+        self.auto_reboot_config = value('auto_reboot_config')
+        self.last_reboot_date = value('last_reboot_date')
+
+
+class Record:
+    """پایه رکوردهای فشرده __slots__؛ دسترسی rec['x'] و rec.get('x') مثل sqlite3.Row/dict کار می‌کند.
+    فیلدی که مقدار نگرفته مثل کلید ناموجود دیکشنری رفتار می‌کند"""
+    __slots__ = ()
+
+    @classmethod
+    def from_row(cls, row):
+        rec = cls.__new__(cls)
+        for field in cls.__slots__:
+            setattr(rec, field, row[field])
+        return rec
+
+    def __getitem__(self, key):
+        try: return getattr(self, key)
+        except AttributeError: raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __contains__(self, key):
+        return key in self.__slots__ and hasattr(self, key)
+
+    def keys(self):
+        return [field for field in self.__slots__ if hasattr(self, field)]
+
+
+class ServerRecord(Record):
+    """ردیف جدول servers"""
+    __slots__ = ('id', 'owner_id', 'group_id', 'name', 'ip', 'port', 'username', 'password',
+                 'expiry_date', 'last_status', 'is_active')
+
+
+class UserRecord(Record):
+    """ردیف جدول users به همراه تاریخ انقضای پارس‌شده و پرچم پلن (یکبار هنگام خواندن محاسبه می‌شوند)"""
+    COLUMNS = ('user_id', 'full_name', 'added_date', 'expiry_date', 'server_limit', 'is_banned',
+               'plan_type', 'wallet_balance', 'referral_count', 'invited_by')
+    __slots__ = COLUMNS + ('expiry_dt', 'is_premium')
+
+    @classmethod
+    def from_row(cls, row):
+        rec = cls.__new__(cls)
+        for field in cls.COLUMNS:
+            setattr(rec, field, row[field])
+        try: rec.expiry_dt = datetime.strptime(rec.expiry_date, '%Y-%m-%d %H:%M:%S')
+        except (TypeError, ValueError): rec.expiry_dt = None
+        rec.is_premium = rec.plan_type == 1 or rec.user_id == SUPER_ADMIN_ID
+        return rec
+
+
+class ProbeResult(Record):
+    """نتیجه یک پروب سرور (به جای دیکشنری با کلیدهای رشته‌ای برای هر سرور در هر تیک)"""
+    __slots__ = ('status', 'error', 'cpu', 'ram', 'disk', 'uptime_str', 'uptime_sec', 'traffic_gb',
+                 'ssh_sessions', 'rtt', 'net_rx_bps', 'net_tx_bps', 'disk_read_bps', 'disk_write_bps')
+
+    def __init__(self, **fields):
+        for field, value in fields.items():
+            setattr(self, field, value)
+
+    @classmethod
+    def offline(cls, error, rtt=None):
+        return cls(status='Offline', error=error, uptime_sec=0, traffic_gb=0, ssh_sessions=[], rtt=rtt)
+
+    def copy(self):
+        return ProbeResult(**{field: getattr(self, field) for field in self.keys()})
+
+
+class ServerRegistry:
+    """کش کامل سرورها در حافظه: یکبار با یک کوئری ساخته و با هر تغییر دیتابیس همگام می‌شود"""
+    def __init__(self):
+        self.by_id = {}
+        self.by_owner = {}
+        self.loaded = False
+        self.lock = threading.RLock()
+
+    def load(self, rows):
+        with self.lock:
+            self.by_id, self.by_owner = {}, {}
+            for row in rows: self._put(ServerRecord.from_row(row))
+            self.loaded = True
+
+    def clear(self):
+        with self.lock:
+            self.by_id, self.by_owner = {}, {}
+            self.loaded = False
+
+    def _put(self, rec):
+        self.by_id[rec.id] = rec
+        self.by_owner.setdefault(rec.owner_id, {})[rec.id] = rec
+
+    def put(self, row):
+        with self.lock:
+            if self.loaded: self._put(ServerRecord.from_row(row))
+
+    def get(self, s_id):
+        try: return self.by_id.get(int(s_id))
+        except (TypeError, ValueError): return None
+
+    def owner_servers(self, owner_id):
+        with self.lock:
+            return list(self.by_owner.get(owner_id, {}).values())
+
+    def owners(self):
+        """{owner_id: [سرورها]} برای حلقه مانیتور"""
+        with self.lock:
+            return {uid: list(items.values()) for uid, items in self.by_owner.items() if items}
+
+    def all(self):
+        with self.lock:
+            return list(self.by_id.values())
+
+    def update(self, s_id, **fields):
+        rec = self.get(s_id)
+        if rec is None: return
+        for field, value in fields.items():
+            setattr(rec, field, value)
+
+    def remove(self, s_id, owner_id=None):
+        with self.lock:
+            rec = self.get(s_id)
+            if rec is None or (owner_id is not None and rec.owner_id != owner_id): return
+            self.by_id.pop(rec.id, None)
+            self.by_owner.get(rec.owner_id, {}).pop(rec.id, None)
+
+    def remove_owner(self, owner_id):
+        with self.lock:
+            for sid in self.by_owner.pop(owner_id, {}):
+                self.by_id.pop(sid, None)
+
+    def ungroup(self, owner_id, group_id):
+        with self.lock:
+            for rec in self.by_owner.get(owner_id, {}).values():
+                if rec.group_id == group_id: rec.group_id = None
+
+
 class Database:
     def __init__(self):
         self.db_name = DB_NAME
+        self.stats_db_name = STATS_DB_NAME
+        # اتصال‌های ماندگار: یکی برای هر ترد و هر فایل (به جای connect/close در هر متد)
+        self.local = threading.local()
+        self.registry = []
+        self.registry_lock = threading.Lock()
+        self.generation = 0
+        # کش write-through تنظیمات: owner_id -> {key: value} و نسخه تایپ‌شده آن
+        self.settings_cache = {}
+        self.settings_typed = {}
+        self.settings_complete = False
+        self.settings_lock = threading.Lock()
+        self.servers = ServerRegistry()
+        # کش کاربران: user_id -> (UserRecord یا None, زمان انقضا)
+        self.user_cache = {}
         self.init_db()
 
+    def _thread_connection(self, path):
+        local = self.local
+        if getattr(local, 'generation', None) != self.generation:
+            local.conns, local.depth, local.generation = {}, {}, self.generation
+        conn = local.conns.get(path)
+        if conn is None:
+            conn = sqlite3.connect(path, check_same_thread=False, cached_statements=DB_STATEMENT_CACHE, factory=DeferrableConnection)
+            conn.row_factory = sqlite3.Row
+            # PRAGMAها فقط یکبار هنگام باز شدن اتصال
+            conn.execute('PRAGMA journal_mode=WAL;')
+            local.conns[path] = conn
+            with self.registry_lock:
+                self.registry.append(conn)
+        return conn
+
     @contextmanager
-    def get_connection(self):
-        conn = sqlite3.connect(self.db_name, check_same_thread=False)
-        conn.row_factory = sqlite3.Row
+    def _use(self, path, label):
+        conn = self._thread_connection(path)
+        depth = self.local.depth
+        depth[path] = depth.get(path, 0) + 1
         try:
-            conn.execute('PRAGMA journal_mode=WAL;')
             yield conn
         except sqlite3.Error as e:
-            logger.error(f"Database Error: {e}")
+            # در دسته نوشتن، خطا به ترد نویسنده می‌رسد تا دسته را rollback کند
+            if conn.defer_commit: raise
+            logger.error(f"{label} Error: {e}")
+        finally:
+            depth[path] -= 1
+            # مثل قبل: تغییرات commit نشده با پایان کار از بین می‌روند، ولی اتصال باز می‌ماند
+            if depth[path] == 0 and conn.in_transaction and not conn.defer_commit:
+                try: conn.rollback()
+                except sqlite3.Error: pass
+
+    def get_connection(self):
+        return self._use(self.db_name, "Database")
+
+    @contextmanager
+    def get_stats_connection(self, attach_main=False):
+        """اتصال به فایل آمار؛ attach_main برای کوئری‌هایی که به جداول اصلی (servers) نیاز دارند"""
+        with self._use(self.stats_db_name, "Stats Database") as conn:
+            if not attach_main:
+                yield conn
+                return
+            conn.execute("ATTACH DATABASE ? AS main_db", (self.db_name,))
+            try:
+                yield conn
+            finally:
+                if conn.in_transaction: conn.rollback()
+                conn.execute("DETACH DATABASE main_db")
+
+    def close_all(self):
+        """بستن همه اتصال‌های ماندگار؛ فقط هنگام خاموشی و بعد از توقف همه تردهایی که از دیتابیس استفاده می‌کنند"""
+        with self.registry_lock:
+            conns, self.registry = self.registry, []
+            self.generation += 1
+        for conn in conns:
+            try: conn.close()
+            except: pass
+        self.reset_caches()
+
+    def reset_caches(self):
+        """خالی کردن کش‌های حافظه (تنظیمات، سرورها، کاربران) تا از دیتابیس دوباره خوانده شوند"""
+        self.clear_settings_cache()
+        self.servers.clear()
+        self.user_cache = {}
+
+    def restore_from(self, path):
+        """جایگزینی محتوای دیتابیس اصلی با فایل بکاپ از طریق backup API خود SQLite.
+        فایل عوض نمی‌شود، پس اتصال‌های باز تردهای دیگر (و WAL آن‌ها) معتبر می‌مانند؛ خطا به فراخواننده می‌رسد"""
+        src = sqlite3.connect(path)
+        try:
+            src.execute('PRAGMA schema_version').fetchone()  # فایل غیر SQLite همین‌جا خطا می‌دهد
+            src.backup(self._thread_connection(self.db_name))
         finally:
-            conn.close()
+            src.close()
+        self.init_db()
+        self.reset_caches()
+
+    def checkpoint(self, stats=False):
+        """انتقال کامل WAL به فایل دیتابیس قبل از ارسال بکاپ"""
+        with (self.get_stats_connection() if stats else self.get_connection()) as conn:
+            conn.execute("PRAGMA wal_checkpoint(FULL);")
 
     def init_db(self):
         with self.get_connection() as conn:
@@ -215,17 +542,68 @@ class Database:
                 id INTEGER PRIMARY KEY AUTOINCREMENT, owner_id INTEGER, chat_id TEXT, name TEXT, 
                 usage_type TEXT DEFAULT "all"
             )''')
-            cursor.execute('''CREATE TABLE IF NOT EXISTS server_stats (
-                id INTEGER PRIMARY KEY AUTOINCREMENT, server_id INTEGER, cpu REAL, ram REAL, 
+            conn.commit()
+            self.migrate()
+        self.init_stats_db()
+        self.move_stats_tables()
+
+    def init_stats_db(self):
+        with self.get_stats_connection() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS server_stats (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, server_id INTEGER, cpu REAL, ram REAL, rtt REAL,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_server_stats_sid_time ON server_stats(server_id, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_server_stats_time ON server_stats(created_at)")
+            for tier in STATS_ROLLUP_TIERS:
+                conn.execute(f'''CREATE TABLE IF NOT EXISTS server_stats_{tier} (
+                    server_id INTEGER, bucket INTEGER,
+                    cpu_min REAL, cpu_avg REAL, cpu_max REAL,
+                    ram_min REAL, ram_avg REAL, ram_max REAL,
+                    rtt_avg REAL, samples INTEGER,
+                    PRIMARY KEY(server_id, bucket)
+                ) WITHOUT ROWID''')
+                conn.execute(f"CREATE INDEX IF NOT EXISTS idx_server_stats_{tier}_bucket ON server_stats_{tier}(bucket)")
+            conn.execute('''CREATE TABLE IF NOT EXISTS rollup_state (
+                tier TEXT PRIMARY KEY,
+                watermark INTEGER   -- سطل‌های قبل از این زمان (unix) کامل تجمیع شده‌اند
+            )''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS latency_history (
+                ip TEXT,
+                port INTEGER,
+                rtt TEXT,         -- JSON list (seconds)
+                duration TEXT,    -- JSON list (seconds)
+                updated_at TEXT,
+                PRIMARY KEY(ip, port)
+            )''')
             conn.commit()
-            self.migrate()
+
+    def move_stats_tables(self):
+        """انتقال یکباره جداول آماری از دیتابیس اصلی (نسخه‌های قبلی یا بکاپ بازنشانی شده) به فایل آمار"""
+        with self.get_connection() as conn:
+            existing = {r['name'] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            moving = [t for t in STATS_TABLES if t in existing]
+            if not moving: return
+            conn.execute("ATTACH DATABASE ? AS stats_db", (self.stats_db_name,))
+            try:
+                for table in moving:
+                    target = {r['name'] for r in conn.execute(f"PRAGMA stats_db.table_info({table})")}
+                    cols = ", ".join(r['name'] for r in conn.execute(f"PRAGMA main.table_info({table})") if r['name'] in target)
+                    conn.execute(f"INSERT OR IGNORE INTO stats_db.{table} ({cols}) SELECT {cols} FROM main.{table}")
+                    conn.execute(f"DROP TABLE main.{table}")
+                conn.commit()
+            finally:
+                if conn.in_transaction: conn.rollback()
+                conn.execute("DETACH DATABASE stats_db")
+            # فضای آزاد شده برگردانده می‌شود تا بکاپ ساعتی واقعاً کوچک شود
+            conn.execute("VACUUM")
+        logger.info(f"📦 Moved {', '.join(moving)} to {self.stats_db_name}")
 
     def migrate(self):
         with self.get_connection() as conn:
             try: conn.execute("ALTER TABLE servers ADD COLUMN expiry_date TEXT")
             except: pass
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_servers_expiry ON servers(expiry_date)")
             try: conn.execute("ALTER TABLE channels ADD COLUMN usage_type TEXT DEFAULT 'all'")
             except: pass
             try: conn.execute("ALTER TABLE users ADD COLUMN plan_type INTEGER DEFAULT 0")
@@ -275,6 +653,10 @@ class Database:
             conn.commit()
             return cursor.lastrowid
 
+    def get_payment(self, payment_id):
+        with self.get_connection() as conn:
+            return conn.execute('SELECT * FROM payments WHERE id = ?', (payment_id,)).fetchone()
+
     def approve_payment(self, payment_id):
         with self.get_connection() as conn:
             # 1. گرفتن اطلاعات پرداخت
@@ -312,6 +694,7 @@ class Database:
                 ''', (plan['limit'], new_exp, p_type_code, pay['user_id']))
                 
             conn.commit()
+            self.invalidate_user(pay['user_id'])
             return pay['user_id'], plan['name']
     def apply_referral_reward(self, inviter_id):
         """اعمال جایزه: +1 سرور (موقت ۱۰ روزه) و +10 روز اعتبار"""
@@ -348,14 +731,42 @@ class Database:
             ''', (inviter_id, now_str, bonus_expiry))
             
             conn.commit()
+        self.invalidate_user(inviter_id)
             
         return True, new_limit, new_exp
 
+    def expire_bonuses(self, now_str):
+        """حذف پاداش‌های منقضی و کسر لیمیت؛ [(user_id, new_limit)] کاربرانی که لیمیتشان کم شد"""
+        reduced, committed = [], False
+        with self.get_connection() as conn:
+            expired_bonuses = conn.execute("SELECT * FROM temp_bonuses WHERE expires_at < ?", (now_str,)).fetchall()
+            
+            for bonus in expired_bonuses:
+                uid = bonus['user_id']
+                
+                # گرفتن کاربر برای کاهش لیمیت
+                user = conn.execute("SELECT server_limit FROM users WHERE user_id = ?", (uid,)).fetchone()
+                if user:
+                    new_limit = max(0, user['server_limit'] - bonus['bonus_limit']) # جلوگیری از منفی شدن
+                    conn.execute("UPDATE users SET server_limit = ? WHERE user_id = ?", (new_limit, uid))
+                    reduced.append((uid, new_limit))
+                
+                # حذف از جدول پاداش‌ها
+                conn.execute("DELETE FROM temp_bonuses WHERE id = ?", (bonus['id'],))
+            
+            conn.commit()
+            committed = True
+        if not committed: return []
+        for uid, _ in reduced: self.invalidate_user(uid)
+        return reduced
+
     def update_wallet(self, user_id, amount):
         """افزایش یا کاهش موجودی (amount می‌تواند منفی باشد)"""
         with self.get_connection() as conn:
             conn.execute('UPDATE users SET wallet_balance = wallet_balance + ? WHERE user_id = ?', (amount, user_id))
-            conn.commit()        
+            conn.commit()
+        self.invalidate_user(user_id)
+
     def toggle_user_plan(self, user_id):
         user = self.get_user(user_id)
         if not user: return 0 
@@ -364,6 +775,7 @@ class Database:
         with self.get_connection() as conn:
             conn.execute('UPDATE users SET plan_type = ?, server_limit = ? WHERE user_id = ?', (new_plan, new_limit, user_id))
             conn.commit()
+        self.invalidate_user(user_id)
         return new_plan
     
     def add_or_update_user(self, user_id, full_name=None, invited_by=0):
@@ -383,11 +795,13 @@ class Database:
                     VALUES (?, ?, ?, ?, ?, ?, 0, 0)
                 ''', (user_id, full_name, now_str, expiry, default_limit, invited_by))
             conn.commit()
-            
+        self.invalidate_user(user_id)
+
     def update_user_limit(self, user_id, limit):
         with self.get_connection() as conn:
             conn.execute('UPDATE users SET server_limit = ? WHERE user_id = ?', (limit, user_id))
             conn.commit()
+        self.invalidate_user(user_id)
 
     def toggle_ban_user(self, user_id):
         user = self.get_user(user_id)
@@ -396,20 +810,32 @@ class Database:
         with self.get_connection() as conn:
             conn.execute('UPDATE users SET is_banned = ? WHERE user_id = ?', (new_state, user_id))
             conn.commit()
+        self.invalidate_user(user_id)
         return new_state
 
     def get_user(self, user_id):
+        cached = self.user_cache.get(user_id)
+        if cached and cached[1] > time.monotonic(): return cached[0]
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-            return cursor.fetchone()
+            row = cursor.fetchone()
+        user = UserRecord.from_row(row) if row else None
+        self.user_cache[user_id] = (user, time.monotonic() + USER_CACHE_TTL)
+        return user
+
+    def invalidate_user(self, user_id):
+        self.user_cache.pop(user_id, None)
+        # داخل دسته ترد نویسنده commit هنوز انجام نشده؛ بعد از commit دوباره پاک می‌شود
+        pending = getattr(self.local, 'pending_users', None)
+        if pending is not None: pending.add(user_id)
 
     def get_all_users_paginated(self, page=1, per_page=5):
         offset = (page - 1) * per_page
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT * FROM users LIMIT ? OFFSET ?', (per_page, offset))
-            users = cursor.fetchall()
+            users = [UserRecord.from_row(row) for row in cursor.fetchall()]
             cursor.execute('SELECT COUNT(*) FROM users')
             total = cursor.fetchone()[0]
             return users, total
@@ -418,26 +844,29 @@ class Database:
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT * FROM users')
-            return cursor.fetchall()
+            return [UserRecord.from_row(row) for row in cursor.fetchall()]
 
     def remove_user(self, user_id):
+        # کش‌ها فقط بعد از commit موفق تغییر می‌کنند (get_connection خطای sqlite را فقط لاگ می‌کند)
+        committed = False
         with self.get_connection() as conn:
             for t in ['users', 'servers', 'groups', 'channels']:
                 col = 'user_id' if t == 'users' else 'owner_id'
                 conn.execute(f'DELETE FROM {t} WHERE {col} = ?', (user_id,))
             conn.commit()
+            committed = True
+        if committed: self.servers.remove_owner(user_id)
+        self.invalidate_user(user_id)
 
     def check_access(self, user_id):
         if user_id == SUPER_ADMIN_ID: return True, "Super Admin"
         user = self.get_user(user_id)
         if not user: return False, "کاربر یافت نشد"
-        if user['is_banned']: return False, "حساب شما مسدود شده است ⛔️"
-        try:
-            expiry_dt = datetime.strptime(user['expiry_date'], '%Y-%m-%d %H:%M:%S')
-            now_tehran_naive = get_tehran_datetime().replace(tzinfo=None)
-            if now_tehran_naive > expiry_dt: return False, "اشتراک شما منقضی شده است 📅"
-            return True, (expiry_dt - now_tehran_naive).days
-        except: return False, "خطا در تاریخ"
+        if user.is_banned: return False, "حساب شما مسدود شده است ⛔️"
+        if user.expiry_dt is None: return False, "خطا در تاریخ"
+        now_tehran_naive = get_tehran_datetime().replace(tzinfo=None)
+        if now_tehran_naive > user.expiry_dt: return False, "اشتراک شما منقضی شده است 📅"
+        return True, (user.expiry_dt - now_tehran_naive).days
 
     # --- Group Methods ---
     def add_group(self, owner_id, name):
@@ -452,10 +881,13 @@ class Database:
             return cursor.fetchall()
 
     def delete_group(self, group_id, owner_id):
+        committed = False
         with self.get_connection() as conn:
             conn.execute('DELETE FROM groups WHERE id = ? AND owner_id = ?', (group_id, owner_id))
             conn.execute('UPDATE servers SET group_id = NULL WHERE group_id = ? AND owner_id = ?', (group_id, owner_id)) 
             conn.commit()
+            committed = True
+        if committed: self.servers.ungroup(owner_id, int(group_id))
 
     # --- Server Methods ---
     def add_server(self, owner_id, group_id, data):
@@ -468,6 +900,7 @@ class Database:
             if current_count >= user['server_limit']:
                 raise Exception("Server Limit Reached")
         
+        row = None
         with self.get_connection() as conn:
             # --- تغییر جدید: شروع تایمر ۳۰ روزه با اولین سرور ---
             if current_count == 0 and user['plan_type'] == 0:
@@ -475,71 +908,227 @@ class Database:
                 conn.execute('UPDATE users SET expiry_date = ? WHERE user_id = ?', (new_expiry, owner_id))
             # -----------------------------------------------------
 
-            conn.execute(
+            cursor = conn.execute(
                 'INSERT INTO servers (owner_id, group_id, name, ip, port, username, password, expiry_date) VALUES (?,?,?,?,?,?,?,?)',
                 (owner_id, g_id, data['name'], data['ip'], data['port'], data['username'], data['password'], data.get('expiry_date'))
             )
+            inserted = conn.execute('SELECT * FROM servers WHERE id = ?', (cursor.lastrowid,)).fetchone()
             conn.commit()
+            row = inserted
+        if row: self.servers.put(row)
+        self.invalidate_user(owner_id)
+
+    def _server_registry(self):
+        if not self.servers.loaded:
+            with self.servers.lock:
+                if not self.servers.loaded:
+                    with self.get_connection() as conn:
+                        self.servers.load(conn.execute('SELECT * FROM servers ORDER BY id').fetchall())
+        return self.servers
+
+    def get_expiring_servers(self, dates):
+        """سرورهایی که expiry_date آن‌ها یکی از dates است، هر کدام با کانال‌های هشدار انقضا (یک ردیف برای هر کانال)"""
+        marks = ','.join('?' * len(dates))
+        with self.get_connection() as conn:
+            return conn.execute(f'''
+                SELECT s.id, s.owner_id, s.name, s.expiry_date, c.chat_id
+                FROM servers s
+                LEFT JOIN channels c ON c.owner_id = s.owner_id AND COALESCE(c.usage_type, 'all') IN ('expiry', 'all')
+                WHERE s.expiry_date IN ({marks})
+                ORDER BY s.id
+            ''', list(dates)).fetchall()
+
+    def get_all_servers(self):
+        return self._server_registry().all()
+
+    def get_servers_by_owner(self):
+        return self._server_registry().owners()
 
     def get_all_user_servers(self, owner_id):
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT * FROM servers WHERE owner_id = ?', (owner_id,))
-            return cursor.fetchall()
+        return self._server_registry().owner_servers(owner_id)
 
     def get_servers_by_group(self, owner_id, group_id):
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            sql = 'SELECT * FROM servers WHERE owner_id = ? AND group_id IS NULL' if group_id == 0 else 'SELECT * FROM servers WHERE owner_id = ? AND group_id = ?'
-            cursor.execute(sql, (owner_id,) if group_id == 0 else (owner_id, group_id))
-            return cursor.fetchall()
+        g_id = None if group_id == 0 else group_id
+        return [s for s in self.get_all_user_servers(owner_id) if s.group_id == g_id]
 
     def get_server_by_id(self, s_id):
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT * FROM servers WHERE id = ?', (s_id,))
-            return cursor.fetchone()
+        return self._server_registry().get(s_id)
 
     def delete_server(self, s_id, owner_id):
+        committed = False
         with self.get_connection() as conn:
             conn.execute('DELETE FROM servers WHERE id = ? AND owner_id = ?', (s_id, owner_id))
             conn.commit()
+            committed = True
+        if committed: self.servers.remove(s_id, owner_id)
 
     def update_status(self, s_id, status):
+        committed = False
         with self.get_connection() as conn:
             conn.execute('UPDATE servers SET last_status = ? WHERE id = ?', (status, s_id))
             conn.commit()
+            committed = True
+        if committed: self.servers.update(s_id, last_status=status)
 
     def update_server_expiry(self, s_id, new_date):
+        committed = False
         with self.get_connection() as conn:
             conn.execute('UPDATE servers SET expiry_date = ? WHERE id = ?', (new_date, s_id))
             conn.commit()
+            committed = True
+        if committed: self.servers.update(s_id, expiry_date=new_date)
     
     def toggle_server_active(self, s_id, current_state):
         new_state = 0 if current_state else 1
+        committed = False
         with self.get_connection() as conn:
             conn.execute('UPDATE servers SET is_active = ? WHERE id = ?', (new_state, s_id))
             conn.commit()
+            committed = True
+        if committed: self.servers.update(s_id, is_active=new_state)
         return new_state
 
     # --- Stats & Charts ---
-    def add_server_stat(self, server_id, cpu, ram):
-        with self.get_connection() as conn:
-            conn.execute('INSERT INTO server_stats (server_id, cpu, ram) VALUES (?, ?, ?)', (server_id, cpu, ram))
-            conn.execute("DELETE FROM server_stats WHERE created_at < datetime('now', '-1 day')")
+    def add_server_stats(self, rows):
+        """rows: [(server_id, cpu, ram, rtt, created_at)] — یک تراکنش برای کل تیک"""
+        with self.get_stats_connection() as conn:
+            conn.executemany('INSERT INTO server_stats (server_id, cpu, ram, rtt, created_at) VALUES (?, ?, ?, ?, ?)', rows)
             conn.commit()
 
-    def get_server_stats(self, server_id):
-        with self.get_connection() as conn:
+    def prune_server_stats(self, days, batch_size):
+        """حذف آمار قدیمی در دسته‌های محدود تا قفل نوشتن طولانی نشود؛ تعداد حذف شده را برمی‌گرداند"""
+        total = 0
+        with self.get_stats_connection() as conn:
+            while True:
+                cur = conn.execute(
+                    "DELETE FROM server_stats WHERE id IN (SELECT id FROM server_stats WHERE created_at < datetime('now', ?) LIMIT ?)",
+                    (f'-{days} day', batch_size)
+                )
+                conn.commit()
+                total += cur.rowcount
+                if cur.rowcount < batch_size: return total
+
+    def prune_orphan_stats(self):
+        """حذف آمار سرورهای حذف شده (دیتابیس اصلی برای این کوئری ATTACH می‌شود)"""
+        total = 0
+        with self.get_stats_connection(attach_main=True) as conn:
+            for table in ('server_stats', 'server_stats_5m', 'server_stats_1h'):
+                total += conn.execute(f"DELETE FROM {table} WHERE server_id NOT IN (SELECT id FROM main_db.servers)").rowcount
+            conn.commit()
+        return total
+
+    def rollup_server_stats(self):
+        """تجمیع افزایشی: خام ← ۵ دقیقه‌ای ← ساعتی؛ فقط سطل‌های کامل بعد از watermark هر سطح"""
+        now = int(time.time()) - STATS_ROLLUP_LAG
+        with self.get_stats_connection() as conn:
+            marks = {r['tier']: r['watermark'] for r in conn.execute('SELECT tier, watermark FROM rollup_state')}
+
+            size = STATS_ROLLUP_TIERS['5m'][0]
+            start, end = marks.get('5m', 0), now // size * size
+            if end > start:
+                conn.execute('''
+                    INSERT OR REPLACE INTO server_stats_5m
+                    SELECT server_id, CAST(strftime('%s', created_at) AS INTEGER) / :size * :size AS bucket,
+                        MIN(cpu), AVG(cpu), MAX(cpu), MIN(ram), AVG(ram), MAX(ram), AVG(rtt), COUNT(*)
+                    FROM server_stats
+                    WHERE created_at >= datetime(:start, 'unixepoch') AND created_at < datetime(:end, 'unixepoch')
+                    GROUP BY server_id, bucket
+                ''', {'size': size, 'start': start, 'end': end})
+                conn.execute('INSERT OR REPLACE INTO rollup_state (tier, watermark) VALUES (?, ?)', ('5m', end))
+
+            size = STATS_ROLLUP_TIERS['1h'][0]
+            start, end = marks.get('1h', 0), now // size * size
+            if end > start:
+                conn.execute('''
+                    INSERT OR REPLACE INTO server_stats_1h
+                    SELECT server_id, bucket / :size * :size AS b,
+                        MIN(cpu_min), SUM(cpu_avg * samples) / SUM(samples), MAX(cpu_max),
+                        MIN(ram_min), SUM(ram_avg * samples) / SUM(samples), MAX(ram_max),
+                        AVG(rtt_avg), SUM(samples)
+                    FROM server_stats_5m
+                    WHERE bucket >= :start AND bucket < :end
+                    GROUP BY server_id, b
+                ''', {'size': size, 'start': start, 'end': end})
+                conn.execute('INSERT OR REPLACE INTO rollup_state (tier, watermark) VALUES (?, ?)', ('1h', end))
+            conn.commit()
+
+    def prune_rollups(self, batch_size):
+        """حذف دسته‌ای سطل‌های قدیمی‌تر از نگهداری هر سطح"""
+        total = 0
+        with self.get_stats_connection() as conn:
+            for tier, (_, days) in STATS_ROLLUP_TIERS.items():
+                cutoff = int(time.time()) - days * 86400
+                while True:
+                    cur = conn.execute(
+                        f"DELETE FROM server_stats_{tier} WHERE (server_id, bucket) IN (SELECT server_id, bucket FROM server_stats_{tier} WHERE bucket < ? LIMIT ?)",
+                        (cutoff, batch_size)
+                    )
+                    conn.commit()
+                    total += cur.rowcount
+                    if cur.rowcount < batch_size: break
+        return total
+
+    def get_rollup_stats(self, server_id, tier, since_seconds):
+        """سری زمانی از جدول Rollup با همان کلیدهای get_server_stats (بدون p95)"""
+        step = max(STATS_ROLLUP_TIERS[tier][0], math.ceil(since_seconds / STATS_MAX_POINTS))
+        with self.get_stats_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT bucket / :step * :step AS ts,
+                    SUM(cpu_avg * samples) / SUM(samples) AS cpu, MAX(cpu_max) AS cpu_max,
+                    SUM(ram_avg * samples) / SUM(samples) AS ram, MAX(ram_max) AS ram_max,
+                    AVG(rtt_avg) AS rtt, SUM(samples) AS samples,
+                    strftime('%m/%d %H:%M', bucket / :step * :step, 'unixepoch', '+3 hours', '+30 minutes') AS time_str
+                FROM server_stats_{tier}
+                WHERE server_id = :sid AND bucket >= CAST(strftime('%s', 'now') AS INTEGER) - :since
+                GROUP BY ts
+                ORDER BY ts
+            ''', {'sid': server_id, 'step': step, 'since': int(since_seconds)})
+            return cursor.fetchall()
+
+    def get_server_stats(self, server_id, since_seconds=86400, bucket_seconds=None):
+        """سری زمانی خلاصه شده در SQL: هر سطل میانگین/حداکثر/p95؛ حداکثر STATS_MAX_POINTS نقطه"""
+        bucket = max(1, int(bucket_seconds or math.ceil(since_seconds / STATS_MAX_POINTS)))
+        with self.get_stats_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                SELECT cpu, ram, strftime('%H:%M', created_at, '+3 hours', '+30 minutes') as time_str 
-                FROM server_stats 
-                WHERE server_id = ? 
-                ORDER BY created_at ASC
-            ''', (server_id,))
+                WITH raw AS (
+                    SELECT cpu, ram, rtt, CAST(strftime('%s', created_at) AS INTEGER) / :bucket AS b
+                    FROM server_stats
+                    WHERE server_id = :sid AND created_at >= datetime('now', :since)
+                ),
+                ranked AS (
+                    SELECT b, cpu, ram, rtt,
+                        CUME_DIST() OVER (PARTITION BY b ORDER BY cpu) AS cpu_rank,
+                        CUME_DIST() OVER (PARTITION BY b ORDER BY ram) AS ram_rank
+                    FROM raw
+                )
+                SELECT b * :bucket AS ts,
+                    AVG(cpu) AS cpu, MAX(cpu) AS cpu_max, MIN(CASE WHEN cpu_rank >= 0.95 THEN cpu END) AS cpu_p95,
+                    AVG(ram) AS ram, MAX(ram) AS ram_max, MIN(CASE WHEN ram_rank >= 0.95 THEN ram END) AS ram_p95,
+                    AVG(rtt) AS rtt, COUNT(*) AS samples,
+                    strftime('%H:%M', b * :bucket, 'unixepoch', '+3 hours', '+30 minutes') AS time_str
+                FROM ranked
+                GROUP BY b
+                ORDER BY b
+            ''', {'sid': server_id, 'since': f'-{int(since_seconds)} seconds', 'bucket': bucket})
             return cursor.fetchall()
 
+    # --- Latency History ---
+    def get_latency_history(self):
+        with self.get_stats_connection() as conn:
+            return conn.execute('SELECT ip, port, rtt, duration FROM latency_history').fetchall()
+
+    def save_latency_history(self, rows):
+        """rows: [(ip, port, rtt_json, duration_json)]"""
+        now = get_tehran_datetime().strftime('%Y-%m-%d %H:%M:%S')
+        with self.get_stats_connection() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO latency_history (ip, port, rtt, duration, updated_at) VALUES (?, ?, ?, ?, ?)',
+                [row + (now,) for row in rows]
+            )
+            conn.commit()
+
     # --- Channel & Settings Methods ---
     def add_channel(self, owner_id, chat_id, name, usage_type='all'):
         with self.get_connection() as conn:
@@ -558,16 +1147,62 @@ class Database:
             conn.commit()
 
     def set_setting(self, owner_id, key, value):
+        with self.settings_lock:
+            committed = False
+            with self.get_connection() as conn:
+                conn.execute('REPLACE INTO settings (owner_id, key, value) VALUES (?, ?, ?)', (owner_id, key, str(value)))
+                conn.commit()
+                committed = True
+            # کش فقط بعد از commit موفق (مالک بدون ورودی کش هم ساخته می‌شود)؛ در غیر این صورت دوباره از دیتابیس خوانده می‌شود
+            if committed:
+                self._owner_entry(owner_id)[key] = str(value)
+            elif owner_id in self.settings_cache:
+                self.settings_cache[owner_id] = self._read_owner_settings(owner_id)
+            self.settings_typed.pop(owner_id, None)
+
+    def load_all_settings(self):
+        """بارگذاری کل جدول settings با یک کوئری؛ بعد از آن کاربر بدون ردیف یعنی همه پیش‌فرض"""
+        cache = {}
         with self.get_connection() as conn:
-            conn.execute('REPLACE INTO settings (owner_id, key, value) VALUES (?, ?, ?)', (owner_id, key, str(value)))
-            conn.commit()
+            for row in conn.execute('SELECT owner_id, key, value FROM settings'):
+                cache.setdefault(row['owner_id'], {})[row['key']] = row['value']
+        with self.settings_lock:
+            self.settings_cache = cache
+            self.settings_typed = {}
+            self.settings_complete = True
+
+    def clear_settings_cache(self):
+        with self.settings_lock:
+            self.settings_cache, self.settings_typed = {}, {}
+            self.settings_complete = False
+
+    def _owner_settings(self, owner_id):
+        cached = self.settings_cache.get(owner_id)
+        if cached is not None: return cached
+        with self.settings_lock:
+            return self._owner_entry(owner_id)
+
+    def _owner_entry(self, owner_id):
+        """ورودی کش مالک (در صورت نبود ساخته می‌شود)؛ فقط با settings_lock گرفته‌شده صدا زده شود"""
+        cached = self.settings_cache.get(owner_id)
+        if cached is None:
+            cached = {} if self.settings_complete else self._read_owner_settings(owner_id)
+            self.settings_cache[owner_id] = cached
+        return cached
+
+    def _read_owner_settings(self, owner_id):
+        with self.get_connection() as conn:
+            return {row['key']: row['value'] for row in conn.execute('SELECT key, value FROM settings WHERE owner_id = ?', (owner_id,))}
 
     def get_setting(self, owner_id, key):
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT value FROM settings WHERE owner_id = ? AND key = ?', (owner_id, key,))
-            res = cursor.fetchone()
-            return res['value'] if res else None
+        return self._owner_settings(owner_id).get(key)
+
+    def get_settings(self, owner_id):
+        typed = self.settings_typed.get(owner_id)
+        if typed is None:
+            typed = UserSettings(self._owner_settings(owner_id))
+            self.settings_typed[owner_id] = typed
+        return typed
     # --- Payment Settings Management ---
     def add_payment_method(self, p_type, network, address, holder):
         with self.get_connection() as conn:
@@ -592,8 +1227,617 @@ class Database:
             conn.commit()
     # --- پایان whitelist_bot_ip ---
 # Initializing Global Objects
+class AsyncDatabase:
+    """نمای async دیتابیس: خواندن‌ها روی Pool کوچک تردها و همه نوشتن‌ها از یک ترد نویسنده با صف؛
+    نوشتن‌های پشت سر هم در یک تراکنش commit می‌شوند تا event loop و قفل WAL درگیر نشوند"""
+    def __init__(self, database, readers, batch_size):
+        self.db = database
+        self.batch_size = batch_size
+        self.readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='db-read')
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self._writer_loop, name='db-writer', daemon=True)
+        self.writer.start()
+
+    async def read(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.readers, func, *args)
+
+    async def write(self, func, *args, exclusive=False):
+        """exclusive: بیرون از دسته اجرا شود (متدهایی که خودشان commit مرحله‌ای دارند)"""
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self.queue.put((func, args, exclusive, loop, fut))
+        return await fut
+
+    @staticmethod
+    def _resolve(fut, ok, value):
+        if fut.done(): return
+        if ok: fut.set_result(value)
+        else: fut.set_exception(value)
+
+    def _deliver(self, item, ok, value):
+        item[3].call_soon_threadsafe(self._resolve, item[4], ok, value)
+
+    def _run_one(self, item):
+        try: self._deliver(item, True, item[0](*item[1]))
+        except Exception as e: self._deliver(item, False, e)
+
+    def _run_batch(self, batch):
+        if len(batch) == 1:
+            self._run_one(batch[0])
+            return
+        conns = [self.db._thread_connection(path) for path in (self.db.db_name, self.db.stats_db_name)]
+        results = []
+        self.db.local.pending_users = set()
+        try:
+            for c in conns: c.defer_commit = True
+            for func, args, *_ in batch:
+                results.append(func(*args))
+        except Exception as e:
+            for c in conns:
+                c.defer_commit = False
+                if c.in_transaction:
+                    try: c.rollback()
+                    except sqlite3.Error: pass
+            # یک نوشتن خراب نباید بقیه دسته را از بین ببرد
+            logger.warning(f"DB write batch of {len(batch)} failed ({e}), retrying one by one")
+            for item in batch: self._run_one(item)
+            return
+        finally:
+            for c in conns: c.defer_commit = False
+            pending, self.db.local.pending_users = self.db.local.pending_users, None
+
+        try:
+            for c in conns: c.commit()
+        except Exception as e:
+            # کش‌های write-through جلوتر از دیتابیس رفته‌اند؛ از نو از دیتابیس خوانده شوند
+            self.db.reset_caches()
+            for item in batch: self._deliver(item, False, e)
+            return
+        finally:
+            for uid in pending: self.db.invalidate_user(uid)
+        for item, res in zip(batch, results): self._deliver(item, True, res)
+
+    def _writer_loop(self):
+        pending = []
+        while True:
+            item = pending.pop() if pending else self.queue.get()
+            if item is None: return
+            if item[2]:
+                self._run_one(item)
+                continue
+
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try: nxt = self.queue.get_nowait()
+                except queue.Empty: break
+                # توقف یا نوشتن exclusive بعد از همین دسته اجرا می‌شود
+                if nxt is None or nxt[2]:
+                    pending.append(nxt)
+                    break
+                batch.append(nxt)
+            self._run_batch(batch)
+
+    def shutdown(self):
+        self.queue.put(None)
+        self.writer.join(timeout=10)
+        self.readers.shutdown(wait=True)
+
 db = Database()
 sec = Security()
+adb = AsyncDatabase(db, DB_READERS, DB_WRITE_BATCH)
+
+
+# ==============================================================================
+# 📏 LATENCY TRACKER
+# ==============================================================================
+class LatencyTracker:
+    """تاریخچه چرخشی RTT اتصال TCP و مدت اجرای پروب هر هاست؛ تایم‌اوت‌ها = p99 × ضریب (محدود به بازه)"""
+    KINDS = ('rtt', 'duration')
+
+    def __init__(self, hosts, window, min_samples):
+        self.hosts = hosts
+        self.window = window
+        self.min_samples = min_samples
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+    def _get(self, key):
+        return self.hosts.setdefault(key, {kind: deque(maxlen=self.window) for kind in self.KINDS})
+
+    def record(self, ip, port, kind, seconds):
+        key = (ip, int(port))
+        with self.lock:
+            self._get(key)[kind].append(round(seconds, 4))
+            self.dirty.add(key)
+
+    def p99(self, ip, port, kind):
+        with self.lock:
+            entry = self.hosts.get((ip, int(port)))
+            samples = sorted(entry[kind]) if entry else []
+        if len(samples) < self.min_samples: return None
+        return samples[min(len(samples) - 1, math.ceil(len(samples) * 0.99) - 1)]
+
+    def timeout(self, ip, port, kind, factor, bounds, default):
+        p = self.p99(ip, port, kind)
+        if p is None: return default
+        return min(bounds[1], max(bounds[0], p * factor))
+
+    def preflight_timeout(self, ip, port):
+        return self.timeout(ip, port, 'rtt', PREFLIGHT_RTT_FACTOR, (PREFLIGHT_MIN_TIMEOUT, TCP_PROBE_TIMEOUT), TCP_PROBE_TIMEOUT)
+
+    def connect_timeout(self, ip, port):
+        # Handshake + KEX + Auth چند رفت‌وبرگشت شبکه است
+        return self.timeout(ip, port, 'rtt', CONNECT_RTT_FACTOR, SSH_CONNECT_TIMEOUT_RANGE, SSH_CONNECT_TIMEOUT)
+
+    def command_timeout(self, ip, port):
+        return self.timeout(ip, port, 'duration', COMMAND_DURATION_FACTOR, SSH_COMMAND_TIMEOUT_RANGE, SSH_COMMAND_TIMEOUT)
+
+    def load(self, rows):
+        with self.lock:
+            for row in rows:
+                try:
+                    entry = self._get((row['ip'], int(row['port'])))
+                    entry['rtt'].extend(json.loads(row['rtt'] or '[]'))
+                    entry['duration'].extend(json.loads(row['duration'] or '[]'))
+                except: pass
+
+    def pop_dirty(self):
+        """ردیف‌های تغییر کرده برای ذخیره در latency_history"""
+        with self.lock:
+            rows = [
+                (ip, port, json.dumps(list(self.hosts[(ip, port)]['rtt'])), json.dumps(list(self.hosts[(ip, port)]['duration'])))
+                for ip, port in self.dirty if (ip, port) in self.hosts
+            ]
+            self.dirty.clear()
+        return rows
+
+LATENCY = LatencyTracker(LATENCY_HISTORY, LATENCY_WINDOW, LATENCY_MIN_SAMPLES)
+
+# ==============================================================================
+# 🔌 SSH CONNECTION POOL
+# ==============================================================================
+class SSHConnectionPool:
+    """نگهداری اتصال‌های SSH احراز هویت شده برای استفاده مجدد (کلید: ip, port, username)"""
+    def __init__(self, sessions, keepalive=SSH_KEEPALIVE_INTERVAL, idle_timeout=SSH_POOL_IDLE_TIMEOUT):
+        self.sessions = sessions
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        # اتصال‌های جایگزین‌شده که هنوز اجاره دارند: id(client) -> entry؛ آخرین release آن را می‌بندد
+        self.retired = {}
+
+    @staticmethod
+    def make_key(ip, port, user):
+        return (ip, int(port), user)
+
+    @staticmethod
+    def _secret_digest(password):
+        return hashlib.sha256((password or "").encode()).hexdigest()
+
+    @staticmethod
+    def _is_alive(entry):
+        transport = entry['client'].get_transport()
+        return transport is not None and transport.is_active()
+
+    @staticmethod
+    def _close(entry):
+        try: entry['client'].close()
+        except: pass
+
+    def _pop_and_close(self, key):
+        entry = self.sessions.pop(key, None)
+        if entry: self._close(entry)
+
+    def _retire(self, key):
+        """برداشتن اتصال از Pool (فقط با self.lock)؛ اتصال در حال استفاده تا آخرین release باز می‌ماند"""
+        entry = self.sessions.pop(key, None)
+        if not entry: return
+        if entry['leases']: self.retired[id(entry['client'])] = entry
+        else: self._close(entry)
+
+    def acquire(self, ip, port, user, password):
+        """برگرداندن (client, reused)؛ اتصال مرده یا با رمز قدیمی دوباره ساخته می‌شود"""
+        key = self.make_key(ip, port, user)
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+        # فقط یک Handshake همزمان برای هر کلید
+        with key_lock:
+            digest = self._secret_digest(password)
+            with self.lock:
+                entry = self.sessions.get(key)
+                if entry and entry['digest'] == digest and self._is_alive(entry):
+                    entry['last_used'] = time.time()
+                    entry['leases'] += 1
+                    return entry['client'], True
+                # اتصال قدیمی جایگزین می‌شود، نه بسته: ممکن است دستور دیگری (مثلا آپدیت) روی آن در حال اجرا باشد
+                self._retire(key)
+
+            client = ServerMonitor.get_ssh_client(ip, port, user, password)
+            transport = client.get_transport()
+            if transport: transport.set_keepalive(self.keepalive)
+            now = time.time()
+            with self.lock:
+                self.sessions[key] = {'client': client, 'digest': digest, 'created': now, 'last_used': now, 'leases': 1}
+            return client, False
+
+    def release(self, ip, port, user, client):
+        """پایان استفاده از اتصالی که acquire داده؛ اتصال در حال استفاده هرگز بیکار حساب نمی‌شود"""
+        with self.lock:
+            entry = self.sessions.get(self.make_key(ip, port, user))
+            if entry and entry['client'] is client:
+                entry['leases'] = max(0, entry['leases'] - 1)
+                entry['last_used'] = time.time()
+                return
+            entry = self.retired.get(id(client))
+            if entry and entry['client'] is client:
+                entry['leases'] -= 1
+                if entry['leases'] <= 0:
+                    del self.retired[id(client)]
+                    self._close(entry)
+
+    def invalidate(self, ip, port, user, client):
+        """کنار گذاشتن اتصال خراب؛ فقط اگر هنوز همان client در Pool باشد (نه اتصال تازه‌ای که دیگری ساخته)"""
+        key = self.make_key(ip, port, user)
+        with self.lock:
+            entry = self.sessions.get(key)
+            if entry and entry['client'] is client:
+                self._retire(key)
+
+    def evict_idle(self):
+        """بستن اتصال‌های بیکار یا قطع شده؛ تعداد حذف شده‌ها را برمی‌گرداند"""
+        now = time.time()
+        with self.lock:
+            # اتصال اجاره داده شده (دستور طولانی مثل آپدیت در حال اجرا) بسته نمی‌شود
+            stale = [
+                k for k, e in list(self.sessions.items())
+                if not e['leases'] and (now - e['last_used'] > self.idle_timeout or not self._is_alive(e))
+            ]
+            for k in stale:
+                self._pop_and_close(k)
+        # قفل هر کلید حذف نمی‌شود: acquire همزمان ممکن است آن را گرفته باشد و قفل تازه دو Handshake موازی می‌سازد
+        return len(stale)
+
+    def close_all(self):
+        with self.lock:
+            for k in list(self.sessions):
+                self._pop_and_close(k)
+            for entry in self.retired.values():
+                self._close(entry)
+            self.retired.clear()
+
+SSH_POOL = SSHConnectionPool(SSH_SESSION_CACHE)
+
+
+# ==============================================================================
+# ⚙️ SSH EXECUTORS
+# ==============================================================================
+class SSHExecutor:
+    """Thread pool اختصاصی SSH با سقف نشست همزمان برای هر هاست (صف FIFO)"""
+    def __init__(self, name, max_workers, per_host):
+        self.name = name
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"ssh-{name}")
+        self.host_slots = {}
+        self.stats_lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _execute(self, submitted, func, args):
+        wait = time.monotonic() - submitted
+        with self.stats_lock:
+            self.queued -= 1
+            self.running += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        try:
+            return func(*args)
+        finally:
+            with self.stats_lock:
+                self.running -= 1
+                self.completed += 1
+
+    async def run(self, host, func, *args):
+        submitted = time.monotonic()
+        with self.stats_lock:
+            self.queued += 1
+        slot = self.host_slots.get(host)
+        if slot is None:
+            slot = self.host_slots[host] = [asyncio.Semaphore(self.per_host), 0]
+        slot[1] += 1
+        started = False
+        try:
+            async with slot[0]:
+                started = True
+                return await asyncio.get_running_loop().run_in_executor(self.pool, self._execute, submitted, func, args)
+        finally:
+            if not started:
+                with self.stats_lock:
+                    self.queued -= 1
+            slot[1] -= 1
+            if slot[1] == 0 and self.host_slots.get(host) is slot:
+                del self.host_slots[host]
+
+    def stats(self):
+        with self.stats_lock:
+            done = self.completed + self.running
+            return {
+                'name': self.name, 'workers': self.max_workers, 'per_host': self.per_host,
+                'queued': self.queued, 'running': self.running, 'completed': self.completed,
+                'avg_wait': self.total_wait / done if done else 0.0, 'max_wait': self.max_wait
+            }
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+PROBE_EXECUTOR = SSHExecutor('probe', SSH_PROBE_WORKERS, SSH_PROBE_PER_HOST)
+TASK_EXECUTOR = SSHExecutor('task', SSH_TASK_WORKERS, SSH_TASK_PER_HOST)
+
+
+# ==============================================================================
+# 🔁 SINGLE-FLIGHT (ادغام درخواست‌های همزمان)
+# ==============================================================================
+class SingleFlight:
+    """درخواست‌های همزمان با کلید یکسان (عملیات + هدف) منتظر یک Future مشترک می‌مانند
+    و نتیجه برای مدت کوتاهی (TTL) کش می‌شود تا رگبار کلیک‌ها دوباره اجرا نشوند"""
+    def __init__(self, ttls, failure_ttl):
+        self.ttls = ttls
+        self.failure_ttl = failure_ttl
+        self.inflight = {}
+        self.cache = {}
+        self.counters = {}
+
+    async def do(self, op, target, factory):
+        key = (op, target)
+        st = self.counters.setdefault(op, {'calls': 0, 'hits': 0, 'joins': 0})
+        st['calls'] += 1
+
+        cached = self.cache.get(key)
+        if cached and time.time() < cached[0]:
+            st['hits'] += 1
+            return cached[1]
+
+        fut = self.inflight.get(key)
+        if fut:
+            st['joins'] += 1
+            return await asyncio.shield(fut)
+
+        fut = self.inflight[key] = asyncio.ensure_future(factory())
+        try:
+            res = await asyncio.shield(fut)
+            ttl = self.ttls.get(op, 0) if self.succeeded(res) else min(self.failure_ttl, self.ttls.get(op, 0))
+            self.cache[key] = (time.time() + ttl, res)
+            return res
+        finally:
+            if self.inflight.get(key) is fut: del self.inflight[key]
+
+    @staticmethod
+    def succeeded(res):
+        """(ok, data) یا نتیجه پروب با status"""
+        if isinstance(res, tuple): return bool(res and res[0])
+        if isinstance(res, ProbeResult): return res.get('status') == 'Online'
+        return bool(res)
+
+    def prune(self):
+        now = time.time()
+        for key in [k for k, (expires, _) in self.cache.items() if now >= expires]:
+            del self.cache[key]
+
+    def stats(self):
+        return {op: dict(st) for op, st in self.counters.items()}
+
+SINGLE_FLIGHT = SingleFlight(SINGLE_FLIGHT_TTL, SINGLE_FLIGHT_FAILURE_TTL)
+
+async def coalesced_full_stats(ip, port, user, password, rtt=None):
+    # رمز هم در کلید است تا دو کاربر با رمزهای متفاوت نتیجه یکدیگر را نگیرند
+    target = (ip, int(port), user, SSHConnectionPool._secret_digest(password))
+    res = await SINGLE_FLIGHT.do('full_stats', target, lambda: PROBE_EXECUTOR.run(
+        ip, ServerMonitor.check_full_stats, ip, port, user, password, rtt
+    ))
+    return res.copy()
+
+async def coalesced_host_check(target):
+    loop = asyncio.get_running_loop()
+    return await SINGLE_FLIGHT.do('check_host', target, lambda: loop.run_in_executor(None, ServerMonitor.check_host_api, target))
+
+async def coalesced_datacenter_info(ip):
+    loop = asyncio.get_running_loop()
+    return await SINGLE_FLIGHT.do('datacenter', ip, lambda: loop.run_in_executor(None, ServerMonitor.get_datacenter_info, ip))
+
+
+# ==============================================================================
+# 📐 METRICS COLLECTOR & PARSER
+# ==============================================================================
+# یک دستور واحد که فایل‌های خام را در یک کانال SSH می‌خواند (به جای ۷ دستور جداگانه)
+METRICS_PROBE_CMD = (
+    "echo '@@stat'; head -n 1 /proc/stat 2>/dev/null; "
+    "echo '@@meminfo'; cat /proc/meminfo 2>/dev/null; "
+    "echo '@@statvfs'; stat -f -c '%S %b %f %a' / 2>/dev/null; "
+    "echo '@@uptime'; cat /proc/uptime 2>/dev/null; "
+    "echo '@@netdev'; cat /proc/net/dev 2>/dev/null; "
+    "echo '@@diskstats'; cat /proc/diskstats 2>/dev/null; "
+    "echo '@@who'; who 2>/dev/null; "
+    "echo '@@end'"
+)
+
+WHOLE_DISK_RE = re.compile(r'^(sd[a-z]+|vd[a-z]+|xvd[a-z]+|hd[a-z]+|nvme\d+n\d+|mmcblk\d+)$')
+
+class MetricsParser:
+    """تجزیه خروجی METRICS_PROBE_CMD به صورت محلی"""
+    @staticmethod
+    def split_sections(payload):
+        sections, current = {}, None
+        for line in payload.splitlines():
+            if line.startswith('@@'):
+                current = line[2:].strip()
+                sections[current] = []
+            elif current is not None and line.strip():
+                sections[current].append(line)
+        return sections
+
+    @staticmethod
+    def parse_cpu_times(lines):
+        """(busy, total) بر حسب jiffies از خط cpu در /proc/stat"""
+        fields = lines[0].split()
+        if fields[0] != 'cpu': raise ValueError("bad /proc/stat")
+        values = [int(v) for v in fields[1:9]]
+        values += [0] * (8 - len(values))
+        idle = values[3] + values[4]  # idle + iowait
+        total = sum(values)
+        return total - idle, total
+
+    @staticmethod
+    def parse_meminfo(lines):
+        info = {}
+        for line in lines:
+            key, _, rest = line.partition(':')
+            parts = rest.split()
+            if parts: info[key.strip()] = int(parts[0])
+        total = info['MemTotal']
+        available = info.get('MemAvailable')
+        if available is None:
+            available = info.get('MemFree', 0) + info.get('Buffers', 0) + info.get('Cached', 0)
+        return (total - available) * 100 / total if total else 0.0
+
+    @staticmethod
+    def parse_statvfs(lines):
+        """درصد مصرف دیسک / مثل ستون Use% در df"""
+        _, blocks, bfree, bavail = (int(v) for v in lines[0].split()[:4])
+        used = blocks - bfree
+        denom = used + bavail
+        if denom <= 0: return 0
+        return -(-used * 100 // denom)  # گرد کردن به بالا مثل df
+
+    @staticmethod
+    def parse_net_dev(lines):
+        """(rx_bytes, tx_bytes) مجموع همه اینترفیس‌ها"""
+        rx = tx = 0
+        for line in lines:
+            if ':' not in line: continue
+            _, _, data = line.partition(':')
+            fields = data.split()
+            if len(fields) < 9: continue
+            rx += int(fields[0])
+            tx += int(fields[8])
+        return rx, tx
+
+    @staticmethod
+    def parse_diskstats(lines):
+        """(read_bytes, write_bytes) مجموع دیسک‌های فیزیکی (بدون پارتیشن و loop/ram/dm)"""
+        read = write = 0
+        for line in lines:
+            fields = line.split()
+            if len(fields) < 10 or not WHOLE_DISK_RE.match(fields[2]): continue
+            read += int(fields[5]) * 512
+            write += int(fields[9]) * 512
+        return read, write
+
+    @staticmethod
+    def parse_who(lines):
+        sessions = []
+        for line in lines:
+            parts = line.split()
+            if not parts: continue
+            host = parts[4] if len(parts) > 4 else ''
+            sessions.append(f"{parts[0]}_{host}".replace('(', '').replace(')', ''))
+        return sessions
+
+    @staticmethod
+    def format_uptime(seconds):
+        minutes = int(seconds) // 60
+        weeks, minutes = divmod(minutes, 7 * 24 * 60)
+        days, minutes = divmod(minutes, 24 * 60)
+        hours, minutes = divmod(minutes, 60)
+        parts = [f"{v} {u}" for v, u in ((weeks, 'w'), (days, 'd'), (hours, 'h')) if v]
+        parts.append(f"{minutes} m")
+        return ", ".join(parts)
+
+    @staticmethod
+    def parse(payload):
+        sections = MetricsParser.split_sections(payload)
+        if 'end' not in sections: raise ValueError("truncated metrics payload")
+
+        def safe(func, key, default):
+            try: return func(sections.get(key, []))
+            except Exception: return default
+
+        busy, total = safe(MetricsParser.parse_cpu_times, 'stat', (0, 0))
+        uptime_sec = safe(lambda l: float(l[0].split()[0]), 'uptime', 0)
+        rx, tx = safe(MetricsParser.parse_net_dev, 'netdev', (0, 0))
+        disk_read, disk_write = safe(MetricsParser.parse_diskstats, 'diskstats', (0, 0))
+        return {
+            'cpu': round(busy * 100 / total, 1) if total else 0.0,
+            'ram': round(safe(MetricsParser.parse_meminfo, 'meminfo', 0.0), 1),
+            'disk': int(safe(MetricsParser.parse_statvfs, 'statvfs', 0)),
+            'uptime_str': MetricsParser.format_uptime(uptime_sec),
+            'uptime_sec': uptime_sec,
+            'traffic_gb': round((rx + tx) / (1024**3), 2),
+            'ssh_sessions': safe(MetricsParser.parse_who, 'who', []),
+            # شمارنده‌های خام از زمان بوت؛ CounterDeltaEngine از آن‌ها نرخ لحظه‌ای می‌سازد
+            'counters': {
+                'uptime': uptime_sec, 'cpu_busy': busy, 'cpu_total': total,
+                'net_rx': rx, 'net_tx': tx, 'disk_read': disk_read, 'disk_write': disk_write
+            },
+        }
+
+
+class CounterDeltaEngine:
+    """نگهداری آخرین نمونه شمارنده‌های هر سرور و محاسبه CPU و نرخ شبکه/دیسک بین دو پروب"""
+    MIN_WINDOW = 1.0
+    CUMULATIVE_KEYS = ('cpu_busy', 'cpu_total', 'net_rx', 'net_tx', 'disk_read', 'disk_write')
+
+    def __init__(self, samples):
+        self.samples = samples
+        self.lock = threading.Lock()
+
+    def apply(self, key, stats, now=None):
+        counters = stats.pop('counters', None)
+        if counters is None: return stats
+        now = now or time.time()
+
+        with self.lock:
+            prev = self.samples.get(key)
+            if prev and now - prev['ts'] < self.MIN_WINDOW:
+                # فاصله خیلی کم است؛ نمونه پایه را نگه می‌داریم و نرخ قبلی را برمی‌گردانیم
+                stats.update(prev['rates'])
+                return stats
+
+            rates = {'net_rx_bps': None, 'net_tx_bps': None, 'disk_read_bps': None, 'disk_write_bps': None}
+            old = prev['counters'] if prev else None
+            # ریبوت یا ریست شمارنده: آپتایم یا یکی از شمارنده‌ها کم شده است
+            is_reset = (
+                old is None or counters['uptime'] < old['uptime']
+                or any(counters[k] < old[k] for k in self.CUMULATIVE_KEYS)
+            )
+            if not is_reset:
+                # فاصله واقعی از روی آپتایم سرور (بدون خطای تاخیر شبکه)
+                elapsed = counters['uptime'] - old['uptime']
+                if elapsed <= 0: elapsed = now - prev['ts']
+                d_total = counters['cpu_total'] - old['cpu_total']
+                if d_total > 0:
+                    rates['cpu'] = round((counters['cpu_busy'] - old['cpu_busy']) * 100 / d_total, 1)
+                rates['net_rx_bps'] = (counters['net_rx'] - old['net_rx']) / elapsed
+                rates['net_tx_bps'] = (counters['net_tx'] - old['net_tx']) / elapsed
+                rates['disk_read_bps'] = (counters['disk_read'] - old['disk_read']) / elapsed
+                rates['disk_write_bps'] = (counters['disk_write'] - old['disk_write']) / elapsed
+
+            self.samples[key] = {'ts': now, 'counters': counters, 'rates': rates}
+
+        stats.update(rates)
+        return stats
+
+    def prune(self, max_age=3600):
+        cutoff = time.time() - max_age
+        with self.lock:
+            for k in [k for k, v in self.samples.items() if v['ts'] < cutoff]:
+                del self.samples[k]
+
+METRIC_DELTAS = CounterDeltaEngine(COUNTER_SAMPLES)
 
 
 # ==============================================================================
@@ -604,8 +1848,49 @@ class ServerMonitor:
     def get_ssh_client(ip, port, user, password):
         client = paramiko.SSHClient()
         client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(ip, port=port, username=user, password=password, timeout=10)
+        timeout = LATENCY.connect_timeout(ip, port)
+        client.connect(ip, port=port, username=user, password=password, timeout=timeout, banner_timeout=timeout)
         return client
+
+    @staticmethod
+    async def tcp_preflight(ip, port):
+        """اتصال async به پورت SSH قبل از handshake پارامیکو (بدون اشغال ترد)؛ خروجی (ok, rtt_ms, error)"""
+        timeout = LATENCY.preflight_timeout(ip, port)
+        started = time.monotonic()
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(ip, int(port)), timeout)
+        except (asyncio.TimeoutError, TimeoutError):
+            # تایم‌اوت نمونه RTT نیست: ثبتش p99 و در نتیجه تایم‌اوت اتصال SSH را بی‌دلیل بزرگ می‌کند
+            return False, None, "TCP connect timeout"
+        except OSError as e:
+            return False, None, (e.strerror or str(e))[:50]
+
+        rtt = time.monotonic() - started
+        writer.close()
+        try: await writer.wait_closed()
+        except: pass
+        LATENCY.record(ip, port, 'rtt', rtt)
+        return True, round(rtt * 1000, 1), None
+
+    @staticmethod
+    def run_with_client(ip, port, user, password, func, idempotent=False):
+        """اجرای func روی اتصال Pool. فقط خطای سطح اتصال، اتصال مشترک را می‌بندد (نه Timeout دستور یا خطای پارس).
+        تکرار با اتصال تازه: برای func تکرارپذیر همیشه، برای بقیه فقط وقتی کانال اصلا باز نشده است"""
+        for attempt in range(2):
+            client, reused = SSH_POOL.acquire(ip, port, user, password)
+            try:
+                return func(client)
+            except Exception as e:
+                transport = client.get_transport()
+                dead = transport is None or not transport.is_active()
+                transport_error = isinstance(e, (paramiko.SSHException, EOFError, OSError)) and not isinstance(e, TimeoutError)
+                if not (dead or transport_error): raise
+                SSH_POOL.invalidate(ip, port, user, client)
+                not_started = isinstance(e, paramiko.ChannelException) or 'session not active' in str(e)
+                if not reused or attempt or not (idempotent or not_started): raise
+                logger.info(f"Stale pooled SSH session to {ip}:{port} dropped ({e}), reconnecting")
+            finally:
+                SSH_POOL.release(ip, port, user, client)
     @staticmethod
     def get_bot_public_ip():
         """آی‌پی سرور خود ربات را می‌گیرد"""
@@ -716,71 +2001,43 @@ class ServerMonitor:
         return bar
 
     @staticmethod
-    def check_full_stats(ip, port, user, password):
-        client = None
-        try:
-            client = ServerMonitor.get_ssh_client(ip, port, user, password)
-            commands = [
-                "grep 'cpu ' /proc/stat | awk '{usage=($2+$4)*100/($2+$4+$5)} END {print usage}'", 
-                "free -m | awk 'NR==2{printf \"%.2f\", $3*100/$2 }'", 
-                "df -h / | awk 'NR==2{print $5}' | tr -d '%'", 
-                "uptime -p", 
-                "cat /proc/uptime | awk '{print $1}'", 
-                "cat /proc/net/dev | awk 'NR>2 {rx+=$2; tx+=$10} END {print rx+tx}'",
-                "who | awk '{print $1 \"_\" $5}'"
-            ]
-            results = []
-            for cmd in commands:
-                try:
-                    _, stdout, _ = client.exec_command(cmd, timeout=5)
-                    out = stdout.read().decode().strip()
-                    results.append(out if out else "0")
-                except: results.append("0")
-            client.close()
-            
-            try:
-                uptime_sec = float(results[4]) if results[4].replace('.','',1).isdigit() else 0
-            except ValueError: uptime_sec = 0
+    def format_rate(bps):
+        if not isinstance(bps, (int, float)): return "—"
+        for unit in ('B/s', 'KB/s', 'MB/s'):
+            if bps < 1024: return f"{bps:.1f} {unit}"
+            bps /= 1024
+        return f"{bps:.1f} GB/s"
 
-            traffic_bytes = int(results[5]) if results[5].isdigit() else 0
-            traffic_gb = round(traffic_bytes / (1024**3), 2)
-            uptime_str = results[3].replace('up ', '').replace('weeks', 'w').replace('days', 'd').replace('hours', 'h').replace('minutes', 'm')
-            
-            try: cpu_val = round(float(results[0]), 1)
-            except: cpu_val = 0.0
-            try: ram_val = round(float(results[1]), 1)
-            except: ram_val = 0.0
-            try: disk_val = int(results[2])
-            except: disk_val = 0
-            who_data = results[6].split('\n') if results[6] != "0" else []
-            current_sessions = [line.strip().replace('(', '').replace(')', '') for line in who_data if line.strip()]
-            return {
-                'status': 'Online', 'cpu': cpu_val, 'ram': ram_val, 'disk': disk_val, 
-                'uptime_str': uptime_str, 'uptime_sec': uptime_sec, 'traffic_gb': traffic_gb, 
-                'ssh_sessions': current_sessions,
-                'error': None
-            }
+    @staticmethod
+    def check_full_stats(ip, port, user, password, rtt=None):
+        """rtt: زمان اتصال TCP پیش‌پرواز (میلی‌ثانیه) که همراه آمار برگردانده می‌شود"""
+        try:
+            def collect(client):
+                started = time.monotonic()
+                _, stdout, _ = client.exec_command(METRICS_PROBE_CMD, timeout=LATENCY.command_timeout(ip, port))
+                payload = stdout.read().decode(errors='replace')
+                LATENCY.record(ip, port, 'duration', time.monotonic() - started)
+                return payload
+
+            payload = ServerMonitor.run_with_client(ip, port, user, password, collect, idempotent=True)
+            stats = METRIC_DELTAS.apply((ip, int(port)), MetricsParser.parse(payload))
+            return ProbeResult(status='Online', error=None, rtt=rtt, **stats)
         except Exception as e:
-            if client: 
-                try: client.close()
-                except: pass
-            return {'status': 'Offline', 'error': str(e)[:50], 'uptime_sec': 0, 'traffic_gb': 0, 'ssh_sessions': []}
+            return ProbeResult.offline(str(e)[:50], rtt)
 
     @staticmethod
     def run_remote_command(ip, port, user, password, command, timeout=60):
-        client = None
         try:
-            client = ServerMonitor.get_ssh_client(ip, port, user, password)
             full_cmd = f"export DEBIAN_FRONTEND=noninteractive; {command}"
-            _, stdout, stderr = client.exec_command(full_cmd, timeout=timeout)
-            out = stdout.read().decode().strip()
-            err = stderr.read().decode().strip()
-            client.close()
-            return True, (out + "\n" + err).strip()
+
+            def execute(client):
+                _, stdout, stderr = client.exec_command(full_cmd, timeout=timeout)
+                out = stdout.read().decode().strip()
+                err = stderr.read().decode().strip()
+                return (out + "\n" + err).strip()
+
+            return True, ServerMonitor.run_with_client(ip, port, user, password, execute)
         except Exception as e:
-            if client:
-                try: client.close()
-                except: pass
             return False, str(e)
 
     @staticmethod
@@ -799,12 +2056,13 @@ class ServerMonitor:
     # --- تابع جدید پاکسازی دیسک ---
     @staticmethod
     def clean_disk_space(ip, port, user, password):
-        try:
-            client = ServerMonitor.get_ssh_client(ip, port, user, password)
-            
-            # 1. محاسبه فضای مصرفی قبل از پاکسازی
+        def used_kb(client):
             _, stdout, _ = client.exec_command("df / --output=used | tail -n 1")
-            start_used = int(stdout.read().decode().strip())
+            return int(stdout.read().decode().strip())
+
+        def clean(client):
+            # 1. محاسبه فضای مصرفی قبل از پاکسازی
+            start_used = used_kb(client)
 
             # 2. اجرای دستورات پاکسازی
             commands = (
@@ -818,12 +2076,13 @@ class ServerMonitor:
             chan = client.get_transport().open_session()
             chan.exec_command(commands)
             chan.recv_exit_status() # این خط صبر می‌کند تا دستور تمام شود
+            chan.close()
             
             # 3. محاسبه فضای مصرفی بعد از پاکسازی
-            _, stdout, _ = client.exec_command("df / --output=used | tail -n 1")
-            end_used = int(stdout.read().decode().strip())
-            
-            client.close()
+            return start_used, used_kb(client)
+
+        try:
+            start_used, end_used = ServerMonitor.run_with_client(ip, port, user, password, clean)
             
             # محاسبه مقدار آزاد شده
             freed_kb = start_used - end_used
@@ -924,7 +2183,7 @@ class ServerMonitor:
         return "🌍 **Check-Host (Iran Only)**\n`Location         | Pkts| Latency (m/a/x)`\n" + "─"*48 + "\n" + "\n".join(rows)
 
 
-def generate_plot(server_name, stats):
+def generate_plot(server_name, stats, range_label='24h'):
     if not stats:
         return None
     try:
@@ -937,8 +2196,11 @@ def generate_plot(server_name, stats):
         
         ax.plot(times, cpus, label='CPU (%)', color='red', linewidth=2)
         ax.plot(times, rams, label='RAM (%)', color='blue', linewidth=2)
+        # داده خام p95 دارد و Rollupها حداکثر هر سطل
+        peak = 'cpu_p95' if 'cpu_p95' in stats[0].keys() else 'cpu_max'
+        ax.plot(times, [s[peak] for s in stats], label='CPU p95' if peak == 'cpu_p95' else 'CPU max', color='red', linewidth=1, linestyle=':', alpha=0.6)
         
-        ax.set_title(f"Server Monitor: {server_name} (Last 24h)")
+        ax.set_title(f"Server Monitor: {server_name} (Last {range_label})")
         ax.set_xlabel('Time')
         ax.set_ylabel('Usage %')
         ax.set_ylim(0, 100)
@@ -977,9 +2239,8 @@ async def safe_edit_message(update: Update, text, reply_markup=None, parse_mode=
 
 
 async def run_background_ssh_task(context: ContextTypes.DEFAULT_TYPE, chat_id, func, *args):
-    loop = asyncio.get_running_loop()
     try:
-        ok, output = await loop.run_in_executor(None, func, *args)
+        ok, output = await TASK_EXECUTOR.run(args[0], func, *args)
         clean_out = html.escape(str(output))
         if len(clean_out) > 3500: 
             clean_out = clean_out[:3500] + "\n... (Output Truncated)"
@@ -1020,14 +2281,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     full_name = update.effective_user.full_name
     username = update.effective_user.username or "ندارد"
     context.user_data.clear()
-    loop = asyncio.get_running_loop()
 
     # --- بررسی دعوت ---
     args = context.args  # پارامترهای لینک (مثلا /start 12345)
     inviter_id = 0
     
     # چک می‌کنیم کاربر قبلاً عضو نبوده باشد
-    existing_user = await loop.run_in_executor(None, db.get_user, user_id)
+    existing_user = await adb.read(db.get_user, user_id)
     is_new_user = False if existing_user else True
 
     if is_new_user and args and args[0].isdigit():
@@ -1035,12 +2295,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # کاربر نمی‌تواند خودش را دعوت کند
         if possible_inviter != user_id:
             # چک می‌کنیم معرف وجود دارد؟
-            inviter_exists = await loop.run_in_executor(None, db.get_user, possible_inviter)
+            inviter_exists = await adb.read(db.get_user, possible_inviter)
             if inviter_exists:
                 inviter_id = possible_inviter
 
     # ثبت نام کاربر (با آیدی معرف اگر وجود داشت)
-    await loop.run_in_executor(None, db.add_or_update_user, user_id, full_name, inviter_id)
+    await adb.write(db.add_or_update_user, user_id, full_name, inviter_id)
     
     # --- سیستم جایزه دهی ---
     if is_new_user:
@@ -1052,7 +2312,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # 2. اگر معرف داشت، جایزه را اعمال کن
         if inviter_id != 0:
-            ok, new_lim, new_exp = await loop.run_in_executor(None, db.apply_referral_reward, inviter_id)
+            ok, new_lim, new_exp = await adb.write(db.apply_referral_reward, inviter_id)
             if ok:
                 try:
                     # پیام تبریک به معرف
@@ -1079,7 +2339,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
     # --- ادامه کد استارت مثل قبل ---
-    has_access, msg = await loop.run_in_executor(None, db.check_access, user_id)
+    has_access, msg = await adb.read(db.check_access, user_id)
     if not has_access:
         await update.effective_message.reply_text(f"⛔️ دسترسی مسدود است: {msg}")
         return
@@ -1116,7 +2376,7 @@ async def user_profile_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try: await update.callback_query.answer()
         except: pass
     uid = update.effective_user.id
-    user = db.get_user(uid)
+    user = await adb.read(db.get_user, uid)
     
     if not user:
         await safe_edit_message(update, "❌ کاربر یافت نشد.")
@@ -1129,7 +2389,7 @@ async def user_profile_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except:
         join_str = "نامشخص"
 
-    access, time_left = db.check_access(uid)
+    access, time_left = await adb.read(db.check_access, uid)
     if uid == SUPER_ADMIN_ID:
         sub_type = "👑 مدیریت کل (God Mode)"
         expiry_str = "♾ نامحدود"
@@ -1137,7 +2397,7 @@ async def user_profile_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         sub_type = "💎 پریمیوم (VIP)" if user['server_limit'] > 10 else "👤 عادی (Normal)"
         expiry_str = f"{time_left} روز مانده" if isinstance(time_left, int) else "نامحدود"
 
-    servers = db.get_all_user_servers(uid)
+    servers = await adb.read(db.get_all_user_servers, uid)
     srv_count = len(servers)
     active_srv = sum(1 for s in servers if s['is_active'])
 
@@ -1175,9 +2435,8 @@ async def web_token_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def admin_panel_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != SUPER_ADMIN_ID: return
     
-    users_count = len(db.get_all_users())
-    with db.get_connection() as conn:
-        total_servers = len(conn.execute('SELECT id FROM servers').fetchall())
+    users_count = len(await adb.read(db.get_all_users))
+    total_servers = len(await adb.read(db.get_all_servers))
     
     kb = [
         [InlineKeyboardButton("👥 مدیریت کاربران", callback_data='admin_users_page_1')],
@@ -1191,17 +2450,35 @@ async def admin_panel_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("🔙 بازگشت", callback_data='main_menu')]
     ]
     
+    executor_lines = ""
+    for ex in (PROBE_EXECUTOR, TASK_EXECUTOR):
+        st = ex.stats()
+        executor_lines += (
+            f"\n⚙️ `{st['name']}`: صف `{st['queued']}` | فعال `{st['running']}/{st['workers']}` | "
+            f"انتظار میانگین `{st['avg_wait']:.2f}s` (حداکثر `{st['max_wait']:.1f}s`)"
+        )
+
+    for op, st in SINGLE_FLIGHT.stats().items():
+        executor_lines += f"\n🔁 `{op}`: درخواست `{st['calls']}` | کش `{st['hits']}` | ادغام `{st['joins']}`"
+
+    guard = MONITOR_TICK_GUARD
+    monitor_line = (
+        f"\n⏱ تیک مانیتور: `{guard.last_duration:.1f}s` | جامانده: `{guard.total_skipped}` | "
+        f"تاخیر: `{guard.lag:.0f}s` (`{len(guard.carryover)}` سرور در صف)"
+    )
+
     txt = (
         f"🤖 **پنل مدیریت ربات**\n\n"
         f"📊 **آمار کلی:**\n"
         f"👤 کل کاربران: `{users_count}`\n"
-        f"🖥 کل سرورهای ثبت شده: `{total_servers}`"
+        f"🖥 کل سرورهای ثبت شده: `{total_servers}`\n\n"
+        f"🔌 **صف‌های SSH:**{executor_lines}{monitor_line}"
     )
     await safe_edit_message(update, txt, reply_markup=InlineKeyboardMarkup(kb))
 
 async def admin_users_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     page = int(update.callback_query.data.split('_')[-1])
-    users, total_count = db.get_all_users_paginated(page, 5)
+    users, total_count = await adb.read(db.get_all_users_paginated, page, 5)
     total_pages = (total_count + 4) // 5
     
     txt = f"👥 **لیست کاربران (صفحه {page} از {total_pages})**\nتعداد کل: `{total_count}`\n➖➖➖➖➖➖"
@@ -1233,10 +2510,11 @@ async def admin_user_manage(update: Update, context: ContextTypes.DEFAULT_TYPE,
         await safe_edit_message(update, "❌ خطای سیستمی: آیدی کاربر پیدا نشد.")
         return
 
-    user = db.get_user(user_id)
+    user = await adb.read(db.get_user, user_id)
     if not user:
         await safe_edit_message(update, "❌ کاربر در دیتابیس یافت نشد.")
         return
+    srv_count = len(await adb.read(db.get_all_user_servers, user_id))
 
     plan_txt = "💎 پریمیوم (VIP)" if user['plan_type'] == 1 else "👤 عادی (Normal)"
     plan_action = "تبدیل به عادی ⬇️" if user['plan_type'] == 1 else "ارتقا به پریمیوم 💎"
@@ -1249,7 +2527,7 @@ async def admin_user_manage(update: Update, context: ContextTypes.DEFAULT_TYPE,
         f"📆 انقضا: `{user['expiry_date']}`\n"
         f"📡 وضعیت: {ban_status}\n"
         f"➖➖➖➖➖➖➖➖➖➖\n"
-        f"📊 سرورها: `{len(db.get_all_user_servers(user_id))}` / `{user['server_limit']}`"
+        f"📊 سرورها: `{srv_count}` / `{user['server_limit']}`"
     )
     
     kb = [
@@ -1268,20 +2546,20 @@ async def admin_user_actions(update: Update, context: ContextTypes.DEFAULT_TYPE)
     target_id = int(data.split('_')[3])
     
     if action == 'ban':
-        new_state = db.toggle_ban_user(target_id)
+        new_state = await adb.write(db.toggle_ban_user, target_id)
         msg = "کاربر مسدود شد." if new_state else "کاربر فعال شد."
         try: await update.callback_query.answer(msg)
         except: pass
         await admin_user_manage(update, context, user_id=target_id)
         
     elif action == 'del':
-        db.remove_user(target_id)
+        await adb.write(db.remove_user, target_id)
         try: await update.callback_query.answer("کاربر حذف شد.")
         except: pass
         await admin_users_list(update, context)
         
     elif action == 'addtime':
-        db.add_or_update_user(target_id, days=30)
+        await adb.write(lambda: db.add_or_update_user(target_id, days=30))
         try: await update.callback_query.answer("30 روز تمدید شد.")
         except: pass
         await admin_user_manage(update, context, user_id=target_id)
@@ -1296,7 +2574,7 @@ async def admin_user_actions(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await safe_edit_message(update, "📅 **تعداد روز اعتبار را وارد کنید (مثلا 60):**", reply_markup=get_cancel_markup())
         return ADMIN_SET_TIME_MANUAL
     elif action == 'toggleplan':
-        new_plan = db.toggle_user_plan(target_id)
+        new_plan = await adb.write(db.toggle_user_plan, target_id)
         msg = "✅ کاربر به پریمیوم ارتقا یافت (لیمیت: 10)" if new_plan == 1 else "⬇️ کاربر به عادی تغییر یافت (لیمیت: 2)"
         try: await update.callback_query.answer(msg, show_alert=True)
         except: pass
@@ -1306,7 +2584,7 @@ async def admin_set_limit_handler(update: Update, context: ContextTypes.DEFAULT_
     try:
         lim = int(update.message.text)
         target_id = context.user_data.get('target_uid')
-        db.update_user_limit(target_id, lim)
+        await adb.write(db.update_user_limit, target_id, lim)
         await update.message.reply_text(f"✅ محدودیت سرور به {lim} تغییر یافت.")
         await admin_user_manage(update, context, user_id=target_id)
         return ConversationHandler.END
@@ -1318,7 +2596,7 @@ async def admin_set_days_handler(update: Update, context: ContextTypes.DEFAULT_T
     try:
         days = int(update.message.text)
         target_id = context.user_data.get('target_uid')
-        db.add_or_update_user(target_id, days=days)
+        await adb.write(lambda: db.add_or_update_user(target_id, days=days))
         await update.message.reply_text(f"✅ اعتبار کاربر {days} روز تمدید شد.")
         await admin_user_manage(update, context, user_id=target_id)
         return ConversationHandler.END
@@ -1333,7 +2611,7 @@ async def admin_search_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def admin_search_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         tid = int(update.message.text)
-        user = db.get_user(tid)
+        user = await adb.read(db.get_user, tid)
         if user:
             await admin_user_manage(update, context, user_id=tid)
             return ConversationHandler.END
@@ -1345,7 +2623,7 @@ async def admin_search_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         return ADMIN_SEARCH_USER
 
 async def admin_users_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    users = db.get_all_users()
+    users = await adb.read(db.get_all_users)
     txt = "📋 **لیست کل کاربران:**\n\n"
     for u in users:
         txt += f"🆔 {u['user_id']} | 👤 {u['full_name']} | 📅 Exp: {u['expiry_date']}\n"
@@ -1362,8 +2640,7 @@ async def admin_users_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def admin_backup_get(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try: await update.callback_query.answer("در حال ارسال فایل...")
     except: pass
-    with db.get_connection() as conn:
-        conn.execute("PRAGMA wal_checkpoint(FULL);")
+    await adb.write(db.checkpoint, exclusive=True)
     await update.callback_query.message.reply_document(document=open(DB_NAME, 'rb'), caption=f"📦 Backup: {get_jalali_str()}")
 
 async def admin_backup_restore_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1381,7 +2658,7 @@ async def admin_broadcast_start(update: Update, context: ContextTypes.DEFAULT_TY
     return GET_BROADCAST_MSG
 
 async def admin_broadcast_send(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    users = db.get_all_users()
+    users = await adb.read(db.get_all_users)
     total = len(users)
     success = 0
     blocked = 0
@@ -1419,17 +2696,15 @@ async def admin_backup_restore_handler(update: Update, context: ContextTypes.DEF
     await f.download_to_drive(temp_name)
     
     try:
-        if os.path.exists(DB_NAME):
-            os.remove(DB_NAME)
-        os.rename(temp_name, DB_NAME)
-        
-        # Re-initialize to ensure tables exist if backup was old
-        db.init_db()
+        # کپی داخل همان فایل از ترد نویسنده (بدون نوشتن همزمان)؛ init_db جداول بکاپ قدیمی را کامل می‌کند
+        await adb.write(db.restore_from, temp_name, exclusive=True)
         
         await update.message.reply_text("✅ دیتابیس با موفقیت بازنشانی شد.")
         await start(update, context)
     except Exception as e:
         await update.message.reply_text(f"❌ خطا در بازنشانی: {e}")
+    finally:
+        if os.path.exists(temp_name): os.remove(temp_name)
     
     return ConversationHandler.END
 # --- SECRET KEY HANDLERS ---
@@ -1476,7 +2751,8 @@ async def get_new_user_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def get_new_user_days(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        db.add_or_update_user(context.user_data['new_uid'], full_name="User (Manual)", days=int(update.message.text))
+        new_uid, days = context.user_data['new_uid'], int(update.message.text)
+        await adb.write(lambda: db.add_or_update_user(new_uid, full_name="User (Manual)", days=days))
         await update.message.reply_text("✅ کاربر افزوده شد.")
         await start(update, context)
         return ConversationHandler.END
@@ -1489,7 +2765,7 @@ async def get_new_user_days(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def admin_payment_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """منوی مدیریت روش‌های پرداخت"""
-    methods = db.get_payment_methods()
+    methods = await adb.read(db.get_payment_methods)
     
     txt = "💳 **مدیریت روش‌های پرداخت**\n\nلیست روش‌های فعال:\n"
     if not methods:
@@ -1509,7 +2785,7 @@ async def admin_payment_settings(update: Update, context: ContextTypes.DEFAULT_T
 
 async def delete_payment_method_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
     p_id = int(update.callback_query.data.split('_')[3])
-    db.delete_payment_method(p_id)
+    await adb.write(db.delete_payment_method, p_id)
     await update.callback_query.answer("🗑 حذف شد.")
     await admin_payment_settings(update, context)
 
@@ -1554,7 +2830,7 @@ async def get_pay_holder(update: Update, context: ContextTypes.DEFAULT_TYPE):
     holder = update.message.text
     data = context.user_data
     
-    db.add_payment_method(data['new_pay_type'], data['new_pay_net'], data['new_pay_addr'], holder)
+    await adb.write(db.add_payment_method, data['new_pay_type'], data['new_pay_net'], data['new_pay_addr'], holder)
     
     await update.message.reply_text("✅ **روش پرداخت با موفقیت اضافه شد.**")
     # بازگشت به منوی پرداخت
@@ -1571,7 +2847,7 @@ async def get_pay_holder(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # 🛠 SERVER & GROUP MANAGEMENT
 # ==============================================================================
 async def groups_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    groups = db.get_user_groups(update.effective_user.id)
+    groups = await adb.read(db.get_user_groups, update.effective_user.id)
     kb = [[InlineKeyboardButton(f"🗑 {g['name']}", callback_data=f'delgroup_{g["id"]}')] for g in groups]
     kb.append([InlineKeyboardButton("➕ گروه جدید", callback_data='add_group')])
     kb.append([InlineKeyboardButton("🔙", callback_data='main_menu')])
@@ -1582,17 +2858,17 @@ async def add_group_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return GET_GROUP_NAME
 
 async def get_group_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    db.add_group(update.effective_user.id, update.message.text)
+    await adb.write(db.add_group, update.effective_user.id, update.message.text)
     await start(update, context)
     return ConversationHandler.END
 
 async def delete_group_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    db.delete_group(int(update.callback_query.data.split('_')[1]), update.effective_user.id)
+    await adb.write(db.delete_group, int(update.callback_query.data.split('_')[1]), update.effective_user.id)
     await groups_menu(update, context)
 
 async def add_server_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = db.get_user(update.effective_user.id)
-    srv_count = len(db.get_all_user_servers(update.effective_user.id))
+    user = await adb.read(db.get_user, update.effective_user.id)
+    srv_count = len(await adb.read(db.get_all_user_servers, update.effective_user.id))
     if update.effective_user.id != SUPER_ADMIN_ID and srv_count >= user['server_limit']:
         await update.effective_message.reply_text("⛔️ **شما به سقف مجاز افزودن سرور رسیده‌اید.**")
         return ConversationHandler.END
@@ -1604,8 +2880,8 @@ SELECT_ADD_METHOD, GET_LINEAR_DATA = range(100, 102)
 
 async def add_server_start_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """منوی انتخاب روش افزودن سرور"""
-    user = db.get_user(update.effective_user.id)
-    srv_count = len(db.get_all_user_servers(update.effective_user.id))
+    user = await adb.read(db.get_user, update.effective_user.id)
+    srv_count = len(await adb.read(db.get_all_user_servers, update.effective_user.id))
     
     # چک کردن محدودیت کاربر
     if update.effective_user.id != SUPER_ADMIN_ID and srv_count >= user['server_limit']:
@@ -1666,9 +2942,9 @@ async def process_linear_data(update: Update, context: ContextTypes.DEFAULT_TYPE
     lines = [line.strip() for line in text.split('\n') if line.strip()]
     
     uid = update.effective_user.id
-    user = db.get_user(uid)
+    user = await adb.read(db.get_user, uid)
     limit = user['server_limit']
-    current_count = len(db.get_all_user_servers(uid))
+    current_count = len(await adb.read(db.get_all_user_servers, uid))
     
     success = 0
     failed = 0
@@ -1692,8 +2968,6 @@ async def process_linear_data(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
         return GET_LINEAR_DATA
 
-    loop = asyncio.get_running_loop()
-
     # پردازش ۵ خط به ۵ خط
     for i in range(0, len(lines), 5):
         if uid != SUPER_ADMIN_ID and (current_count + success) >= limit:
@@ -1715,8 +2989,8 @@ async def process_linear_data(update: Update, context: ContextTypes.DEFAULT_TYPE
         port = int(port_str)
         
         # تست اتصال
-        res = await loop.run_in_executor(
-            None, ServerMonitor.check_full_stats, ip, port, username, password
+        res = await PROBE_EXECUTOR.run(
+            ip, ServerMonitor.check_full_stats, ip, port, username, password
         )
         
         if res['status'] == 'Online':
@@ -1727,12 +3001,12 @@ async def process_linear_data(update: Update, context: ContextTypes.DEFAULT_TYPE
                     'expiry_date': None
                 }
                 
-                db.add_server(uid, 0, data)
+                await adb.write(db.add_server, uid, 0, data)
                 
                 # ✅ اصلاح بخش وایت‌لیست (رفع ارور Future pending)
                 if bot_ip:
                     async def do_whitelist_bg():
-                        await loop.run_in_executor(None, ServerMonitor.whitelist_bot_ip, ip, port, username, password, bot_ip)
+                        await TASK_EXECUTOR.run(ip, ServerMonitor.whitelist_bot_ip, ip, port, username, password, bot_ip)
                     # تسک را بدون await اجرا می‌کنیم تا سرعت کم نشود و ارور ندهد
                     asyncio.create_task(do_whitelist_bg())
                 
@@ -1808,7 +3082,7 @@ async def get_srv_expiry(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return SELECT_GROUP
 
 async def get_group_keyboard(uid):
-    groups = db.get_user_groups(uid)
+    groups = await adb.read(db.get_user_groups, uid)
     kb = [[InlineKeyboardButton(f"📁 {g['name']}", callback_data=str(g['id']))] for g in groups]
     kb.append([InlineKeyboardButton("فایل اصلی (بدون گروه)", callback_data="0")])
     kb.append([InlineKeyboardButton("🔙 انصراف", callback_data="cancel_flow")])
@@ -1818,15 +3092,15 @@ async def select_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.callback_query.data == 'cancel_flow': return await cancel_handler_func(update, context)
     await safe_edit_message(update, "⚡️ **در حال تست اتصال به سرور... (لطفاً صبر کنید)**")
     data = context.user_data['srv']
-    res = await asyncio.get_running_loop().run_in_executor(None, ServerMonitor.check_full_stats, data['ip'], data['port'], data['username'], sec.decrypt(data['password']))
+    res = await PROBE_EXECUTOR.run(data['ip'], ServerMonitor.check_full_stats, data['ip'], data['port'], data['username'], sec.decrypt(data['password']))
     if res['status'] == 'Online':
         try:
-            db.add_server(update.effective_user.id, int(update.callback_query.data), data)
+            await adb.write(db.add_server, update.effective_user.id, int(update.callback_query.data), data)
             try:
                 bot_ip = ServerMonitor.get_bot_public_ip()
                 if bot_ip:
-                    asyncio.create_task(asyncio.get_running_loop().run_in_executor(
-                        None, 
+                    asyncio.create_task(TASK_EXECUTOR.run(
+                        data['ip'], 
                         ServerMonitor.whitelist_bot_ip, 
                         data['ip'], data['port'], data['username'], sec.decrypt(data['password']), bot_ip
                     ))
@@ -1842,7 +3116,7 @@ async def select_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def list_groups_for_servers(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try: await update.callback_query.answer()
     except: pass
-    groups = db.get_user_groups(update.effective_user.id)
+    groups = await adb.read(db.get_user_groups, update.effective_user.id)
     kb = [[InlineKeyboardButton("🔗 همه سرورها (یکجا)", callback_data='list_all')]] + [[InlineKeyboardButton(f"📁 {g['name']}", callback_data=f'listsrv_{g["id"]}')] for g in groups]
     kb.append([InlineKeyboardButton("📄 سرورهای بدون گروه", callback_data='listsrv_0')])
     kb.append([InlineKeyboardButton("🔙 منوی اصلی", callback_data='main_menu')])
@@ -1852,7 +3126,7 @@ async def show_servers(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try: await update.callback_query.answer()
     except: pass
     uid, data = update.effective_user.id, update.callback_query.data
-    servers = db.get_all_user_servers(uid) if data == 'list_all' else db.get_servers_by_group(uid, int(data.split('_')[1]))
+    servers = await (adb.read(db.get_all_user_servers, uid) if data == 'list_all' else adb.read(db.get_servers_by_group, uid, int(data.split('_')[1])))
     if not servers: 
         try: await update.callback_query.answer("⚠️ این پوشه خالی است!", show_alert=True)
         except: pass
@@ -1880,7 +3154,7 @@ async def status_dashboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("🔄 **در حال دریافت اطلاعات سرورها...**")
 
     user_id = update.effective_user.id
-    servers = db.get_all_user_servers(user_id)
+    servers = await adb.read(db.get_all_user_servers, user_id)
     if not servers:
         msg = "📂 **سروری یافت نشد!**\nابتدا یک سرور اضافه کنید."
         if update.callback_query: 
@@ -1889,29 +3163,34 @@ async def status_dashboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
              await update.message.reply_text(msg, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data='main_menu')]]))
         return
     
-    loop = asyncio.get_running_loop()
     tasks = []
     for s in servers:
         if s['is_active']:
-            tasks.append(loop.run_in_executor(None, ServerMonitor.check_full_stats, s['ip'], s['port'], s['username'], sec.decrypt(s['password'])))
+            # از آخرین نتیجه مانیتور؛ فقط سرورهای بدون داده منتظر پروب (از مسیر Circuit Breaker) می‌مانند
+            tasks.append(SNAPSHOTS.fetch(s))
         else:
-            async def fake(): return {'status': 'Disabled', 'uptime_sec': -1, 'traffic_gb': 0}
+            async def fake(): return ProbeResult(status='Disabled', uptime_sec=-1, traffic_gb=0)
             tasks.append(fake())
     
     results = await asyncio.gather(*tasks)
-    txt = f"📊 **داشبورد وضعیت شبکه** 🦇\n📆 `{get_jalali_str()}`\n➖➖➖➖➖➖➖➖➖➖\n\n"
-    active_count = sum(1 for r in results if isinstance(r, dict) and r['status'] == 'Online')
+    ages = [SNAPSHOTS.age(s['id']) for s in servers if s['is_active']]
+    oldest = max([a for a in ages if a is not None], default=0)
+    txt = f"📊 **داشبورد وضعیت شبکه** 🦇\n📆 `{get_jalali_str()}`\n🕒 قدیمی‌ترین داده: `{int(oldest)} ثانیه پیش`\n➖➖➖➖➖➖➖➖➖➖\n\n"
+    active_count = sum(1 for r in results if isinstance(r, ProbeResult) and r['status'] == 'Online')
     txt += f"🟢 **سرورهای آنلاین:** `{active_count}`\n🔴 **آفلاین/خاموش:** `{len(servers) - active_count}`\n\n"
     
     for i, res in enumerate(results):
-        final_res = res if isinstance(res, dict) else await res
+        final_res = res if isinstance(res, ProbeResult) else await res
         srv_name = servers[i]['name']
         if final_res['status'] == 'Disabled': txt += f"⚪️ **{srv_name}** ⇽ 💤 (خاموش)\n"
-        elif final_res['status'] == 'Offline': txt += f"🔴 **{srv_name}** ⇽ ⛔️ **OFFLINE**\n"
+        elif final_res['status'] == 'Offline':
+            txt += f"🔴 **{srv_name}** ⇽ ⛔️ **OFFLINE**\n"
+            breaker = HOST_BREAKER.describe((servers[i]['ip'], int(servers[i]['port'])))
+            if breaker: txt += f"   └ {breaker}\n"
         else:
             txt += (f"🟢 **{srv_name}**\n"
                 f"   ├ ⏱ `{final_res['uptime_str']}`\n"
-                f"   ├ 📡 Traf: `{final_res['traffic_gb']} GB`\n"
+                f"   ├ 📡 Traf: `{final_res['traffic_gb']} GB`  ⬇️ `{ServerMonitor.format_rate(final_res.get('net_rx_bps'))}` ⬆️ `{ServerMonitor.format_rate(final_res.get('net_tx_bps'))}`\n"
                 f"   └ 💻 CPU: `{final_res['cpu']}%`  RAM: `{final_res['ram']}%`\n\n")
     
     kb = [[InlineKeyboardButton("⚡️ مدیریت سرورها", callback_data='manage_servers_list')], [InlineKeyboardButton("🔄 بروزرسانی", callback_data='status_dashboard')], [InlineKeyboardButton("🔙 منوی اصلی", callback_data='main_menu')]]
@@ -1929,14 +3208,12 @@ async def server_detail(update: Update, context: ContextTypes.DEFAULT_TYPE, cust
     else:
         return
 
-    srv = db.get_server_by_id(sid)
+    srv = await adb.read(db.get_server_by_id, sid)
     if not srv: return
     
-    await safe_edit_message(update, f"⚡️ **در حال پردازش اطلاعات سرور {srv['name']}...**")
-    
     user_id = update.effective_user.id
-    user = db.get_user(user_id)
-    is_premium = True if user['plan_type'] == 1 or user_id == SUPER_ADMIN_ID else False
+    user = await adb.read(db.get_user, user_id)
+    is_premium = user.is_premium
     
     # دکمه پاکسازی دیسک جایگزین ترمینال شد
     btn_clean = InlineKeyboardButton("🧹 پاکسازی دیسک", callback_data=f'act_cleandisk_{sid}')
@@ -1946,10 +3223,72 @@ async def server_detail(update: Update, context: ContextTypes.DEFAULT_TYPE, cust
     else:
         btn_script = InlineKeyboardButton("🔒 اسکریپت", callback_data=f'act_installscript_{sid}')
 
-    res = await asyncio.get_running_loop().run_in_executor(
-        None, ServerMonitor.check_full_stats, srv['ip'], srv['port'], srv['username'], sec.decrypt(srv['password'])
-    )
-    
+    kb = [
+        [
+            InlineKeyboardButton("📊 نمودار", callback_data=f'act_chart_{sid}'),
+            InlineKeyboardButton("🔄 تازه‌سازی", callback_data=f'detail_{sid}')
+        ],
+        [
+            InlineKeyboardButton("🌍 بررسی وضعیت جهانی", callback_data=f'act_checkhost_{sid}_{srv["ip"]}'),
+            InlineKeyboardButton("🏢 دیتاسنتر", callback_data=f'act_datacenter_{sid}')
+        ],
+        [
+            InlineKeyboardButton("📝 گزارش جامع جهانی", callback_data=f'act_fullreport_{sid}')
+        ],
+        [
+            InlineKeyboardButton("🚀 تست سرعت", callback_data=f'act_speedtest_{sid}'),
+            InlineKeyboardButton("🧹 پاکسازی RAM", callback_data=f'act_clearcache_{sid}')
+        ],
+        [
+            InlineKeyboardButton("⚙️ DNS", callback_data=f'act_dns_{sid}'),
+            InlineKeyboardButton("📥 نصب Speedtest", callback_data=f'act_installspeed_{sid}')
+        ],
+        [
+            InlineKeyboardButton("📦 بروزرسانی Repo", callback_data=f'act_repoupdate_{sid}'),
+            InlineKeyboardButton("💎 ارتقاء کامل", callback_data=f'act_fullupdate_{sid}')
+        ],
+        [
+            InlineKeyboardButton("📅 ویرایش انقضا", callback_data=f'act_editexpiry_{sid}'),
+            InlineKeyboardButton("⚠️ راه‌اندازی مجدد", callback_data=f'act_reboot_{sid}')
+        ],
+        [btn_clean, btn_script],
+        [InlineKeyboardButton("❌ حذف سرور", callback_data=f'act_del_{sid}')],
+        [InlineKeyboardButton("🔙 بازگشت به لیست", callback_data='list_groups_for_servers')]
+    ]
+
+    # فاز اول: رندر فوری از آخرین داده (با برچسب سن داده)
+    cached = SNAPSHOTS.get(srv['id'])
+    if cached:
+        txt = build_server_detail_text(srv, cached, SNAPSHOTS.age(srv['id']))
+    else:
+        txt = f"⚡️ **در حال پردازش اطلاعات سرور {srv['name']}...**"
+
+    if update.callback_query:
+        await safe_edit_message(update, txt, reply_markup=InlineKeyboardMarkup(kb))
+        target = update.callback_query.message
+    else:
+        target = await update.message.reply_text(txt, reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
+
+    # فاز دوم: پروب زنده در پس‌زمینه و ویرایش همان پیام؛ تپ تکراری به همان پروب می‌پیوندد
+    edit_key = (target.chat_id, target.message_id)
+    if edit_key in DETAIL_LIVE_EDITS: return
+    DETAIL_LIVE_EDITS.add(edit_key)
+    probe = SNAPSHOTS.refresh(srv)
+
+    async def live_edit():
+        try:
+            res = await probe
+            await adb.write(db.update_status, srv['id'], "Online" if res['status'] == 'Online' else "Offline")
+            await target.edit_text(build_server_detail_text(srv, res), reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
+        except BadRequest: pass
+        except Exception as e: logger.error(f"Detail Refresh Error: {e}")
+        finally:
+            DETAIL_LIVE_EDITS.discard(edit_key)
+
+    context.application.create_task(live_edit())
+
+def build_server_detail_text(srv, res, age=None):
+    """متن جزئیات سرور؛ age (ثانیه) یعنی داده از کش است و بروزرسانی زنده در راه است"""
     expiry_display = "♾ **نامحدود (همیشگی)**"
     status_expiry = "✅"
     
@@ -1988,41 +3327,7 @@ async def server_detail(update: Update, context: ContextTypes.DEFAULT_TYPE, cust
             f"   ╰ (معادل **{equiv_days}** روز فعالیت 🔥)"
         )
 
-    kb = [
-        [
-            InlineKeyboardButton("📊 نمودار", callback_data=f'act_chart_{sid}'),
-            InlineKeyboardButton("🔄 تازه‌سازی", callback_data=f'detail_{sid}')
-        ],
-        [
-            InlineKeyboardButton("🌍 بررسی وضعیت جهانی", callback_data=f'act_checkhost_{sid}_{srv["ip"]}'),
-            InlineKeyboardButton("🏢 دیتاسنتر", callback_data=f'act_datacenter_{sid}')
-        ],
-        [
-            InlineKeyboardButton("📝 گزارش جامع جهانی", callback_data=f'act_fullreport_{sid}')
-        ],
-        [
-            InlineKeyboardButton("🚀 تست سرعت", callback_data=f'act_speedtest_{sid}'),
-            InlineKeyboardButton("🧹 پاکسازی RAM", callback_data=f'act_clearcache_{sid}')
-        ],
-        [
-            InlineKeyboardButton("⚙️ DNS", callback_data=f'act_dns_{sid}'),
-            InlineKeyboardButton("📥 نصب Speedtest", callback_data=f'act_installspeed_{sid}')
-        ],
-        [
-            InlineKeyboardButton("📦 بروزرسانی Repo", callback_data=f'act_repoupdate_{sid}'),
-            InlineKeyboardButton("💎 ارتقاء کامل", callback_data=f'act_fullupdate_{sid}')
-        ],
-        [
-            InlineKeyboardButton("📅 ویرایش انقضا", callback_data=f'act_editexpiry_{sid}'),
-            InlineKeyboardButton("⚠️ راه‌اندازی مجدد", callback_data=f'act_reboot_{sid}')
-        ],
-        [btn_clean, btn_script],
-        [InlineKeyboardButton("❌ حذف سرور", callback_data=f'act_del_{sid}')],
-        [InlineKeyboardButton("🔙 بازگشت به لیست", callback_data='list_groups_for_servers')]
-    ]
-
     if res['status'] == 'Online':
-        db.update_status(sid, "Online")
         cpu_emoji = "🟢" if res['cpu'] < 50 else "🟡" if res['cpu'] < 80 else "🔴"
         ram_emoji = "🟢" if res['ram'] < 50 else "🟡" if res['ram'] < 80 else "🔴"
         disk_emoji = "💿" if res['disk'] < 80 else "⚠️"
@@ -2036,6 +3341,9 @@ async def server_detail(update: Update, context: ContextTypes.DEFAULT_TYPE, cust
             f"{uptime_display}\n\n"
             f"🌐 **IP:** `{srv['ip']}`\n"
             f"📡 **ترافیک:** `{res['traffic_gb']} GB`\n"
+            f"📶 **شبکه:** ⬇️ `{ServerMonitor.format_rate(res.get('net_rx_bps'))}` ⬆️ `{ServerMonitor.format_rate(res.get('net_tx_bps'))}`\n"
+            f"💽 **دیسک I/O:** 📖 `{ServerMonitor.format_rate(res.get('disk_read_bps'))}` ✍️ `{ServerMonitor.format_rate(res.get('disk_write_bps'))}`\n"
+            f"⏱ **بازه پایش:** `{MONITOR_POLICY.interval_of(srv['id'])} ثانیه`\n"
             f"━━━━━━━━━━━━━━━━━━\n"
             f"📊 **منابع:**\n\n"
             f"{cpu_emoji} **CPU:** `{res['cpu']}%`\n"
@@ -2046,7 +3354,6 @@ async def server_detail(update: Update, context: ContextTypes.DEFAULT_TYPE, cust
             f"`{ServerMonitor.make_bar(res['disk'], length=15)}`"
         )
     else:
-        db.update_status(sid, "Offline")
         txt = (
             f"🔴 **{srv['name']}** `[آفلاین]`\n"
             f"━━━━━━━━━━━━━━━━━━\n"
@@ -2056,25 +3363,28 @@ async def server_detail(update: Update, context: ContextTypes.DEFAULT_TYPE, cust
             f"2. آیا IP ربات مسدود شده؟\n"
             f"3. آیا پورت SSH تغییر کرده است؟\n\n"
             f"📅 **انقضا:**\n`{expiry_display}`\n\n"
+            f"⏱ **بازه پایش:** `{MONITOR_POLICY.interval_of(srv['id'])} ثانیه`\n\n"
             f"❌ **خطا:**\n`{res['error']}`"
         )
-        
-    await safe_edit_message(update, txt, reply_markup=InlineKeyboardMarkup(kb))
+
+    if age is not None:
+        txt += f"\n\n🕒 _داده {int(age)} ثانیه پیش — در حال بروزرسانی..._"
+    return txt
 
 async def server_actions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     data = update.callback_query.data
     parts = data.split('_')
     act, sid = parts[1], parts[2]
     
-    srv = db.get_server_by_id(sid)
+    srv = await adb.read(db.get_server_by_id, sid)
     if not srv:
         try: await update.callback_query.answer("❌ سرور یافت نشد!", show_alert=True)
         except: pass
         return
 
     uid = update.effective_user.id
-    user = db.get_user(uid)
-    is_premium = True if user['plan_type'] == 1 or uid == SUPER_ADMIN_ID else False
+    user = await adb.read(db.get_user, uid)
+    is_premium = user.is_premium
     
     LOCKED_FEATURES = ['installscript'] 
 
@@ -2091,7 +3401,7 @@ async def server_actions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     loop = asyncio.get_running_loop()
     
     if act == 'del':
-        db.delete_server(sid, update.effective_user.id)
+        await adb.write(db.delete_server, sid, update.effective_user.id)
         try: await update.callback_query.answer("✅ سرور با موفقیت حذف شد.")
         except: pass
         await list_groups_for_servers(update, context)
@@ -2113,8 +3423,8 @@ async def server_actions(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "1️⃣ استعلام دیتاسنتر...\n"
             "2️⃣ پینگ جهانی (۱۰ ثانیه زمان می‌برد)..."
         )
-        task_dc = loop.run_in_executor(None, ServerMonitor.get_datacenter_info, srv['ip'])
-        task_ch = loop.run_in_executor(None, ServerMonitor.check_host_api, srv['ip'])
+        task_dc = coalesced_datacenter_info(srv['ip'])
+        task_ch = coalesced_host_check(srv['ip'])
         
         (dc_ok, dc_data), (ch_ok, ch_data) = await asyncio.gather(task_dc, task_ch)
         
@@ -2146,20 +3456,28 @@ async def server_actions(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.callback_query.message.reply_text(final_report, parse_mode='Markdown')
 
     elif act == 'chart':
+        range_key = parts[3] if len(parts) > 3 and parts[3] in CHART_RANGES else '24h'
+        range_kb = InlineKeyboardMarkup([[
+            InlineKeyboardButton(("✅ " if k == range_key else "") + k, callback_data=f'act_chart_{sid}_{k}') for k in CHART_RANGES
+        ]])
         await update.callback_query.message.reply_text("📊 **در حال ترسیم نمودار...**")
-        stats = await loop.run_in_executor(None, db.get_server_stats, sid)
+        since, source = CHART_RANGES[range_key]
+        if source == 'raw':
+            stats = await adb.read(db.get_server_stats, sid, since)
+        else:
+            stats = await adb.read(db.get_rollup_stats, sid, source, since)
         if not stats:
-            await update.callback_query.message.reply_text("❌ داده‌ای برای رسم نمودار موجود نیست.")
+            await update.callback_query.message.reply_text("❌ داده‌ای برای رسم نمودار موجود نیست.", reply_markup=range_kb)
             return
-        photo = await loop.run_in_executor(None, generate_plot, srv['name'], stats)
+        photo = await loop.run_in_executor(None, generate_plot, srv['name'], stats, range_key)
         if photo:
-            await update.callback_query.message.reply_photo(photo=photo, caption=f"📊 مصرف منابع: **{srv['name']}**")
+            await update.callback_query.message.reply_photo(photo=photo, caption=f"📊 مصرف منابع: **{srv['name']}** ({range_key})", reply_markup=range_kb)
         else:
             await update.callback_query.message.reply_text("❌ خطا در تولید تصویر نمودار.")
 
     elif act == 'datacenter':
         await update.callback_query.message.reply_text("🔍 **در حال استعلام...**")
-        ok, data = await loop.run_in_executor(None, ServerMonitor.get_datacenter_info, srv['ip'])
+        ok, data = await coalesced_datacenter_info(srv['ip'])
         if ok:
             txt = (
                 f"🏢 **مشخصات دیتاسنتر:**\n"
@@ -2175,7 +3493,7 @@ async def server_actions(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif act == 'checkhost':
         await update.callback_query.message.reply_text("🌍 **در حال دریافت گزارش Check-Host...**")
-        ok, data = await loop.run_in_executor(None, ServerMonitor.check_host_api, parts[3])
+        ok, data = await coalesced_host_check(parts[3])
         report = ServerMonitor.format_check_host_results(data) if ok else f"❌ خطا: {data}"
         await update.callback_query.message.reply_text(report, parse_mode='Markdown')
 
@@ -2210,7 +3528,7 @@ async def server_actions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif act == 'clearcache':
         try: await update.callback_query.answer("🧹 کش رم پاکسازی شد.")
         except: pass
-        await loop.run_in_executor(None, ServerMonitor.clear_cache, srv['ip'], srv['port'], srv['username'], real_pass)
+        await TASK_EXECUTOR.run(srv['ip'], ServerMonitor.clear_cache, srv['ip'], srv['port'], srv['username'], real_pass)
         await server_detail(update, context)
     
     elif act == 'cleandisk':
@@ -2223,7 +3541,7 @@ async def server_actions(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "- فایل‌های موقت (Tmp)\n\n"
             "⏳ لطفاً صبر کنید..."
         )
-        ok, result = await loop.run_in_executor(None, ServerMonitor.clean_disk_space, srv['ip'], srv['port'], srv['username'], real_pass)
+        ok, result = await TASK_EXECUTOR.run(srv['ip'], ServerMonitor.clean_disk_space, srv['ip'], srv['port'], srv['username'], real_pass)
         if ok:
             await update.callback_query.message.reply_text(f"✅ **پاکسازی با موفقیت انجام شد.**\n💾 فضای آزاد شده: `{result:.2f} MB`", parse_mode='Markdown')
         else:
@@ -2251,14 +3569,14 @@ async def send_global_full_report_action(update: Update, context: ContextTypes.D
     query = update.callback_query
     uid = update.effective_user.id
     
-    channels = db.get_user_channels(uid)
+    channels = await adb.read(db.get_user_channels, uid)
     if not channels:
         try: await query.answer("❌ ابتدا کانالی برای ارسال گزارش ثبت کنید!", show_alert=True)
         except BadRequest: pass 
         return
 
-    user = db.get_user(uid)
-    is_premium = True if user['plan_type'] == 1 or uid == SUPER_ADMIN_ID else False
+    user = await adb.read(db.get_user, uid)
+    is_premium = user.is_premium
     limit = 20 if is_premium else 3
     
     today_str = datetime.now().strftime('%Y-%m-%d')
@@ -2278,7 +3596,7 @@ async def send_global_full_report_action(update: Update, context: ContextTypes.D
 
     loading_msg = await query.message.reply_text("⏳ **در حال آنالیز تک‌تک سرورها و ارسال به کانال...**\nلطفاً صبر کنید.")
     
-    servers = db.get_all_user_servers(uid)
+    servers = await adb.read(db.get_all_user_servers, uid)
     active_servers = [s for s in servers if s['is_active']]
     
     if not active_servers:
@@ -2288,7 +3606,6 @@ async def send_global_full_report_action(update: Update, context: ContextTypes.D
     user_usage['count'] += 1
     DAILY_REPORT_USAGE[uid] = user_usage
     
-    loop = asyncio.get_running_loop()
     sent_count = 0
 
     header = f"📣 **گزارش وضعیت فوری شبکه**\n📅 زمان: `{get_jalali_str()}`\n👤 کاربر: {user['full_name']}\n➖➖➖➖➖➖➖➖➖➖"
@@ -2298,8 +3615,8 @@ async def send_global_full_report_action(update: Update, context: ContextTypes.D
 
     for srv in active_servers:
         try:
-            task_ssh = loop.run_in_executor(None, ServerMonitor.check_full_stats, srv['ip'], srv['port'], srv['username'], sec.decrypt(srv['password']))
-            task_dc = loop.run_in_executor(None, ServerMonitor.get_datacenter_info, srv['ip'])
+            task_ssh = SNAPSHOTS.fetch(srv)
+            task_dc = coalesced_datacenter_info(srv['ip'])
             
             ssh_res, (dc_ok, dc_data) = await asyncio.gather(task_ssh, task_dc)
             
@@ -2347,34 +3664,33 @@ async def send_global_full_report_action(update: Update, context: ContextTypes.D
 
 async def set_dns_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
     sid = update.callback_query.data.split('_')[2]
-    srv = db.get_server_by_id(sid)
+    srv = await adb.read(db.get_server_by_id, sid)
     await update.callback_query.message.reply_text("⚙️ **Applying DNS...**")
-    ok, out = await asyncio.get_running_loop().run_in_executor(None, ServerMonitor.set_dns, srv['ip'], srv['port'], srv['username'], sec.decrypt(srv['password']), update.callback_query.data.split('_')[1])
+    ok, out = await TASK_EXECUTOR.run(srv['ip'], ServerMonitor.set_dns, srv['ip'], srv['port'], srv['username'], sec.decrypt(srv['password']), update.callback_query.data.split('_')[1])
     await update.callback_query.message.reply_text("✅ Done" if ok else f"❌ {out}")
 
 async def send_instant_channel_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user_id = update.effective_user.id
     
-    channels = db.get_user_channels(user_id)
+    channels = await adb.read(db.get_user_channels, user_id)
     if not channels:
         try: await query.answer("❌ ابتدا یک کانال ثبت کنید!", show_alert=True)
         except: pass
         return
 
     loading_msg = await query.message.reply_text("⏳ **در حال جمع‌آوری و مرتب‌سازی اطلاعات...**")
-    servers = db.get_all_user_servers(user_id)
+    servers = await adb.read(db.get_all_user_servers, user_id)
     active_servers = [s for s in servers if s['is_active']]
     
     if not active_servers:
         await loading_msg.edit_text("❌ هیچ سرور فعالی ندارید.")
         return
 
-    loop = asyncio.get_running_loop()
     tasks = []
     for srv in active_servers:
-        ssh_task = loop.run_in_executor(None, ServerMonitor.check_full_stats, srv['ip'], srv['port'], srv['username'], sec.decrypt(srv['password']))
-        ping_task = loop.run_in_executor(None, ServerMonitor.check_host_api, srv['ip'])
+        ssh_task = SNAPSHOTS.fetch(srv)
+        ping_task = coalesced_host_check(srv['ip'])
         tasks.append(asyncio.gather(ssh_task, ping_task))
 
     results = await asyncio.gather(*tasks)
@@ -2445,15 +3761,15 @@ async def send_instant_channel_report(update: Update, context: ContextTypes.DEFA
 async def manage_servers_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try: await update.callback_query.answer()
     except: pass
-    servers = db.get_all_user_servers(update.effective_user.id)
+    servers = await adb.read(db.get_all_user_servers, update.effective_user.id)
     kb = [[InlineKeyboardButton(f"{'🟢' if s['is_active'] else '🔴'} | {s['name']}", callback_data=f'toggle_active_{s["id"]}')] for s in servers]
     kb.append([InlineKeyboardButton("🔙 بازگشت", callback_data='status_dashboard')])
     await safe_edit_message(update, "🛠 **مدیریت مانیتورینگ:**\nبا کلیک روی هر سرور، مانیتورینگ آن را روشن/خاموش کنید.", reply_markup=InlineKeyboardMarkup(kb))
 
 async def toggle_server_active_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
     sid = int(update.callback_query.data.split('_')[2])
-    srv = db.get_server_by_id(sid)
-    db.toggle_server_active(sid, srv['is_active'])
+    srv = await adb.read(db.get_server_by_id, sid)
+    await adb.write(db.toggle_server_active, sid, srv['is_active'])
     try: await update.callback_query.answer(f"وضعیت {srv['name']} تغییر کرد.")
     except: pass
     await manage_servers_list(update, context)
@@ -2467,8 +3783,7 @@ async def manual_ping_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def perform_manual_ping(update: Update, context: ContextTypes.DEFAULT_TYPE):
     host = update.message.text
     msg = await update.message.reply_text("🌍 **در حال استعلام از Check-Host...**")
-    loop = asyncio.get_running_loop()
-    ok, data = await loop.run_in_executor(None, ServerMonitor.check_host_api, host)
+    ok, data = await coalesced_host_check(host)
     
     report = ServerMonitor.format_check_host_results(data) if ok else f"❌ خطا: {data}"
     await context.bot.send_message(chat_id=msg.chat_id, text=report, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 منوی اصلی", callback_data='main_menu')]]))
@@ -2517,13 +3832,13 @@ async def automation_settings_menu(update: Update, context: ContextTypes.DEFAULT
     uid = update.effective_user.id
     
     # دریافت وضعیت‌های فعلی برای نمایش در دکمه
-    cron_val = db.get_setting(uid, 'report_interval') or '0'
+    cron_val = await adb.read(db.get_setting, uid, 'report_interval') or '0'
     cron_status = "❌ خاموش" if cron_val == '0' else f"✅ هر {int(int(cron_val)/60)} دقیقه"
     
-    up_val = db.get_setting(uid, 'auto_update_hours') or '0'
+    up_val = await adb.read(db.get_setting, uid, 'auto_update_hours') or '0'
     up_status = "❌ خاموش" if up_val == '0' else f"✅ هر {up_val} ساعت"
     
-    reb_val = db.get_setting(uid, 'auto_reboot_config')
+    reb_val = await adb.read(db.get_setting, uid, 'auto_reboot_config')
     reb_status = "✅ فعال" if reb_val and reb_val != 'OFF' else "❌ خاموش"
 
     txt = (
@@ -2550,13 +3865,13 @@ async def monitoring_settings_menu(update: Update, context: ContextTypes.DEFAULT
     uid = update.effective_user.id
     
     # وضعیت هشدار قطعی
-    down_alert = db.get_setting(uid, 'down_alert_enabled') or '1'
+    down_alert = await adb.read(db.get_setting, uid, 'down_alert_enabled') or '1'
     alert_icon = "🔔 روشن" if down_alert == '1' else "🔕 خاموش"
     toggle_val = "0" if down_alert == "1" else "1"
     
     # وضعیت منابع
-    cpu_limit = db.get_setting(uid, 'cpu_threshold') or '80'
-    ram_limit = db.get_setting(uid, 'ram_threshold') or '80'
+    cpu_limit = await adb.read(db.get_setting, uid, 'cpu_threshold') or '80'
+    ram_limit = await adb.read(db.get_setting, uid, 'ram_threshold') or '80'
 
     txt = (
         "📟 **تنظیمات مانیتورینگ و هشدار**\n"
@@ -2576,7 +3891,7 @@ async def monitoring_settings_menu(update: Update, context: ContextTypes.DEFAULT
 
 async def channels_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    chans = db.get_user_channels(uid)
+    chans = await adb.read(db.get_user_channels, uid)
     
     type_map = {'all': '✅ همه', 'down': '🚨 قطعی', 'report': '📊 گزارش', 'expiry': '⏳ انقضا', 'resource': '🔥 منابع'}
     
@@ -2587,7 +3902,7 @@ async def channels_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def settings_cron_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    current_val = db.get_setting(uid, 'report_interval') or '0'
+    current_val = await adb.read(db.get_setting, uid, 'report_interval') or '0'
     def get_label(text, value): return f"✅ {text}" if str(value) == str(current_val) else text
     kb = [
         [InlineKeyboardButton(get_label("30m", 1800), callback_data='setcron_1800'), InlineKeyboardButton(get_label("60m", 3600), callback_data='setcron_3600')],
@@ -2597,7 +3912,7 @@ async def settings_cron_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await safe_edit_message(update, "⏰ **بازه گزارش خودکار:**", reply_markup=InlineKeyboardMarkup(kb))
 
 async def set_cron_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    db.set_setting(update.effective_user.id, 'report_interval', int(update.callback_query.data.split('_')[1]))
+    await adb.write(db.set_setting, update.effective_user.id, 'report_interval', int(update.callback_query.data.split('_')[1]))
     try: await update.callback_query.answer("ذخیره شد.")
     except: pass
     await settings_cron_menu(update, context)
@@ -2610,9 +3925,9 @@ async def resource_settings_menu(update: Update, context: ContextTypes.DEFAULT_T
         try: await update.callback_query.answer()
         except: pass
     
-    cpu_limit = db.get_setting(uid, 'cpu_threshold') or '80'
-    ram_limit = db.get_setting(uid, 'ram_threshold') or '80'
-    disk_limit = db.get_setting(uid, 'disk_threshold') or '90'
+    cpu_limit = await adb.read(db.get_setting, uid, 'cpu_threshold') or '80'
+    ram_limit = await adb.read(db.get_setting, uid, 'ram_threshold') or '80'
+    disk_limit = await adb.read(db.get_setting, uid, 'disk_threshold') or '90'
     
     txt = (
         "🎚 **تنظیم آستانه حساسیت (Thresholds)**\n"
@@ -2633,7 +3948,7 @@ async def resource_settings_menu(update: Update, context: ContextTypes.DEFAULT_T
     
     await safe_edit_message(update, txt, reply_markup=InlineKeyboardMarkup(kb))
 async def toggle_down_alert(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    db.set_setting(update.effective_user.id, 'down_alert_enabled', update.callback_query.data.split('_')[2])
+    await adb.write(db.set_setting, update.effective_user.id, 'down_alert_enabled', update.callback_query.data.split('_')[2])
     await monitoring_settings_menu(update, context)
 
 async def ask_cpu_limit(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2644,7 +3959,7 @@ async def save_cpu_limit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         val = int(update.message.text)
         if 1 <= val <= 100:
-            db.set_setting(update.effective_user.id, 'cpu_threshold', val)
+            await adb.write(db.set_setting, update.effective_user.id, 'cpu_threshold', val)
             await update.message.reply_text(f"✅ ذخیره شد: {val}%")
             await resource_settings_menu(update, context)
             return ConversationHandler.END
@@ -2660,7 +3975,7 @@ async def save_ram_limit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         val = int(update.message.text)
         if 1 <= val <= 100:
-            db.set_setting(update.effective_user.id, 'ram_threshold', val)
+            await adb.write(db.set_setting, update.effective_user.id, 'ram_threshold', val)
             await update.message.reply_text(f"✅ ذخیره شد: {val}%")
             await resource_settings_menu(update, context)
             return ConversationHandler.END
@@ -2676,7 +3991,7 @@ async def save_disk_limit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         val = int(update.message.text)
         if 1 <= val <= 100:
-            db.set_setting(update.effective_user.id, 'disk_threshold', val)
+            await adb.write(db.set_setting, update.effective_user.id, 'disk_threshold', val)
             await update.message.reply_text(f"✅ ذخیره شد: {val}%")
             await resource_settings_menu(update, context)
             return ConversationHandler.END
@@ -2692,7 +4007,7 @@ async def set_custom_interval_action(update: Update, context: ContextTypes.DEFAU
     try:
         minutes = int(update.message.text)
         if 10 <= minutes <= 1440:
-            db.set_setting(update.effective_user.id, 'report_interval', minutes * 60)
+            await adb.write(db.set_setting, update.effective_user.id, 'report_interval', minutes * 60)
             await update.message.reply_text(f"✅ تنظیم شد: هر {minutes} دقیقه.")
             await settings_cron_menu(update, context)
             return ConversationHandler.END
@@ -2768,13 +4083,13 @@ async def set_channel_type_action(update: Update, context: ContextTypes.DEFAULT_
     except: pass
     usage = query.data.split('_')[1]
     cdata = context.user_data['new_chan']
-    db.add_channel(update.effective_user.id, cdata['id'], cdata['name'], usage)
+    await adb.write(db.add_channel, update.effective_user.id, cdata['id'], cdata['name'], usage)
     await query.message.reply_text(f"✅ کانال {cdata['name']} ثبت شد.")
     await channels_menu(update, context)
     return ConversationHandler.END
 
 async def delete_channel_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    db.delete_channel(int(update.callback_query.data.split('_')[1]), update.effective_user.id)
+    await adb.write(db.delete_channel, int(update.callback_query.data.split('_')[1]), update.effective_user.id)
     await channels_menu(update, context)
 
 async def edit_expiry_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2783,7 +4098,7 @@ async def edit_expiry_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except: pass
     sid = query.data.split('_')[2]
     context.user_data['edit_expiry_sid'] = sid
-    srv = db.get_server_by_id(sid)
+    srv = await adb.read(db.get_server_by_id, sid)
     txt = (
         f"📅 **تغییر زمان انقضای سرور: {srv['name']}**\n\n"
         f"🔢 لطفاً **تعداد روزهای باقی‌مانده** را به عدد وارد کنید.\n"
@@ -2803,7 +4118,7 @@ async def edit_expiry_save(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             new_date = None
             msg = "✅ سرور با موفقیت **نامحدود (Lifetime)** شد."
-        db.update_server_expiry(sid, new_date)
+        await adb.write(db.update_server_expiry, sid, new_date)
         await update.message.reply_text(msg)
         await server_detail(update, context, custom_sid=sid)
         return ConversationHandler.END
@@ -2817,7 +4132,7 @@ async def ask_terminal_command(update: Update, context: ContextTypes.DEFAULT_TYP
     except: pass
     
     sid = query.data.split('_')[2]
-    srv = db.get_server_by_id(sid)
+    srv = await adb.read(db.get_server_by_id, sid)
     context.user_data['term_sid'] = sid 
     
     kb = [[InlineKeyboardButton("🔙 خروج و بازگشت به پنل", callback_data='exit_terminal')]]
@@ -2839,12 +4154,12 @@ async def run_terminal_action(update: Update, context: ContextTypes.DEFAULT_TYPE
         return await close_terminal_session(update, context)
 
     sid = context.user_data.get('term_sid')
-    srv = db.get_server_by_id(sid)
+    srv = await adb.read(db.get_server_by_id, sid)
     
     wait_msg = await update.message.reply_text(f"⚙️ `{cmd}` ...")
     
     real_pass = sec.decrypt(srv['password'])
-    ok, output = await asyncio.get_running_loop().run_in_executor(None, ServerMonitor.run_remote_command, srv['ip'], srv['port'], srv['username'], real_pass, cmd)
+    ok, output = await TASK_EXECUTOR.run(srv['ip'], ServerMonitor.run_remote_command, srv['ip'], srv['port'], srv['username'], real_pass, cmd)
     
     if not output: output = "[No Output]"
     if len(output) > 3000: output = output[:3000] + "\n..."
@@ -2877,134 +4192,502 @@ async def close_terminal_session(update: Update, context: ContextTypes.DEFAULT_T
 # ==============================================================================
 # ⏳ SCHEDULED JOBS
 # ==============================================================================
+async def stats_retention_job(context: ContextTypes.DEFAULT_TYPE):
+    """حذف دسته‌ای آمار خام قدیمی‌تر از STATS_RETENTION_DAYS و سطل‌های Rollup منقضی (جدا از مسیر نوشتن مانیتور)"""
+    deleted = await adb.write(db.prune_server_stats, STATS_RETENTION_DAYS, STATS_PRUNE_BATCH, exclusive=True) or 0
+    deleted += await adb.write(db.prune_rollups, STATS_PRUNE_BATCH, exclusive=True) or 0
+    if deleted:
+        logger.info(f"🧹 Stats retention: removed {deleted} old samples")
+
+async def stats_orphan_job(context: ContextTypes.DEFAULT_TYPE):
+    """حذف روزانه آمار سرورهایی که از دیتابیس اصلی حذف شده‌اند"""
+    deleted = await adb.write(db.prune_orphan_stats, exclusive=True)
+    if deleted:
+        logger.info(f"🧹 Stats cleanup: removed {deleted} samples of deleted servers")
+
+async def stats_rollup_job(context: ContextTypes.DEFAULT_TYPE):
+    """تجمیع افزایشی آمار خام در جداول ۵ دقیقه‌ای و ساعتی"""
+    try: await adb.write(db.rollup_server_stats, exclusive=True)
+    except Exception as e: logger.error(f"Stats Rollup Error: {e}")
+
 async def check_bonus_expiry_job(context: ContextTypes.DEFAULT_TYPE):
     """بررسی و حذف پاداش‌های منقضی شده"""
     now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     
-    # گرفتن پاداش‌های منقضی شده
-    with db.get_connection() as conn:
-        expired_bonuses = conn.execute("SELECT * FROM temp_bonuses WHERE expires_at < ?", (now_str,)).fetchall()
-        
-        for bonus in expired_bonuses:
-            uid = bonus['user_id']
-            amount = bonus['bonus_limit']
-            
-            # گرفتن کاربر برای کاهش لیمیت
-            user = conn.execute("SELECT server_limit FROM users WHERE user_id = ?", (uid,)).fetchone()
-            if user:
-                current_limit = user['server_limit']
-                new_limit = max(0, current_limit - amount) # جلوگیری از منفی شدن
-                
-                # کاهش لیمیت
-                conn.execute("UPDATE users SET server_limit = ? WHERE user_id = ?", (new_limit, uid))
-                
-                # اطلاع رسانی به کاربر
+    # اول تغییرات دیتابیس (بدون await داخل تراکنش)، بعد اطلاع رسانی
+    reduced = await adb.write(db.expire_bonuses, now_str)
+    for uid, new_limit in reduced:
+        try:
+            await context.bot.send_message(
+                chat_id=uid,
+                text=f"⚠️ **پایان مهلت پاداش دعوت**\n\nیکی از پاداش‌های ۱۰ روزه شما منقضی شد و ۱ عدد از ظرفیت سرور شما کسر گردید.\nظرفیت فعلی: {new_limit}"
+            )
+        except: pass
+
+async def ssh_pool_maintenance_job(context: ContextTypes.DEFAULT_TYPE):
+    """بستن اتصال‌های SSH بیکار در Pool، حذف نمونه‌های شمارنده قدیمی و ذخیره تاریخچه تاخیر"""
+    evicted = await asyncio.get_running_loop().run_in_executor(None, SSH_POOL.evict_idle)
+    METRIC_DELTAS.prune()
+    SINGLE_FLIGHT.prune()
+    rows = LATENCY.pop_dirty()
+    if rows: await adb.write(db.save_latency_history, rows)
+    if evicted:
+        logger.info(f"🔌 SSH pool: evicted {evicted} idle/dead sessions ({len(SSH_SESSION_CACHE)} alive)")
+
+class NotificationSender:
+    """ارسال همزمان پیام‌ها با سقف همزمانی و فاصله‌گذاری سراسری بین ارسال‌ها (RetryAfter یکبار تکرار می‌شود)"""
+    def __init__(self, concurrency, rate):
+        self.concurrency = concurrency
+        self.interval = 1.0 / rate
+        self.next_slot = 0.0
+
+    async def _wait_turn(self):
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        if slot > now: await asyncio.sleep(slot - now)
+
+    async def _send(self, bot, sem, chat_id, text):
+        async with sem:
+            for attempt in range(2):
+                await self._wait_turn()
                 try:
-                    await context.bot.send_message(
-                        chat_id=uid,
-                        text=f"⚠️ **پایان مهلت پاداش دعوت**\n\nیکی از پاداش‌های ۱۰ روزه شما منقضی شد و ۱ عدد از ظرفیت سرور شما کسر گردید.\nظرفیت فعلی: {new_limit}"
-                    )
-                except: pass
-            
-            # حذف از جدول پاداش‌ها
-            conn.execute("DELETE FROM temp_bonuses WHERE id = ?", (bonus['id'],))
-        
-        conn.commit()
+                    await bot.send_message(chat_id, text, parse_mode='Markdown')
+                    return True
+                except RetryAfter as e:
+                    delay = e.retry_after
+                    if isinstance(delay, timedelta): delay = delay.total_seconds()
+                    if attempt == 0: await asyncio.sleep(delay)
+                except Exception: return False
+            return False
+
+    async def send_all(self, bot, messages):
+        """messages: [(chat_id, text)]؛ تعداد ارسال‌های موفق را برمی‌گرداند"""
+        sem = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(*(self._send(bot, sem, chat_id, text) for chat_id, text in messages))
+        return sum(results)
+
+NOTIFY_SENDER = NotificationSender(NOTIFY_CONCURRENCY, NOTIFY_RATE)
+
 async def check_expiry_job(context: ContextTypes.DEFAULT_TYPE):
-    users = db.get_all_users()
+    """هشدار انقضای سرورها (۳ روز مانده و امروز) با یک کوئری ایندکس‌دار به جای پیمایش همه کاربران"""
     today = datetime.now().date()
-    for user in users:
-        uid = user['user_id']
-        servers = db.get_all_user_servers(uid)
-        user_channels = db.get_user_channels(uid)
-        target_channels = [c for c in user_channels if c.get('usage_type', 'all') in ['expiry', 'all']]
-        
-        for srv in servers:
-            if not srv['expiry_date']: continue
-            try:
-                exp_date = datetime.strptime(srv['expiry_date'], '%Y-%m-%d').date()
-                days_left = (exp_date - today).days
-                msg = None
-                if days_left == 3:
-                    msg = f"⚠️ **هشدار انقضا (۳ روز مانده)**\n\n🖥 سرور: `{srv['name']}`\n📅 اتمام: `{srv['expiry_date']}`\nلطفاً جهت تمدید اقدام کنید."
-                elif days_left == 0:
-                    msg = f"🚨 **هشدار نهایی (امروز تمام می‌شود)**\n\n🖥 سرور: `{srv['name']}`\nدارای انقضای امروز است!"
-                
-                if msg:
-                    try: await context.bot.send_message(uid, msg, parse_mode='Markdown')
-                    except: pass
-                    for ch in target_channels:
-                        try: await context.bot.send_message(ch['chat_id'], msg, parse_mode='Markdown')
-                        except: pass
-            except ValueError as e:
-                logger.error(f"Date format error for server {srv['id']}: {e}")
-            except Exception as e:
-                logger.error(f"Expiry Check Error: {e}")
+    today_str = today.strftime('%Y-%m-%d')
+    warn_str = (today + timedelta(days=3)).strftime('%Y-%m-%d')
+    rows = await adb.read(db.get_expiring_servers, (today_str, warn_str))
+
+    # هر سرور یکبار، با همه کانال‌های مقصدش
+    expiring = {}
+    for row in rows:
+        srv, chats = expiring.setdefault(row['id'], (row, []))
+        if row['chat_id']: chats.append(row['chat_id'])
+
+    messages = []
+    for srv, chats in expiring.values():
+        if srv['expiry_date'] == warn_str:
+            msg = f"⚠️ **هشدار انقضا (۳ روز مانده)**\n\n🖥 سرور: `{srv['name']}`\n📅 اتمام: `{srv['expiry_date']}`\nلطفاً جهت تمدید اقدام کنید."
+        else:
+            msg = f"🚨 **هشدار نهایی (امروز تمام می‌شود)**\n\n🖥 سرور: `{srv['name']}`\nدارای انقضای امروز است!"
+        messages.append((srv['owner_id'], msg))
+        messages.extend((chat_id, msg) for chat_id in chats)
+
+    if messages:
+        sent = await NOTIFY_SENDER.send_all(context.bot, messages)
+        logger.info(f"📅 Expiry notices: {len(expiring)} servers, {sent}/{len(messages)} messages sent")
+
+class FairProbeScheduler:
+    """صف سراسری پروب سرورها با سقف همزمانی واحد و نوبت‌دهی چرخشی بین مالکان"""
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+
+    @staticmethod
+    def round_robin(jobs_by_owner):
+        owners = deque((owner, deque(items)) for owner, items in jobs_by_owner.items() if items)
+        while owners:
+            owner, queue = owners.popleft()
+            yield owner, queue.popleft()
+            if queue: owners.append((owner, queue))
+
+    async def run(self, jobs_by_owner, probe, deadline=None, priority=None):
+        """اجرای probe برای سرورها (اول priority)؛ بعد از deadline پروب جدیدی شروع نمی‌شود.
+        خروجی: ({owner: {server_id: result}}, {owner: [سرورهای باقی‌مانده]})"""
+        priority = priority or {}
+        results = {owner: {} for owner in list(priority) + list(jobs_by_owner)}
+        order = itertools.chain(self.round_robin(priority), self.round_robin(jobs_by_owner))
+
+        async def worker():
+            while deadline is None or time.monotonic() < deadline:
+                item = next(order, None)
+                if item is None: return
+                owner, srv = item
+                try:
+                    results[owner][srv['id']] = await probe(srv)
+                except Exception as e:
+                    logger.error(f"Probe Error {srv['name']}: {e}")
+                    results[owner][srv['id']] = ProbeResult.offline(str(e)[:50])
+
+        total = sum(len(items) for items in priority.values()) + sum(len(items) for items in jobs_by_owner.values())
+        await asyncio.gather(*(worker() for _ in range(min(self.concurrency, total))))
+
+        leftover = {}
+        for owner, srv in order:
+            leftover.setdefault(owner, []).append(srv)
+        return results, leftover
+
+MONITOR_SCHEDULER = FairProbeScheduler(MONITOR_CONCURRENCY)
+
+class HostCircuitBreaker:
+    """مدار قطع‌کن هر هاست: closed (پروب عادی) ← open بعد از DOWN_RETRY_LIMIT خطا (بدون پروب تا پایان backoff)
+    ← half-open (یک پروب TCP ارزان؛ در صورت موفقیت پروب کامل SSH)"""
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, threshold, base_backoff, max_backoff):
+        self.threshold = threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.hosts = {}
+
+    def _get(self, key):
+        return self.hosts.setdefault(key, {'state': self.CLOSED, 'fails': 0, 'backoff': 0, 'retry_at': 0})
+
+    def allow(self, key):
+        """خروجی: ssh (پروب کامل)، tcp (پروب آزمایشی half-open) یا skip"""
+        st = self._get(key)
+        if st['state'] == self.CLOSED: return 'ssh'
+        if st['state'] == self.OPEN and time.time() >= st['retry_at']:
+            st['state'] = self.HALF_OPEN
+            return 'tcp'
+        return 'skip'
+
+    def record_success(self, key):
+        st = self._get(key)
+        if st['state'] != self.CLOSED:
+            logger.info(f"🔌 Circuit closed for {key[0]}:{key[1]}")
+        st.update(state=self.CLOSED, fails=0, backoff=0, retry_at=0)
+
+    def record_failure(self, key):
+        st = self._get(key)
+        st['fails'] += 1
+        if st['state'] == self.HALF_OPEN:
+            st['backoff'] = min(st['backoff'] * 2, self.max_backoff)
+        elif st['state'] == self.CLOSED and st['fails'] >= self.threshold:
+            st['backoff'] = self.base_backoff
+            logger.info(f"🔌 Circuit opened for {key[0]}:{key[1]} after {st['fails']} failures")
+        else:
+            return
+        st['state'] = self.OPEN
+        st['retry_at'] = time.time() + st['backoff']
+
+    def describe(self, key):
+        st = self.hosts.get(key)
+        if not st or st['state'] == self.CLOSED: return ""
+        if st['state'] == self.HALF_OPEN: return "🟠 مدار نیمه‌باز (در حال بررسی)"
+        wait = max(0, int(st['retry_at'] - time.time()))
+        return f"🔌 مدار باز (تلاش بعدی: {wait // 60}m {wait % 60}s)"
+
+    def prune(self, known):
+        for key in [key for key in self.hosts if key not in known]:
+            del self.hosts[key]
+
+HOST_BREAKER = HostCircuitBreaker(DOWN_RETRY_LIMIT, BREAKER_BASE_BACKOFF, BREAKER_MAX_BACKOFF)
+
+async def probe_server(s):
+    key = (s['ip'], int(s['port']))
+    if HOST_BREAKER.allow(key) == 'skip':
+        return ProbeResult.offline('Circuit open (host unreachable)')
+
+    # هر خروجی غیر از موفقیت (نتیجه آفلاین، Exception یا لغو task) خطا ثبت می‌شود؛
+    # وگرنه مدار در half-open با جایگاه آزمایشی اشغال‌شده می‌ماند و هاست دیگر پروب نمی‌شود
+    succeeded = False
+    try:
+        # پیش‌پرواز TCP (در حالت half-open همان پروب آزمایشی است): پورت بسته/بی‌پاسخ در چند میلی‌ثانیه رد می‌شود
+        ok, rtt, err = await ServerMonitor.tcp_preflight(s['ip'], s['port'])
+        if not ok:
+            return ProbeResult.offline(err)
+
+        res = await coalesced_full_stats(s['ip'], s['port'], s['username'], sec.decrypt(s['password']), rtt)
+        succeeded = res['status'] == 'Online'
+        return res
+    finally:
+        if succeeded: HOST_BREAKER.record_success(key)
+        else: HOST_BREAKER.record_failure(key)
+
+class SnapshotStore:
+    """آخرین نتیجه پروب هر سرور با زمان ثبت (stale-while-revalidate):
+    UI فوراً از آن رندر می‌شود و فقط داده کهنه‌تر از max_age در پس‌زمینه تازه می‌شود.
+    interval_of: بازه پایش فعلی هر سرور؛ داده‌ای که مانیتور هنوز موعد تازه کردنش نرسیده کهنه حساب نمی‌شود"""
+    def __init__(self, results, max_age, interval_of=None):
+        self.results = results
+        self.stamps = {}
+        self.inflight = {}
+        self.max_age = max_age
+        self.interval_of = interval_of
+
+    def max_age_of(self, sid):
+        if self.interval_of is None: return self.max_age
+        return max(self.max_age, self.interval_of(sid) + MONITOR_WHEEL_TICK)
+
+    def put(self, sid, res):
+        self.results[sid] = res
+        self.stamps[sid] = time.time()
+
+    def get(self, sid):
+        return self.results.get(sid)
+
+    def age(self, sid):
+        stamp = self.stamps.get(sid)
+        return None if stamp is None else time.time() - stamp
+
+    def refresh(self, srv):
+        """پروب پس‌زمینه؛ اگر پروبی برای این سرور در جریان است همان برگردانده می‌شود"""
+        sid = srv['id']
+        task = self.inflight.get(sid)
+        if task is None:
+            async def run():
+                try:
+                    res = await probe_server(srv)
+                    self.put(sid, res)
+                    return res
+                finally:
+                    self.inflight.pop(sid, None)
+            task = self.inflight[sid] = asyncio.create_task(run())
+        return task
+
+    async def fetch(self, srv, max_age=None):
+        res = self.get(srv['id'])
+        if res is None:
+            return await self.refresh(srv)
+        age = self.age(srv['id'])
+        if age is None or age > (self.max_age_of(srv['id']) if max_age is None else max_age):
+            self.refresh(srv)
+        return res
+
+    def prune(self, known):
+        for sid in [sid for sid in self.results if sid not in known]:
+            self.results.pop(sid, None)
+            self.stamps.pop(sid, None)
+
+SNAPSHOTS = SnapshotStore(LAST_PROBE_RESULTS, SNAPSHOT_MAX_AGE, lambda sid: MONITOR_POLICY.interval_of(sid))
+
+class PollingWheel:
+    """چرخ زمان‌بندی: هر سرور با هش شناسه‌اش یک اسلات ثابت در بازه DEFAULT_INTERVAL دارد"""
+    def __init__(self, interval, tick):
+        self.slots = max(1, int(interval // tick))
+        self.position = 0
+        self.owners = {}
+
+    def slot_of(self, sid):
+        # هش پایدار: افزودن/حذف یک سرور اسلات بقیه را جابجا نمی‌کند
+        return zlib.crc32(str(sid).encode()) % self.slots
+
+    def advance(self):
+        slot = self.position
+        self.position = (self.position + 1) % self.slots
+        return slot
+
+    def due_jobs(self, slot):
+        return {
+            uid: [s for s in servers if s['is_active'] and self.slot_of(s['id']) == slot]
+            for uid, (servers, _) in self.owners.items()
+        }
+
+MONITOR_WHEEL = PollingWheel(DEFAULT_INTERVAL, MONITOR_WHEEL_TICK)
+
+class AdaptivePollingPolicy:
+    """ضریب بازه پایش هر سرور (1, 2, 4, ...): سرور پایدار کم‌کم دیرتر و سرور ناپایدار فوراً با بازه پایه پروب می‌شود"""
+    def __init__(self, max_factor, stable_rounds, margin):
+        self.max_factor = max_factor
+        self.stable_rounds = stable_rounds
+        self.margin = margin
+        self.state = {}
+
+    def _get(self, sid):
+        return self.state.setdefault(sid, {'factor': 1, 'rounds': 0, 'streak': 0, 'status': None})
+
+    def due(self, sid):
+        # یکبار در هر دور چرخ (وقتی اسلات سرور فرا می‌رسد) صدا زده می‌شود
+        st = self._get(sid)
+        st['rounds'] += 1
+        return st['rounds'] >= st['factor']
+
+    def is_stable(self, res, settings):
+        if res.get('status') != 'Online': return False
+        return (
+            res.get('cpu', 0) < settings.cpu - self.margin and
+            res.get('ram', 0) < settings.ram - self.margin and
+            res.get('disk', 0) < settings.disk - self.margin
+        )
+
+    def observe(self, sid, res, settings):
+        st = self._get(sid)
+        st['rounds'] = 0
+        changed = st['status'] is not None and st['status'] != res.get('status')
+        st['status'] = res.get('status')
+
+        # عبور از آستانه، تغییر وضعیت یا خطا: بازگشت فوری به بازه پایه
+        if changed or not self.is_stable(res, settings):
+            st['factor'], st['streak'] = 1, 0
+            return
+        st['streak'] += 1
+        if st['streak'] >= self.stable_rounds:
+            st['factor'] = min(st['factor'] * 2, self.max_factor)
+            st['streak'] = 0
+
+    def interval_of(self, sid):
+        st = self.state.get(sid)
+        return DEFAULT_INTERVAL * (st['factor'] if st else 1)
+
+    def prune(self, known):
+        for sid in [sid for sid in self.state if sid not in known]:
+            del self.state[sid]
+
+MONITOR_POLICY = AdaptivePollingPolicy(ADAPTIVE_MAX_FACTOR, ADAPTIVE_STABLE_ROUNDS, ADAPTIVE_THRESHOLD_MARGIN)
+
+class MonitorTickGuard:
+    """جلوگیری از همپوشانی تیک‌ها، ادغام تیک‌های جامانده و انتقال سرورهای پروب نشده به تیک بعد"""
+    def __init__(self, budget):
+        self.budget = budget
+        self.running = False
+        self.missed = 0
+        self.total_skipped = 0
+        self.carryover = {}
+        self.last_duration = 0.0
+        self.lag = 0.0
+        self.lag_warned = False
+
+    def record_leftover(self, leftover, now):
+        carry = {}
+        for uid, items in leftover.items():
+            for srv in items:
+                prev = self.carryover.get(srv['id'])
+                carry[srv['id']] = (uid, srv, prev[2] if prev else now)
+        self.carryover = carry
+        self.lag = now - min(v[2] for v in carry.values()) if carry else 0.0
+
+        # اگر عقب‌ماندگی از یک دور کامل بیشتر شد، ناوگان از بازه پایش بزرگ‌تر شده است
+        if self.lag > DEFAULT_INTERVAL and not self.lag_warned:
+            logger.warning(f"⏱ Monitor lag {self.lag:.0f}s ({len(carry)} servers pending): fleet has outgrown the {DEFAULT_INTERVAL}s interval")
+            self.lag_warned = True
+        elif self.lag <= DEFAULT_INTERVAL:
+            self.lag_warned = False
+
+MONITOR_TICK_GUARD = MonitorTickGuard(MONITOR_TICK_BUDGET)
+
+class StatsBuffer:
+    """بافر نمونه‌های server_stats در طول یک تیک مانیتور"""
+    def __init__(self):
+        self.rows = []
+
+    def add(self, server_id, cpu, ram, rtt=None):
+        self.rows.append((server_id, cpu, ram, rtt, datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')))
+
+    def drain(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+STATS_BUFFER = StatsBuffer()
 
 async def global_monitor_job(context: ContextTypes.DEFAULT_TYPE):
-    # --- اصلاح شده: اجرای سبک‌تر و جلوگیری از هنگ کردن ---
-    loop = asyncio.get_running_loop()
-    users_list = await loop.run_in_executor(None, db.get_all_users)
-    all_users = set([u['user_id'] for u in users_list] + [SUPER_ADMIN_ID])
-    
-    # محدودیت: فقط ۱۰ سرور همزمان چک شوند
-    semaphore = asyncio.Semaphore(10) 
-
-    async def protected_process(uid):
-        async with semaphore:
-            servers = await loop.run_in_executor(None, db.get_all_user_servers, uid)
-            if not servers: return
-
-            def get_user_settings():
-                return {
-                    'report_interval': db.get_setting(uid, 'report_interval'),
-                    'cpu': int(db.get_setting(uid, 'cpu_threshold') or 80),
-                    'ram': int(db.get_setting(uid, 'ram_threshold') or 80),
-                    'disk': int(db.get_setting(uid, 'disk_threshold') or 90),
-                    'down_alert': db.get_setting(uid, 'down_alert_enabled') == '1'
-                }
-            settings = await loop.run_in_executor(None, get_user_settings)
-            
-            await process_single_user(context, uid, servers, settings, loop)
+    """هر MONITOR_WHEEL_TICK ثانیه فقط سرورهای اسلات جاری پروب می‌شوند (بار یکنواخت)"""
+    guard = MONITOR_TICK_GUARD
+    if guard.running:
+        # تیک قبلی هنوز تمام نشده: این تیک ادغام می‌شود و اسلاتش در تیک بعدی پروب می‌شود
+        guard.missed += 1
+        guard.total_skipped += 1
+        return
 
-    all_tasks = []
-    for uid in all_users:
-        all_tasks.append(protected_process(uid))
+    guard.running = True
+    steps, guard.missed = guard.missed + 1, 0
+    started = time.monotonic()
+    try:
+        await run_monitor_tick(context, guard, steps)
+    finally:
+        guard.running = False
+        guard.last_duration = time.monotonic() - started
+
+async def run_monitor_tick(context, guard, steps):
+    # تاخیری بیشتر از یک دور کامل همان یک دور است: هر اسلات (و هر سرور) حداکثر یکبار در تیک می‌آید
+    steps = min(steps, MONITOR_WHEEL.slots)
+    slots = list(dict.fromkeys(MONITOR_WHEEL.advance() for _ in range(steps)))
+    new_round = 0 in slots
+
+    # لیست سرورها و تنظیمات در ابتدای هر دور از کش‌های حافظه (ServerRegistry و تنظیمات) برداشته می‌شود
+    if new_round or not MONITOR_WHEEL.owners:
+        by_owner = await adb.read(db.get_servers_by_owner)
+        settings = await adb.read(lambda: {uid: db.get_settings(uid) for uid in by_owner})
+        MONITOR_WHEEL.owners = {uid: (servers, settings[uid]) for uid, servers in by_owner.items()}
+
+        known = {s['id'] for servers, _ in MONITOR_WHEEL.owners.values() for s in servers if s['is_active']}
+        SNAPSHOTS.prune(known)
+        guard.carryover = {sid: v for sid, v in guard.carryover.items() if sid in known}
+        MONITOR_POLICY.prune(known)
+        HOST_BREAKER.prune({
+            (s['ip'], int(s['port'])) for servers, _ in MONITOR_WHEEL.owners.values() for s in servers if s['is_active']
+        })
 
-    if all_tasks:
-        await asyncio.gather(*all_tasks)
+    owners = MONITOR_WHEEL.owners
+
+    # سرورهای جامانده از تیک قبل اول پروب می‌شوند
+    carry = {}
+    for uid, srv, _ in guard.carryover.values():
+        carry.setdefault(uid, []).append(srv)
+    due = {}
+    for slot in slots:
+        for uid, items in MONITOR_WHEEL.due_jobs(slot).items():
+            due.setdefault(uid, []).extend(
+                s for s in items if s['id'] not in guard.carryover and MONITOR_POLICY.due(s['id'])
+            )
 
-async def process_single_user(context, uid, servers, settings, loop):
-    tasks = []
-    for s in servers:
-        if s['is_active']:
-            tasks.append(loop.run_in_executor(None, ServerMonitor.check_full_stats, s['ip'], s['port'], s['username'], sec.decrypt(s['password'])))
-        else:
-            async def fake(): return {'status': 'Disabled'}
-            tasks.append(fake())
-            
-    results = await asyncio.gather(*tasks)
-    
+    # صف در سطح سرور: سقف همزمانی سراسری، نوبت چرخشی بین کاربران و بودجه زمانی هر تیک
+    now = time.time()
+    results, leftover = await MONITOR_SCHEDULER.run(
+        due, probe_server, deadline=time.monotonic() + guard.budget, priority=carry
+    )
+    guard.record_leftover(leftover, now)
+    for uid, per_owner in results.items():
+        for sid, res in per_owner.items():
+            SNAPSHOTS.put(sid, res)
+            if uid in owners: MONITOR_POLICY.observe(sid, res, owners[uid][1])
+
+    # هشدارها برای سرورهای پروب شده؛ گزارش زمان‌بندی شده فقط یکبار در هر دور (اسلات صفر)
+    await asyncio.gather(*(
+        process_single_user(context, uid, servers, settings, results.get(uid, {}))
+        for uid, (servers, settings) in owners.items()
+        if results.get(uid) or new_round
+    ))
+
+    # آمار کل تیک با یک executemany از طریق ترد نویسنده نوشته می‌شود
+    rows = STATS_BUFFER.drain()
+    if rows: await adb.write(db.add_server_stats, rows)
+
+async def process_single_user(context, uid, servers, settings, results):
     # --- شروع ساخت گزارش ---
     header = f"📅 **گزارش خودکار ({get_jalali_str()})**\n➖➖➖➖➖➖\n"
     report_lines = []
     
-    for i, res in enumerate(results):
-        s_info = servers[i]
-        r = res if isinstance(res, dict) else await res
+    for s_info in servers:
+        sid = s_info['id']
+        probed = sid in results
+        if probed:
+            r = results[sid]
+        elif s_info['is_active']:
+            # در اسلات دیگری پروب می‌شود؛ آخرین نتیجه برای گزارش کافی است
+            r = SNAPSHOTS.get(sid) or ProbeResult(status='Unknown')
+        else:
+            r = ProbeResult(status='Disabled')
         
         # لاجیک ذخیره آمار و تبریک آپتایم (بدون تغییر)
-        if r.get('status') == 'Online':
-            db.add_server_stat(s_info['id'], r.get('cpu', 0), r.get('ram', 0))
+        if probed and r.get('status') == 'Online':
+            STATS_BUFFER.add(s_info['id'], r.get('cpu', 0), r.get('ram', 0), r.get('rtt'))
             
             # ... (کد تبریک آپتایم که قبلا داشتید اینجا محفوظ است فرض کنید هست) ...
             # ... (کد هشدار ورود SSH که قبلا دادم اینجا محفوظ است) ...
 
             # لاجیک هشدار منابع (Resource Alert)
             alert_msgs = []
-            if r['cpu'] >= settings['cpu']: alert_msgs.append(f"🧠 **CPU:** `{r['cpu']}%`")
-            if r['ram'] >= settings['ram']: alert_msgs.append(f"💾 **RAM:** `{r['ram']}%`")
-            if r['disk'] >= settings['disk']: alert_msgs.append(f"💿 **Disk:** `{r['disk']}%`")
+            if r['cpu'] >= settings.cpu: alert_msgs.append(f"🧠 **CPU:** `{r['cpu']}%`")
+            if r['ram'] >= settings.ram: alert_msgs.append(f"💾 **RAM:** `{r['ram']}%`")
+            if r['disk'] >= settings.disk: alert_msgs.append(f"💿 **Disk:** `{r['disk']}%`")
             
             if alert_msgs:
                 last_alert = CPU_ALERT_TRACKER.get((uid, s_info['id']), 0)
@@ -3016,19 +4699,19 @@ async def process_single_user(context, uid, servers, settings, loop):
                     CPU_ALERT_TRACKER[(uid, s_info['id'])] = time.time()
 
         # آیکون وضعیت برای گزارش کلی
-        icon = "✅" if r.get('status') == 'Online' else "❌"
-        status_txt = f"{r.get('cpu')}% CPU" if r.get('status') == 'Online' else "OFF"
+        icon = "✅" if r.get('status') == 'Online' else "⏳" if r.get('status') == 'Unknown' else "❌"
+        status_txt = f"{r.get('cpu')}% CPU" if r.get('status') == 'Online' else "..." if r.get('status') == 'Unknown' else "OFF"
         report_lines.append(f"{icon} **{s_info['name']}** ⇽ `{status_txt}`")
         
         # بررسی قطعی هوشمند (Smart Down Check)
-        if settings['down_alert'] and s_info['is_active']:
+        if probed and settings.down_alert and s_info['is_active']:
              await check_server_down_logic(context, uid, s_info, r)
 
     # --- ارسال گزارش زمان‌بندی شده (با رفع باگ طولانی بودن پیام) ---
-    report_int = settings['report_interval']
-    if report_int and int(report_int) > 0:
+    report_int = settings.report_interval
+    if report_int > 0:
         last_run = LAST_REPORT_CACHE.get(uid, 0)
-        if time.time() - last_run > int(report_int):
+        if time.time() - last_run > report_int:
             
             # تقسیم پیام به بخش‌های کوچک‌تر (Chunking)
             final_msg = header + "\n".join(report_lines)
@@ -3060,11 +4743,13 @@ async def check_server_down_logic(context, uid, s, res):
         extra_note = ""
 
         # فقط اگر بار اوله که متوجه قطعی میشیم چک کنیم (که اسپم API نشه)
-        if fails == 0: 
+        if res.get('rtt') is not None:
+            # پورت SSH پاسخ داده: شبکه سالم است و نیازی به Check-Host نیست
+            extra_note = f"\n🔑 **نکته:** پورت SSH پاسخ می‌دهد (`{res['rtt']} ms`)؛ مشکل از سرویس SSH یا احراز هویت است."
+        elif fails == 0: 
             try:
-                # استفاده از تابع موجود در کلاس ServerMonitor
-                loop = asyncio.get_running_loop()
-                chk_ok, chk_data = await loop.run_in_executor(None, ServerMonitor.check_host_api, s['ip'])
+                # از مسیر Single-Flight (کش کوتاه Check-Host)
+                chk_ok, chk_data = await coalesced_host_check(s['ip'])
                 
                 if chk_ok and isinstance(chk_data, dict):
                     # بررسی می‌کنیم آیا حداقل ۳ تا نود تونستن پینگ کنن؟
@@ -3095,7 +4780,7 @@ async def check_server_down_logic(context, uid, s, res):
                 )
                 
                 # ارسال به کانال‌های کاربر
-                user_channels = db.get_user_channels(uid)
+                user_channels = await adb.read(db.get_user_channels, uid)
                 sent = False
                 for c in user_channels:
                     if c['usage_type'] in ['down', 'all']:
@@ -3109,7 +4794,7 @@ async def check_server_down_logic(context, uid, s, res):
                     try: await context.bot.send_message(uid, alrt, parse_mode='Markdown')
                     except: pass
                 
-                db.update_status(s['id'], "Offline")
+                await adb.write(db.update_status, s['id'], "Offline")
         else:
             # اگر واقعا داون نبود ولی ربات وصل نمیشد، کانتر رو صفر نگه دار یا ریست کن
             SERVER_FAILURE_COUNTS[k] = 0
@@ -3126,7 +4811,7 @@ async def check_server_down_logic(context, uid, s, res):
                     f"♻️ سرور مجدداً در دسترس قرار گرفت."
                 )
                 
-                user_channels = db.get_user_channels(uid)
+                user_channels = await adb.read(db.get_user_channels, uid)
                 sent = False
                 for c in user_channels:
                     if c['usage_type'] in ['down', 'all']:
@@ -3137,7 +4822,7 @@ async def check_server_down_logic(context, uid, s, res):
                 if not sent:
                     try: await context.bot.send_message(uid, rec_msg, parse_mode='Markdown')
                     except: pass
-                db.update_status(s['id'], "Online")
+                await adb.write(db.update_status, s['id'], "Online")
 # ==============================================================================
 # 🌍 GLOBAL OPERATIONS (NEW FEATURES)
 # ==============================================================================
@@ -3164,7 +4849,7 @@ async def global_action_handler(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     action = query.data.split('_')[2] # update, ram, disk, full
     uid = update.effective_user.id
-    servers = db.get_all_user_servers(uid)
+    servers = await adb.read(db.get_all_user_servers, uid)
     active_servers = [s for s in servers if s['is_active']]
     
     if not active_servers:
@@ -3213,8 +4898,8 @@ async def run_global_commands_background(context, chat_id, servers, action):
 
     for srv in servers:
         try:
-            ok, output = await asyncio.get_running_loop().run_in_executor(
-                None, ServerMonitor.run_remote_command, 
+            ok, output = await TASK_EXECUTOR.run(
+                srv['ip'], ServerMonitor.run_remote_command, 
                 srv['ip'], srv['port'], srv['username'], sec.decrypt(srv['password']), 
                 cmd, 600 
             )
@@ -3251,7 +4936,7 @@ async def auto_update_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.callback_query: await update.callback_query.answer()
 
     uid = update.effective_user.id
-    curr = db.get_setting(uid, 'auto_update_hours') or '0'
+    curr = await adb.read(db.get_setting, uid, 'auto_update_hours') or '0'
     
     def st(val): return "✅" if str(val) == str(curr) else ""
 
@@ -3277,7 +4962,7 @@ async def auto_reboot_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.callback_query: await update.callback_query.answer()
 
     uid = update.effective_user.id
-    curr_setting = db.get_setting(uid, 'auto_reboot_config')
+    curr_setting = await adb.read(db.get_setting, uid, 'auto_reboot_config')
     
     status_txt = "❌ غیرفعال"
     if curr_setting and curr_setting != 'OFF':
@@ -3358,7 +5043,7 @@ async def save_auto_reboot_final(update: Update, context: ContextTypes.DEFAULT_T
     uid = update.effective_user.id
     
     if data == 'disable_reboot':
-        db.set_setting(uid, 'auto_reboot_config', 'OFF')
+        await adb.write(db.set_setting, uid, 'auto_reboot_config', 'OFF')
         await query.answer("✅ ریبوت خودکار غیرفعال شد.", show_alert=True)
         await auto_reboot_menu(update, context)
         return
@@ -3368,8 +5053,8 @@ async def save_auto_reboot_final(update: Update, context: ContextTypes.DEFAULT_T
     time_str = parts[2]
     
     config_str = f"{days}|{time_str}" 
-    db.set_setting(uid, 'auto_reboot_config', config_str)
-    db.set_setting(uid, 'last_reboot_date', '2000-01-01') 
+    await adb.write(db.set_setting, uid, 'auto_reboot_config', config_str)
+    await adb.write(db.set_setting, uid, 'last_reboot_date', '2000-01-01') 
     
     await query.answer(f"✅ تنظیم شد: هر {days} روز ساعت {time_str}")
     await auto_reboot_menu(update, context)
@@ -3384,15 +5069,14 @@ async def startup_whitelist_job(context: ContextTypes.DEFAULT_TYPE):
 
     logger.info(f"🛡 Starting Global IP Whitelist (Bot IP: {bot_ip})...")
     
-    with db.get_connection() as conn:
-        servers = conn.execute("SELECT * FROM servers").fetchall()
+    servers = await adb.read(db.get_all_servers)
 
     count = 0
     for srv in servers:
         try:
             real_pass = sec.decrypt(srv['password'])
-            await loop.run_in_executor(
-                None, 
+            await TASK_EXECUTOR.run(
+                srv['ip'], 
                 ServerMonitor.whitelist_bot_ip, 
                 srv['ip'], srv['port'], srv['username'], real_pass, bot_ip
             )
@@ -3404,8 +5088,7 @@ async def startup_whitelist_job(context: ContextTypes.DEFAULT_TYPE):
 # --- تابع اجرایی جاب (Job) ---
 async def auto_scheduler_job(context: ContextTypes.DEFAULT_TYPE):
     """این تابع هر دقیقه اجرا می‌شود و چک می‌کند آیا وقت عملیات رسیده؟"""
-    loop = asyncio.get_running_loop()
-    users = await loop.run_in_executor(None, db.get_all_users)
+    users = await adb.read(db.get_all_users)
     now = time.time()
     
     # زمان فعلی ایران
@@ -3416,33 +5099,34 @@ async def auto_scheduler_job(context: ContextTypes.DEFAULT_TYPE):
 
     for user in users:
         uid = user['user_id']
+        cfg = await adb.read(db.get_settings, uid)
         
         # 1. چک کردن آپدیت خودکار (بدون تغییر)
-        up_interval = db.get_setting(uid, 'auto_update_hours')
-        if up_interval and up_interval != '0':
-            last_run = int(db.get_setting(uid, 'last_auto_update_run') or 0)
-            interval_sec = int(up_interval) * 3600
+        up_interval = cfg.auto_update_hours
+        if up_interval > 0:
+            last_run = cfg.last_auto_update_run
+            interval_sec = up_interval * 3600
             if now - last_run > interval_sec:
-                servers = db.get_all_user_servers(uid)
+                servers = await adb.read(db.get_all_user_servers, uid)
                 active = [s for s in servers if s['is_active']]
                 if active:
                     try: await context.bot.send_message(uid, f"🔄 **شروع آپدیت خودکار ({up_interval} ساعته)...**")
                     except: pass
                     asyncio.create_task(run_global_commands_background(context, uid, active, 'update'))
-                db.set_setting(uid, 'last_auto_update_run', int(now))
+                await adb.write(db.set_setting, uid, 'last_auto_update_run', int(now))
 
         # 2. چک کردن ریبوت خودکار (لاجیک جدید)
         # فرمت کانفیگ: "DAYS|HH:MM"
-        reb_config = db.get_setting(uid, 'auto_reboot_config')
+        reb_config = cfg.auto_reboot_config
         
-        if reb_config and reb_config != 'OFF' and '|' in reb_config:
+        if reb_config != 'OFF' and '|' in reb_config:
             try:
                 interval_days_str, target_time = reb_config.split('|')
                 interval_days = int(interval_days_str)
                 
                 # اگر ساعت فعلی با ساعت تنظیم شده یکی بود
                 if current_hhmm == target_time:
-                    last_reb_str = db.get_setting(uid, 'last_reboot_date') or '2000-01-01'
+                    last_reb_str = cfg.last_reboot_date
                     last_reb_date = datetime.strptime(last_reb_str, "%Y-%m-%d").date()
                     
                     # محاسبه فاصله روزها
@@ -3450,7 +5134,7 @@ async def auto_scheduler_job(context: ContextTypes.DEFAULT_TYPE):
                     
                     # اگر تعداد روزهای گذشته >= فاصله تنظیم شده باشد
                     if days_diff >= interval_days:
-                        servers = db.get_all_user_servers(uid)
+                        servers = await adb.read(db.get_all_user_servers, uid)
                         active = [s for s in servers if s['is_active']]
                         if active:
                             try: await context.bot.send_message(uid, f"⚠️ **شروع ریبوت خودکار (هر {interval_days} روز - {target_time})...**")
@@ -3463,7 +5147,7 @@ async def auto_scheduler_job(context: ContextTypes.DEFAULT_TYPE):
                                     )
                                 )
                         # بروزرسانی تاریخ آخرین اجرا به امروز
-                        db.set_setting(uid, 'last_reboot_date', today_date_str)
+                        await adb.write(db.set_setting, uid, 'last_reboot_date', today_date_str)
             except Exception as e:
                 logger.error(f"Auto Reboot Error for {uid}: {e}")
 async def auto_backup_send_job(context: ContextTypes.DEFAULT_TYPE):
@@ -3473,8 +5157,7 @@ async def auto_backup_send_job(context: ContextTypes.DEFAULT_TYPE):
 
     # 1. اطمینان از ذخیره شدن تمام داده‌ها روی دیسک
     try:
-        with db.get_connection() as conn:
-            conn.execute("PRAGMA wal_checkpoint(FULL);")
+        await adb.write(db.checkpoint, exclusive=True)
     except Exception as e:
         logger.error(f"Backup Checkpoint Error: {e}")
 
@@ -3483,7 +5166,7 @@ async def auto_backup_send_job(context: ContextTypes.DEFAULT_TYPE):
     caption = (
         f"📦 **بکاپ خودکار ساعتی**\n"
         f"📅 زمان: `{get_jalali_str()}`\n"
-        f"🤖 دیتابیس ربات"
+        f"🤖 دیتابیس ربات (بدون آمار)"
     )
 
     try:
@@ -3497,13 +5180,37 @@ async def auto_backup_send_job(context: ContextTypes.DEFAULT_TYPE):
             )
     except Exception as e:
         logger.error(f"Auto Backup Send Failed: {e}")
+
+async def auto_stats_backup_job(context: ContextTypes.DEFAULT_TYPE):
+    """بکاپ دیتابیس آمار (جدا و با فاصله بیشتر از بکاپ ساعتی)"""
+    chat_id = SUPER_ADMIN_ID
+    if not chat_id or not os.path.exists(STATS_DB_NAME): return
+
+    try:
+        await adb.write(db.checkpoint, True, exclusive=True)
+    except Exception as e:
+        logger.error(f"Stats Backup Checkpoint Error: {e}")
+
+    timestamp = get_tehran_datetime().strftime("%Y-%m-%d_%H-%M")
+    try:
+        with open(STATS_DB_NAME, 'rb') as f:
+            await context.bot.send_document(
+                chat_id=chat_id,
+                document=f,
+                filename=f"stats_backup_{timestamp}.db",
+                caption=f"📈 **بکاپ دیتابیس آمار**\n📅 زمان: `{get_jalali_str()}`",
+                parse_mode='Markdown'
+            )
+    except Exception as e:
+        logger.error(f"Stats Backup Send Failed: {e}")
+
 async def save_auto_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """ذخیره تنظیمات آپدیت خودکار"""
     query = update.callback_query
     uid = update.effective_user.id
     hours = query.data.split('_')[2]
     
-    db.set_setting(uid, 'auto_update_hours', hours)
+    await adb.write(db.set_setting, uid, 'auto_update_hours', hours)
     
     if hours == '0':
         msg = "❌ آپدیت خودکار غیرفعال شد."
@@ -3523,7 +5230,7 @@ async def wallet_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.callback_query: await update.callback_query.answer()
     
     uid = update.effective_user.id
-    user = db.get_user(uid)
+    user = await adb.read(db.get_user, uid)
     
     # تعیین نوع اشتراک فعلی
     plan_names = {0: 'پایه (رایگان)', 1: 'برنزی 🥉', 2: 'نقره‌ای 🥈', 3: 'طلایی 🥇'}
@@ -3603,14 +5310,14 @@ async def show_payment_details(update: Update, context: ContextTypes.DEFAULT_TYP
     user_id = update.effective_user.id
     
     # دریافت روش‌های فعال از دیتابیس
-    methods = db.get_payment_methods(db_type)
+    methods = await adb.read(db.get_payment_methods, db_type)
     
     if not methods:
         await safe_edit_message(update, "❌ متاسفانه در حال حاضر هیچ روش پرداختی برای این گزینه فعال نیست.\nلطفاً با پشتیبانی تماس بگیرید.")
         return
 
     # ثبت سفارش اولیه
-    pay_id = db.create_payment(user_id, plan_key, plan['price'], method_type)
+    pay_id = await adb.write(db.create_payment, user_id, plan_key, plan['price'], method_type)
     
     details_txt = ""
     if db_type == 'card':
@@ -3680,8 +5387,7 @@ async def process_receipt_upload(update: Update, context: ContextTypes.DEFAULT_T
     user = update.effective_user
     
     # پیدا کردن اطلاعات پرداخت از دیتابیس
-    with db.get_connection() as conn:
-        pay_info = conn.execute("SELECT * FROM payments WHERE id=?", (pay_id,)).fetchone()
+    pay_info = await adb.read(db.get_payment, pay_id)
     
     if not pay_info:
         await update.message.reply_text("❌ تراکنش یافت نشد.")
@@ -3744,7 +5450,7 @@ async def admin_approve_payment_action(update: Update, context: ContextTypes.DEF
     query = update.callback_query
     pay_id = query.data.split('_')[3]
     
-    res = db.approve_payment(pay_id)
+    res = await adb.write(db.approve_payment, pay_id)
     
     if res:
         user_id, plan_name = res
@@ -3764,7 +5470,7 @@ async def referral_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.callback_query: await update.callback_query.answer()
     
     uid = update.effective_user.id
-    user = db.get_user(uid)
+    user = await adb.read(db.get_user, uid)
     bot_username = context.bot.username
     
     invite_link = f"https://t.me/{bot_username}?start={uid}"
@@ -3793,6 +5499,9 @@ async def referral_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await safe_edit_message(update, txt, reply_markup=InlineKeyboardMarkup(kb))
 def main():
     print("🚀 SONAR ULTRA PRO RUNNING...")
+    # تاریخچه تاخیر هاست‌ها تا تایم‌اوت‌های تطبیقی بعد از ری‌استارت از صفر شروع نشوند
+    LATENCY.load(db.get_latency_history())
+    db.load_all_settings()
     
     # تنظیمات اپلیکیشن با تایم‌اوت‌های افزایش یافته برای پایداری در شبکه
     app = (
@@ -4008,8 +5717,9 @@ def main():
     if app.job_queue:
         # بررسی انقضا سرورها (هر روز ساعت 8:30 صبح)
         app.job_queue.run_daily(check_expiry_job, time=dt.time(hour=8, minute=30, second=0))
-        # مانیتورینگ اصلی (هر 40 ثانیه)
-        app.job_queue.run_repeating(global_monitor_job, interval=DEFAULT_INTERVAL, first=10)
+        # مانیتورینگ اصلی (هر سرور هر 40 ثانیه، پخش شده در اسلات‌های 5 ثانیه‌ای)
+        # (max_instances=2 تا تیک همپوشان به MonitorTickGuard برسد و ادغام شود)
+        app.job_queue.run_repeating(global_monitor_job, interval=MONITOR_WHEEL_TICK, first=10, job_kwargs={'max_instances': 2})
         # جاب اسکژولر برای آپدیت و ریبوت خودکار (هر دقیقه)
         app.job_queue.run_repeating(auto_scheduler_job, interval=60, first=20)
         # وایت‌لیست کردن آی‌پی ربات در شروع (یکبار)
@@ -4018,11 +5728,31 @@ def main():
         app.job_queue.run_repeating(auto_backup_send_job, interval=3600, first=300)
         # بررسی انقضای پاداش رفرال (هر 12 ساعت)
         app.job_queue.run_repeating(check_bonus_expiry_job, interval=43200, first=60)
+        # پاکسازی اتصال‌های بیکار Pool اس‌اس‌اچ (هر دقیقه)
+        app.job_queue.run_repeating(ssh_pool_maintenance_job, interval=60, first=60)
+        # حذف دسته‌ای آمار قدیمی (هر 10 دقیقه)
+        app.job_queue.run_repeating(stats_retention_job, interval=600, first=120)
+        # تجمیع آمار در جداول Rollup (هر 5 دقیقه)
+        app.job_queue.run_repeating(stats_rollup_job, interval=300, first=90)
+        # حذف آمار سرورهای حذف شده (روزانه)
+        app.job_queue.run_repeating(stats_orphan_job, interval=86400, first=900)
+        # بکاپ دیتابیس آمار (اختیاری، پیش‌فرض روزانه)
+        if STATS_BACKUP_INTERVAL > 0:
+            app.job_queue.run_repeating(auto_stats_backup_job, interval=STATS_BACKUP_INTERVAL, first=STATS_BACKUP_INTERVAL)
     else:
         logger.error("JobQueue not available. Install python-telegram-bot[job-queue]")
     
     # اجرای ربات
     app.run_polling(drop_pending_updates=True, close_loop=False)
+    PROBE_EXECUTOR.shutdown()
+    TASK_EXECUTOR.shutdown()
+    SSH_POOL.close_all()
+    adb.shutdown()
+    rows = LATENCY.pop_dirty()
+    if rows: db.save_latency_history(rows)
+    rows = STATS_BUFFER.drain()
+    if rows: db.add_server_stats(rows)
+    db.close_all()
 
 if __name__ == '__main__':
     main()
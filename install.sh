@@ -10,6 +10,7 @@ SERVICE_NAME="sonar-bot"
 REPO_URL="https://github.com/Amirtn9/radar-sonar.git"
 RAW_URL="https://raw.githubusercontent.com/Amirtn9/radar-sonar/main"
 DB_FILE="sonar_ultra_pro.db"
+STATS_DB_FILE="sonar_stats.db"
 KEY_FILE="secret.key"
 CONFIG_FILE="sonar_config.json"
 
@@ -111,6 +112,7 @@ function install_process() {
     
     print_info "Backing up Database & Keys"
     if [ -f "$INSTALL_DIR/$DB_FILE" ]; then cp "$INSTALL_DIR/$DB_FILE" /tmp/sonar_db.bak; fi
+    if [ -f "$INSTALL_DIR/$STATS_DB_FILE" ]; then cp "$INSTALL_DIR/$STATS_DB_FILE" /tmp/sonar_stats_db.bak; fi
     if [ -f "$INSTALL_DIR/$KEY_FILE" ]; then cp "$INSTALL_DIR/$KEY_FILE" /tmp/sonar_key.bak; fi
     
     # اگر آپدیت است، اطلاعات را از فایل JSON موجود می‌خوانیم
@@ -143,6 +145,7 @@ function install_process() {
     # 6. Restore Data
     print_info "Restoring Database & Keys"
     if [ -f "/tmp/sonar_db.bak" ]; then mv /tmp/sonar_db.bak "$INSTALL_DIR/$DB_FILE"; fi
+    if [ -f "/tmp/sonar_stats_db.bak" ]; then mv /tmp/sonar_stats_db.bak "$INSTALL_DIR/$STATS_DB_FILE"; fi
     if [ -f "/tmp/sonar_key.bak" ]; then mv /tmp/sonar_key.bak "$INSTALL_DIR/$KEY_FILE"; fi
 
     # 7. Setup Python Environment
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# bot.py هنگام import فایل‌های دیتابیس و کلید را در پوشه جاری می‌سازد؛ تست‌ها در پوشه موقت اجرا می‌شوند
+os.chdir(tempfile.mkdtemp(prefix='sonar-tests-'))
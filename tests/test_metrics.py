@@ -0,0 +1,135 @@
+import os
+
+import pytest
+
+from bot import CounterDeltaEngine, MetricsParser
+
+PAYLOADS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'payloads')
+
+
+def load(name):
+    with open(os.path.join(PAYLOADS, name)) as f:
+        return f.read()
+
+
+def counters(uptime, busy, total, rx=0, tx=0, dr=0, dw=0):
+    return {'counters': {
+        'uptime': uptime, 'cpu_busy': busy, 'cpu_total': total,
+        'net_rx': rx, 'net_tx': tx, 'disk_read': dr, 'disk_write': dw
+    }, 'cpu': 0.0}
+
+
+# --- MetricsParser ---
+
+def test_parse_recorded_ubuntu_payload():
+    stats = MetricsParser.parse(load('ubuntu_22_04.txt'))
+    assert stats['cpu'] == 14.5
+    assert stats['ram'] == 40.0
+    assert stats['disk'] == 43  # مثل Use% در df (گرد به بالا)
+    assert stats['uptime_str'] == '1 d, 2 h, 3 m'
+    assert stats['traffic_gb'] == 1.5
+    assert stats['ssh_sessions'] == ['root_203.0.113.7', 'admin_198.51.100.20']
+    c = stats['counters']
+    assert (c['cpu_busy'], c['cpu_total']) == (1370, 9470)
+    # فقط دیسک کامل sda؛ پارتیشن، loop و dm شمرده نمی‌شوند
+    assert (c['disk_read'], c['disk_write']) == (400000 * 512, 600000 * 512)
+
+
+def test_parse_recorded_payload_without_memavailable():
+    stats = MetricsParser.parse(load('centos_7_no_memavailable.txt'))
+    assert stats['cpu'] == 15.0
+    assert stats['ram'] == 50.0  # MemFree + Buffers + Cached
+    assert stats['disk'] == 100
+    assert stats['uptime_str'] == '10 m'
+    assert stats['ssh_sessions'] == []
+    assert (stats['counters']['disk_read'], stats['counters']['disk_write']) == (2000 * 512, 4000 * 512)
+
+
+def test_truncated_payload_is_rejected():
+    payload = load('ubuntu_22_04.txt').replace('@@end', '')
+    with pytest.raises(ValueError):
+        MetricsParser.parse(payload)
+    with pytest.raises(ValueError):
+        MetricsParser.parse('')
+
+
+def test_malformed_sections_fall_back_to_defaults():
+    payload = (
+        "@@stat\nintr 1 2 3\n"
+        "@@meminfo\nMemFree: abc kB\n"
+        "@@statvfs\nstat: cannot read file system information\n"
+        "@@uptime\n"
+        "@@netdev\n  eth0: garbage\n"
+        "@@diskstats\n 8 0 sda x y\n"
+        "@@end\n"
+    )
+    stats = MetricsParser.parse(payload)
+    assert stats['cpu'] == 0.0
+    assert stats['ram'] == 0.0
+    assert stats['disk'] == 0
+    assert stats['uptime_sec'] == 0
+    assert stats['traffic_gb'] == 0
+    assert stats['ssh_sessions'] == []
+
+
+def test_missing_sections_fall_back_to_defaults():
+    stats = MetricsParser.parse("@@stat\ncpu 10 0 10 80\n@@end\n")
+    assert stats['cpu'] == 20.0
+    assert stats['ram'] == 0.0
+    assert stats['counters']['net_rx'] == 0
+
+
+# --- CounterDeltaEngine ---
+
+def test_first_sample_has_no_rates():
+    engine = CounterDeltaEngine({})
+    stats = engine.apply('h', counters(100, 50, 1000, rx=10_000), now=1000.0)
+    assert 'counters' not in stats
+    assert stats['net_rx_bps'] is None and stats['disk_write_bps'] is None
+    assert stats['cpu'] == 0.0  # CPU تجمعی از parse دست نمی‌خورد
+
+
+def test_second_sample_uses_deltas():
+    engine = CounterDeltaEngine({})
+    engine.apply('h', counters(100, 100, 1000, rx=1000, tx=500, dr=0, dw=0), now=1000.0)
+    stats = engine.apply('h', counters(110, 400, 2000, rx=11000, tx=2500, dr=5120, dw=10240), now=1010.0)
+    assert stats['cpu'] == 30.0
+    assert stats['net_rx_bps'] == 1000.0
+    assert stats['net_tx_bps'] == 200.0
+    assert stats['disk_read_bps'] == 512.0
+    assert stats['disk_write_bps'] == 1024.0
+
+
+def test_counter_reset_never_yields_huge_rate():
+    engine = CounterDeltaEngine({})
+    engine.apply('h', counters(5000, 9000, 10000, rx=2**40, tx=2**40), now=1000.0)
+    # ریبوت: آپتایم و شمارنده‌ها صفر شده‌اند
+    stats = engine.apply('h', counters(30, 10, 100, rx=1000, tx=1000), now=1040.0)
+    assert stats['net_rx_bps'] is None and stats['net_tx_bps'] is None
+    # بعد از ریست، نمونه جدید پایه است
+    stats = engine.apply('h', counters(40, 20, 200, rx=2000, tx=1000), now=1050.0)
+    assert stats['net_rx_bps'] == 100.0
+
+
+def test_single_counter_wrap_is_treated_as_reset():
+    engine = CounterDeltaEngine({})
+    engine.apply('h', counters(100, 100, 1000, rx=2**32 - 10), now=1000.0)
+    stats = engine.apply('h', counters(110, 200, 2000, rx=50), now=1010.0)
+    assert stats['net_rx_bps'] is None
+    assert all(v is None or v >= 0 for k, v in stats.items() if k.endswith('_bps'))
+
+
+def test_samples_closer_than_min_window_reuse_previous_rates():
+    engine = CounterDeltaEngine({})
+    engine.apply('h', counters(100, 100, 1000, rx=0), now=1000.0)
+    first = engine.apply('h', counters(110, 200, 2000, rx=10000), now=1010.0)
+    again = engine.apply('h', counters(110.2, 201, 2002, rx=10500), now=1010.2)
+    assert again['net_rx_bps'] == first['net_rx_bps']
+
+
+def test_prune_drops_old_hosts():
+    samples = {}
+    engine = CounterDeltaEngine(samples)
+    engine.apply('old', counters(1, 1, 10), now=1.0)
+    engine.prune(max_age=60)
+    assert 'old' not in samples
@@ -0,0 +1,32 @@
+import pytest
+
+from bot import Database
+
+
+@pytest.fixture
+def database():
+    db = Database()
+    yield db
+    db.close_all()
+
+
+def test_set_setting_after_full_load_for_uncached_owner(database):
+    database.load_all_settings()
+    database.set_setting(5, 'cpu_threshold', 70)
+    assert database.get_setting(5, 'cpu_threshold') == '70'
+    assert database.get_settings(5).cpu == 70
+
+
+def test_set_setting_without_full_load_keeps_other_keys(database):
+    database.set_setting(6, 'ram_threshold', 60)
+    database.clear_settings_cache()
+    database.set_setting(6, 'cpu_threshold', 70)
+    settings = database.get_settings(6)
+    assert (settings.cpu, settings.ram, settings.disk) == (70, 60, 90)
+
+
+def test_set_setting_updates_cached_typed_settings(database):
+    database.load_all_settings()
+    assert database.get_settings(7).cpu == 80
+    database.set_setting(7, 'cpu_threshold', 55)
+    assert database.get_settings(7).cpu == 55